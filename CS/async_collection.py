@@ -0,0 +1,210 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from extensions.connect_db import DBConnection
+from extensions.http_session import configure_session, POOL_SIZE, stats as http_stats
+from extensions.player_cache import get_player_cache
+from extensions.battle_dedup import get_battle_dedup
+from extensions.frontier import get_frontier
+from extensions.yield_model import get_yield_model
+from helpers import log, cr_api_request
+from batch_writer import get_batch_writer
+from data_collection import (SLEEP_TIME, BFS_PLAYERS, insert_battle, store_player_info, get_init_battle,
+                             get_random_playertags)
+
+
+# number of API requests kept in flight at once
+CONCURRENCY = 16
+
+
+class AsyncCrawler:
+    """
+    An asyncio version of collect_data(): the same crawl of the players queued in the frontier
+    (resumed after a restart), but with up to `concurrency` battle_log/player_info requests in
+    flight at once.
+    cr_api_request() is blocking, so requests run in a thread pool; all DB work runs in
+    a dedicated single thread, since a psycopg2 connection must not be shared across
+    concurrent cursors (this includes frontier and YieldModel calls that may checkpoint or
+    commit, since they flush the batch writer). Network and DB work therefore overlap.
+    """
+
+    def __init__(self, con, concurrency: int = CONCURRENCY):
+        """
+        :param con: A psycopg2 connection object;
+        :param concurrency: Maximum number of API requests in flight.
+        """
+        self.con = con
+        self.concurrency = concurrency
+        self.semaphore = None  # created inside the running event loop
+        self.api_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='api')
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+    async def request(self, tag: str, action: str) -> dict:
+        """
+        Non-blocking wrapper of cr_api_request(); same return value and error semantics
+        (403 still terminates the program; 429 and 503 are retried in the worker thread).
+        """
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            res = await loop.run_in_executor(self.api_executor, cr_api_request, tag, action)
+            await asyncio.sleep(SLEEP_TIME)  # keep per-slot pacing of the sync crawler
+            return res
+
+    async def db(self, func, *args):
+        """
+        Run a blocking DB function in the DB thread.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_executor, func, self.con, *args)
+
+    async def get_battle_log(self, tag: str) -> list:
+        """
+        :return: A list of battles; [] if the request failed.
+        """
+        battle_log_res = await self.request(tag, 'battle_log')
+        if battle_log_res.get('statusCode') == 200 and len(battle_log_res.get('body')) > 0:
+            return battle_log_res.get('body')
+        return []
+
+    async def insert_battle(self, battle: dict) -> bool:
+        """
+        Insert a battle, then refresh PlayerInfo of its participants concurrently
+        (skipping players refreshed within the TTL).
+        :return: False if the battle was already stored.
+        """
+        if not await self.db(insert_battle, battle, False):
+            return False  # already stored
+
+        team = battle.get('team') or []
+        opponent = battle.get('opponent') or []
+        tags = sorted(player.get('tag') for player in team + opponent)
+        # claimed until stored (or released) by store_player_info()
+        tags = await self.db(get_player_cache().stale_tags, tags, True)
+
+        player_info_results = await asyncio.gather(
+            *(self.request(tag, 'player_info') for tag in tags))
+        for tag, player_info_res in zip(tags, player_info_results):
+            await self.db(store_player_info, tag, player_info_res)
+        return True
+
+    async def crawl_player(self, tag: str, expand: bool = False) -> None:
+        """
+        Insert every battle in a player's battle log that is newer than the ones seen in the
+        previous request (skipped if the player is not due for a revisit).
+        :param expand: If True, push participants of every battle to the frontier (scored by YieldModel).
+        """
+        model = get_yield_model()
+        if not model.is_due(tag):
+            return
+
+        battle_log = await self.get_battle_log(tag)
+        log('Got battle log response for tag: {}, battles = {}'.format(tag, len(battle_log)))
+
+        new_battles = 0
+        for battle in model.unseen(tag, battle_log):
+            new_battles += await self.insert_battle(battle)
+
+            if expand:
+                team = battle.get('team') or []
+                opponent = battle.get('opponent') or []
+                tags = [player.get('tag') for player in team + opponent]
+                trophies = {player.get('tag'): player.get('startingTrophies') for player in team + opponent}
+                await self.db(lambda con: get_frontier().push(tags, model.score(tags, trophies)))
+
+        if len(battle_log) > 0:
+            # in the DB thread: committing the high-water marks flushes the batch writer
+            await self.db(lambda con: model.observe(tag, battle_log, new_battles))
+
+    async def crawl_frontier(self, frontier, n: int = None, expand: bool = False) -> None:
+        """
+        Crawl players popped from the frontier (highest expected yield first, see Frontier),
+        `concurrency` at a time, until it is empty (or n players were popped); a player is done
+        once its battles are buffered.
+        :param frontier: The Frontier;
+        :param n: Optional max number of players;
+        :param expand: If True, push participants of every battle to the frontier (scored by YieldModel).
+        """
+        popped = 0
+
+        async def worker():
+            nonlocal popped
+            while n is None or popped < n:
+                popped += 1
+                tag = await self.db(lambda con: frontier.pop())
+                if tag is None:
+                    return
+                await self.crawl_player(tag, expand)
+                await self.db(lambda con: frontier.done(tag))
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    async def collect(self) -> None:
+        """
+        Same traversal as collect_data(): a short BFS from an initial battle (or from the
+        players still queued before a restart), then repeated random sampling from the
+        existing player pool, all through the frontier.
+        """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        frontier = get_frontier()
+        # popped players are only checkpointed, and high-water marks committed, once their battles are written
+        frontier.before_checkpoint = get_batch_writer(self.con).flush
+        get_yield_model().before_commit = get_batch_writer(self.con).flush
+
+        if len(frontier) == 0:
+            # need an initial battle
+            init_battle = await self.db(get_init_battle)
+            await self.insert_battle(init_battle)
+
+            team = init_battle.get('team') or []
+            opponent = init_battle.get('opponent') or []
+            tags = [player.get('tag') for player in team + opponent]
+            await self.db(lambda con: frontier.push(tags))
+        else:
+            log('Resuming from frontier: {} players queued'.format(len(frontier)))
+
+        # level-order traversal: participants of the battles of the first players are queued
+        await self.crawl_frontier(frontier, BFS_PLAYERS, expand=True)
+
+        log('Exited while() - BFS')
+
+        # repeat random sampling from existing player pool
+        while True:
+            log('Entered while-true')
+            log('HTTP timings: {}'.format(http_stats.summary()))
+            log('PlayerInfo cache: {}'.format(get_player_cache().summary()))
+            log('Battle dedup: {}'.format(get_battle_dedup(self.con).summary()))
+            log('Batch writer: {}'.format(get_batch_writer(self.con).summary()))
+            log('Frontier: {}'.format(frontier.summary()))
+            log('Yield: {}'.format(get_yield_model().summary()))
+            get_battle_dedup(self.con).prune()
+
+            # players still queued (from the BFS, or from before a restart) go first
+            if len(frontier) == 0:
+                random_playertags = await self.db(get_random_playertags)
+                tags = [tp[0] for tp in random_playertags]
+                await self.db(lambda con: frontier.push(tags, get_yield_model().score(tags)))
+
+                log('Got random player tags')
+
+            await self.crawl_frontier(frontier)
+
+            await self.db(lambda con: frontier.checkpoint())  # flushes the batch writer first
+            await self.db(lambda con: get_yield_model().commit())
+
+
+def collect_data_async(concurrency: int = CONCURRENCY) -> None:
+    """
+    Entry point of the async crawl mode; see AsyncCrawler.
+    :param concurrency: Maximum number of API requests in flight.
+    """
+    # one keep-alive connection per in-flight request
+    configure_session(pool_size=max(POOL_SIZE, concurrency))
+
+    db = DBConnection()
+    con = db.get_con()
+
+    log('collect_data_async() started, concurrency = {}'.format(concurrency))
+
+    crawler = AsyncCrawler(con, concurrency)
+    asyncio.run(crawler.collect())
@@ -0,0 +1,439 @@
+import atexit
+import io
+import threading
+from time import monotonic
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from extensions.battle_dedup import get_battle_dedup
+from helpers import log, email_admin
+from transform import BATTLE_TABLES
+from card_stats import update_card_stats
+
+
+# flush once this many battles are buffered, or once the oldest buffered row is this old
+MAX_BATCH_BATTLES = 500
+MAX_BATCH_DELAY = 10  # seconds
+
+# rows per multi-row INSERT statement
+PAGE_SIZE = 1000
+
+# errors that are not caused by the rows (connection lost, server down, deadlock, ...): the batch
+# is kept and written again later, instead of being retried battle by battle and dropped
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def insert_rows(cur, table: str, rows: list, returning: str = None) -> list:
+    """
+    Insert many rows with multi-row VALUES statements; rows whose primary key already
+    exists are skipped (ON CONFLICT DO NOTHING) instead of aborting the transaction.
+    :param cur: A psycopg2 cursor;
+    :param table: Name of the table;
+    :param rows: A list of tuples (all columns, in table order);
+    :param returning: Optional column to return for the rows actually inserted;
+    :return: The values of that column of the inserted rows (empty without returning).
+    """
+    if len(rows) == 0:
+        return []
+    if returning is None:
+        execute_values(cur, 'INSERT INTO {} VALUES %s ON CONFLICT DO NOTHING;'.format(table),
+                       rows, page_size=PAGE_SIZE)
+        return []
+    inserted = execute_values(cur, 'INSERT INTO {} VALUES %s ON CONFLICT DO NOTHING RETURNING {};'.format(table, returning),
+                              rows, page_size=PAGE_SIZE, fetch=True)
+    return [row[0] for row in inserted]
+
+
+def _copy_value(value) -> str:
+    # a value in the text format of COPY
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        # arrays of numbers only
+        return '{' + ','.join('NULL' if v is None else str(v) for v in value) + '}'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cur, table: str, rows: list) -> None:
+    """
+    Load many rows with COPY, much faster than INSERT for large batches; unlike insert_rows(),
+    a duplicate key aborts the transaction, so copy into a staging table when rows may exist.
+    :param cur: A psycopg2 cursor;
+    :param table: Name of the table;
+    :param rows: A list of tuples (all columns, in table order).
+    """
+    if len(rows) == 0:
+        return
+    buffer = io.StringIO(''.join('\t'.join(_copy_value(value) for value in row) + '\n' for row in rows))
+    cur.copy_expert('COPY {} FROM STDIN;'.format(table), buffer)
+
+
+_columns = {}
+
+
+def table_columns(cur, table: str) -> list:
+    """
+    :param cur: A psycopg2 cursor;
+    :param table: Name of the table;
+    :return: Column names of the table in table order (lower case), cached after the first call.
+    """
+    if table not in _columns:
+        cur.execute('SELECT * FROM {} LIMIT 0;'.format(table))
+        _columns[table] = [desc[0] for desc in cur.description]
+    return _columns[table]
+
+
+def upsert_rows(cur, table: str, rows: list, primary_key: str, touch: str = None) -> int:
+    """
+    Insert many rows, updating the existing row on a primary key conflict
+    (INSERT ... ON CONFLICT DO UPDATE), in multi-row VALUES statements.
+    A row identical to the stored one is left alone, so it costs no write (no dead tuple).
+    :param cur: A psycopg2 cursor;
+    :param table: Name of the table;
+    :param rows: A list of tuples holding the first len(tuple) columns in table order;
+    rows with the same primary key are collapsed (last one wins);
+    :param primary_key: Name of the (single-column) primary key, which must be a column in rows;
+    :param touch: Optional timestamp column set to NOW() on insert or change;
+    :return: Number of rows inserted or changed (the rest were identical).
+    """
+    if len(rows) == 0:
+        return 0
+
+    cols = table_columns(cur, table)[:len(rows[0])]
+    key_idx = cols.index(primary_key.lower())
+    rows = {row[key_idx]: row for row in rows}
+    # sorted by key: concurrent writers lock rows in the same order (no deadlock)
+    rows = [rows[key] for key in sorted(rows)]
+
+    updated = [col for col in cols if col != primary_key.lower()]
+    set_clause = ', '.join('{0} = EXCLUDED.{0}'.format(col) for col in updated)
+    if touch is not None:
+        set_clause += ', {} = NOW()'.format(touch)
+
+    upsert_cmd = """
+        INSERT INTO {table} ({cols}) VALUES %s
+        ON CONFLICT ({key}) DO UPDATE SET {set_clause}
+        WHERE ({old}) IS DISTINCT FROM ({new})
+        RETURNING {key};
+    """.format(table=table, cols=', '.join(cols), key=primary_key, set_clause=set_clause,
+               old=', '.join('{}.{}'.format(table, col) for col in updated),
+               new=', '.join('EXCLUDED.{}'.format(col) for col in updated))
+
+    written = execute_values(cur, upsert_cmd, rows, page_size=PAGE_SIZE, fetch=True)
+    return len(written)
+
+
+def upsert_players(cur, rows: list) -> None:
+    """
+    Add players to table Player (the sampling table, see extensions/player_sampler.py).
+    New players get the next playerId; a known player's trophies are only rewritten when
+    they moved to another trophy range, so most battles cost no write here.
+    :param cur: A psycopg2 cursor;
+    :param rows: A list of (playerTag, trophies) tuples; the last known trophies per tag win.
+    """
+    if len(rows) == 0:
+        return
+
+    players = {}
+    for tag, trophies in rows:
+        if trophies is not None or tag not in players:
+            players[tag] = trophies
+    # sorted by key: concurrent writers lock rows in the same order (no deadlock)
+    rows = [(tag, players[tag]) for tag in sorted(players)]
+
+    # INSERT ... SELECT only draws a playerId for players not stored yet, which keeps the keys dense
+    execute_values(cur, """
+        INSERT INTO Player (playerTag, trophies)
+        SELECT v.playerTag, v.trophies FROM (VALUES %s) AS v (playerTag, trophies)
+        WHERE NOT EXISTS (SELECT 1 FROM Player p WHERE p.playerTag = v.playerTag)
+        ON CONFLICT (playerTag) DO NOTHING;
+    """, rows, template='(%s, %s::int4)', page_size=PAGE_SIZE)
+    execute_values(cur, """
+        UPDATE Player p SET trophies = v.trophies
+        FROM (VALUES %s) AS v (playerTag, trophies)
+        WHERE p.playerTag = v.playerTag AND v.trophies IS NOT NULL
+        AND p.trophies / 1000 IS DISTINCT FROM v.trophies / 1000;
+    """, rows, template='(%s, %s::int4)', page_size=PAGE_SIZE)
+
+
+# merges each placeholder card id (table card_replacement: oldId -> newId) into the API id of
+# its card: in the decks (kept sorted, levels in the same order) and in the card statistics
+# (as migrations/008_card_name_unique.sql)
+REPLACE_CARDS = """
+    UPDATE ParticipantDeck pd
+    SET cards = s.cards, cardLevels = CASE WHEN pd.cardLevels IS NULL THEN NULL ELSE s.cardLevels END
+    FROM (
+      SELECT d.battleId, d.playerTag, d.battleTime,
+             array_agg(COALESCE(r.newId, u.card) ORDER BY COALESCE(r.newId, u.card)) AS cards,
+             array_agg(u.level ORDER BY COALESCE(r.newId, u.card)) AS cardLevels
+      FROM ParticipantDeck d
+      CROSS JOIN unnest(d.cards, d.cardLevels) AS u (card, level)
+      LEFT JOIN card_replacement r ON r.oldId = u.card
+      WHERE d.cards && (SELECT array_agg(oldId) FROM card_replacement)
+      GROUP BY d.battleId, d.playerTag, d.battleTime
+    ) s
+    WHERE pd.battleId = s.battleId AND pd.playerTag = s.playerTag AND pd.battleTime = s.battleTime;
+
+    INSERT INTO CardStats (month, trophyBracket, cardId, decks, wins)
+    SELECT s.month, s.trophyBracket, r.newId, SUM(s.decks), SUM(s.wins)
+    FROM CardStats s
+    JOIN card_replacement r ON r.oldId = s.cardId
+    GROUP BY s.month, s.trophyBracket, r.newId
+    ON CONFLICT (month, trophyBracket, cardId) DO UPDATE
+    SET decks = CardStats.decks + EXCLUDED.decks, wins = CardStats.wins + EXCLUDED.wins;
+    DELETE FROM CardStats WHERE cardId IN (SELECT oldId FROM card_replacement);
+
+    INSERT INTO CardPairStats (month, trophyBracket, cardA, cardB, decks, wins)
+    SELECT month, trophyBracket, LEAST(a, b), GREATEST(a, b), SUM(decks), SUM(wins)
+    FROM (
+      SELECT s.month, s.trophyBracket, COALESCE(ra.newId, s.cardA) AS a, COALESCE(rb.newId, s.cardB) AS b, s.decks, s.wins
+      FROM CardPairStats s
+      LEFT JOIN card_replacement ra ON ra.oldId = s.cardA
+      LEFT JOIN card_replacement rb ON rb.oldId = s.cardB
+      WHERE ra.oldId IS NOT NULL OR rb.oldId IS NOT NULL
+    ) p
+    WHERE a <> b
+    GROUP BY month, trophyBracket, LEAST(a, b), GREATEST(a, b)
+    ON CONFLICT (month, trophyBracket, cardA, cardB) DO UPDATE
+    SET decks = CardPairStats.decks + EXCLUDED.decks, wins = CardPairStats.wins + EXCLUDED.wins;
+    DELETE FROM CardPairStats
+    WHERE cardA IN (SELECT oldId FROM card_replacement) OR cardB IN (SELECT oldId FROM card_replacement);
+
+    DELETE FROM Card WHERE cardId IN (SELECT oldId FROM card_replacement);
+"""
+
+
+def replace_cards(cur, replacements: list) -> None:
+    """
+    :param cur: A psycopg2 cursor;
+    :param replacements: A list of (placeholder card id, API card id) tuples.
+    """
+    cur.execute('DROP TABLE IF EXISTS card_replacement;')
+    cur.execute('CREATE TEMP TABLE card_replacement (oldId int4 NOT NULL, newId int4 NOT NULL) ON COMMIT DROP;')
+    execute_values(cur, 'INSERT INTO card_replacement VALUES %s;', replacements, page_size=PAGE_SIZE)
+    cur.execute(REPLACE_CARDS)
+
+
+def insert_cards(cur, rows: list, known: set) -> list:
+    """
+    Add the cards not stored yet to table Card (card id -> name, for the view BattleDeck). A card
+    stored under a placeholder id (negative: migrations/005_participant_deck.sql, migrate_clash.py)
+    is replaced by its API id, in Card and in the decks and card statistics.
+    :param cur: A psycopg2 cursor;
+    :param rows: A list of (cardId, name) tuples;
+    :param known: Card ids already stored (skipped without a query);
+    :return: The card ids that were not in known (add them to it once committed).
+    """
+    cards = {card_id: name for card_id, name in rows if card_id is not None and card_id not in known}
+    if len(cards) > 0:
+        replacements = execute_values(cur, """
+            SELECT c.cardId, v.cardId
+            FROM Card c JOIN (VALUES %s) AS v (cardId, name) ON v.name = c.name
+            WHERE c.cardId < 0 AND v.cardId >= 0;
+        """, sorted(cards.items()), page_size=PAGE_SIZE, fetch=True)
+        if len(replacements) > 0:
+            log('Replacing placeholder card ids: {}'.format(replacements))
+            replace_cards(cur, replacements)
+        execute_values(cur, 'INSERT INTO Card (cardId, name) VALUES %s ON CONFLICT DO NOTHING;',
+                       sorted(cards.items()), page_size=PAGE_SIZE)
+    return list(cards)
+
+
+class BatchWriter:
+    """
+    Buffers transformed rows of many battles (and PlayerInfo rows) and writes them in one
+    transaction per batch, table by table in foreign key order, instead of one autocommit
+    per table per battle. PlayerInfo rows are upserted (unchanged players are not rewritten),
+    participants are added to the sampling table Player, new cards to table Card, and the
+    decks of new battles are counted in the card statistics (card_stats.py).
+    Flushes when MAX_BATCH_BATTLES battles are buffered, when the oldest buffered row is
+    older than MAX_BATCH_DELAY, or when flush() is called.
+    Thread-safe, but the connection must not be used by another thread during a flush.
+    """
+
+    def __init__(self, con, max_battles: int = MAX_BATCH_BATTLES, max_delay: float = MAX_BATCH_DELAY):
+        """
+        :param con: A psycopg2 connection object;
+        :param max_battles: Flush threshold (number of battles);
+        :param max_delay: Flush threshold (seconds since the first buffered row).
+        """
+        self.con = con
+        self.max_battles = max_battles
+        self.max_delay = max_delay
+        self.lock = threading.RLock()
+        self.known_cards = set()  # card ids already in table Card
+        self.reset()
+
+        # counters for reporting
+        self.flushes = 0
+        self.battles_written = 0
+        self.players_written = 0
+        self.players_unchanged = 0
+        self.failed_flushes = 0
+
+    def reset(self) -> None:
+        self.battles = []  # list of {table: rows} from transform_battle()
+        self.player_infos = {}  # player tag -> PlayerInfo row (latest wins)
+        self.first_added = None
+
+    def pending(self) -> int:
+        """
+        :return: Number of buffered battles and players.
+        """
+        return len(self.battles) + len(self.player_infos)
+
+    def add_battle(self, rows: dict) -> None:
+        """
+        :param rows: Rows of one battle, as returned by transform_battle().
+        """
+        with self.lock:
+            self.battles.append(rows)
+            self._added()
+
+    def add_player_info(self, row: tuple) -> None:
+        """
+        :param row: A full PlayerInfo row (playerTag first).
+        """
+        with self.lock:
+            self.player_infos[row[0]] = row
+            self._added()
+
+    def _added(self) -> None:
+        if self.first_added is None:
+            self.first_added = monotonic()
+        if len(self.battles) >= self.max_battles or self.is_due():
+            self.flush()
+
+    def is_due(self) -> bool:
+        """
+        :return: True if buffered rows have waited longer than max_delay.
+        """
+        return self.first_added is not None and monotonic() - self.first_added >= self.max_delay
+
+    def flush(self) -> None:
+        """
+        Write all buffered rows in a single transaction. If the batch fails on its data, it is
+        retried one battle per transaction, so that a single bad battle does not lose the others
+        (the bad ones are reported and dropped). If it fails for any other reason (TRANSIENT_ERRORS,
+        e.g. the DB is down), the rows not written yet go back to the buffer and the error is raised.
+        """
+        with self.lock:
+            if self.pending() == 0:
+                return
+
+            battles = self.battles
+            player_infos = list(self.player_infos.values())
+            first_added = self.first_added
+            self.reset()
+
+            log('BatchWriter.flush(): {} battles, {} players'.format(len(battles), len(player_infos)))
+
+            try:
+                self._write(battles, player_infos)
+            except TRANSIENT_ERRORS:
+                self._restore(battles, player_infos, first_added)
+                raise
+            except psycopg2.Error as e:
+                log('BatchWriter.flush() failed, retrying battle by battle: {}'.format(str(e).strip()))
+                for i, rows in enumerate(battles):
+                    try:
+                        self._write([rows], [])
+                    except TRANSIENT_ERRORS:
+                        self._restore(battles[i:], player_infos, first_added)
+                        raise
+                    except psycopg2.Error as e:
+                        email_admin(400, 'ERROR: Insertion: {}.'.format(str(e) + '\n' + str(rows)).strip())
+                        get_battle_dedup(self.con).release(rows['BattleInfo'][0][0].hex())
+                try:
+                    self._write([], player_infos)
+                except TRANSIENT_ERRORS:
+                    self._restore([], player_infos, first_added)
+                    raise
+                except psycopg2.Error as e:
+                    email_admin(400, 'ERROR: PlayerInfo insertion: {}.'.format(str(e)).strip())
+
+            self.flushes += 1
+
+    def _restore(self, battles: list, player_infos: list, first_added: float) -> None:
+        # put rows that could not be written back in front of those buffered since
+        self.battles = battles + self.battles
+        for row in player_infos:
+            self.player_infos.setdefault(row[0], row)
+        self.first_added = first_added
+        self.failed_flushes += 1
+
+    def _write(self, battles: list, player_infos: list) -> None:
+        # one transaction for everything; tables in foreign key order
+        con = self.con
+        autocommit = con.autocommit
+        con.autocommit = False
+        try:
+            with con.cursor() as cur:
+                new_ids = {bytes(battle_id) for battle_id in insert_rows(
+                    cur, BATTLE_TABLES[0], [row for rows in battles for row in rows[BATTLE_TABLES[0]]], 'battleId')}
+                for table in BATTLE_TABLES[1:]:
+                    insert_rows(cur, table, [row for rows in battles for row in rows[table]])
+
+                # only the battles that were not stored yet are counted, and each one once: a battle
+                # is in the logs of all its players, so a batch can hold several copies of it
+                counted = []
+                for rows in battles:
+                    battle_id = rows['BattleInfo'][0][0]
+                    if battle_id in new_ids:
+                        new_ids.discard(battle_id)
+                        counted.append(rows)
+                update_card_stats(cur, counted)
+
+                # BattleData rows: (battleId, playerTag, clanTag, startingTrophies, ...)
+                upsert_players(cur, [(row[1], row[3]) for rows in battles for row in rows['BattleData']])
+                new_cards = insert_cards(cur, [row for rows in battles for row in rows['Card']], self.known_cards)
+
+                written = upsert_rows(cur, 'PlayerInfo', player_infos, 'playerTag', touch='lastRefreshed')
+            con.commit()
+            # only now are the battles known to be stored (see BattleDedup.hold())
+            dedup = get_battle_dedup(con)
+            for rows in battles:
+                battle_id, battle_time = rows['BattleInfo'][0][:2]
+                dedup.add(battle_id.hex(), battle_time)
+            self.known_cards.update(new_cards)
+            self.battles_written += len(battles)
+            self.players_written += written
+            self.players_unchanged += len(player_infos) - written
+        except psycopg2.Error:
+            con.rollback()
+            raise
+        finally:
+            con.autocommit = autocommit
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                'battles_written': self.battles_written,
+                'players_written': self.players_written,
+                'players_unchanged': self.players_unchanged,
+                'pending': self.pending(),
+            }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_batch_writer(con) -> BatchWriter:
+    """
+    :param con: A psycopg2 connection object, used by the writer created on first call;
+    :return: The process-wide BatchWriter (flushed at exit).
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BatchWriter(con)
+            atexit.register(_writer.flush)
+        return _writer
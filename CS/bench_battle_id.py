@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+import argparse
+import random
+from time import perf_counter
+
+from extensions.connect_db import DBConnection
+from batch_writer import insert_rows
+from transform import BATTLE_TABLES, make_battle_id, transform_battle
+from bench_transform import random_battle
+
+
+# the purpose of this script is to measure what storing battleId as a 32-byte bytea instead
+# of a 64-character char(64) saves (migrations/004_battle_id_bytea.sql): the same synthetic
+# battles are loaded into both layouts, in scratch schemas that are dropped afterwards
+
+N_BATTLES = 100000
+N_LOOKUPS = 10000
+
+TABLES_SQL = """
+CREATE TABLE BattleInfo (
+  battleId           {id_type} NOT NULL,
+  battleTime         timestamp,
+  type               varchar(30),
+  isLadderTournament boolean,
+  arenaId            int4,
+  arena              varchar(30),
+  gameModeId         int4,
+  gameMode           varchar(50),
+  deckSelection      varchar(30),
+  PRIMARY KEY (battleId));
+CREATE TABLE BattleParticipant (
+  battleId    {id_type} NOT NULL,
+  playerTag   varchar(20) NOT NULL,
+  team        boolean,
+  battleTime  timestamp,
+  PRIMARY KEY (battleId, playerTag),
+  FOREIGN KEY (battleId) REFERENCES BattleInfo (battleId));
+CREATE TABLE BattleData (
+  battleId                {id_type} NOT NULL,
+  playerTag               varchar(20) NOT NULL,
+  clanTag                 varchar(20),
+  startingTrophies        int4,
+  trophyChange            int4,
+  crowns                  int4,
+  princessTower1HitPoints int4,
+  princessTower2HitPoints int4,
+  kingTowerHitPoints      int4,
+  boatBattleSide          char(8),
+  boatBattleWon           boolean,
+  newBoatTowersDestroyed  int4,
+  prevBoatTowersDestroyed int4,
+  remainingBoatTowers     int4,
+  battleTime              timestamp,
+  PRIMARY KEY (battleId, playerTag),
+  FOREIGN KEY (battleId, playerTag) REFERENCES BattleParticipant (battleId, playerTag));
+CREATE TABLE ParticipantDeck (
+  battleId    {id_type} NOT NULL,
+  playerTag   varchar(20) NOT NULL,
+  cards       int4[] NOT NULL,
+  cardLevels  int2[],
+  battleTime  timestamp,
+  PRIMARY KEY (battleId, playerTag),
+  FOREIGN KEY (battleId, playerTag) REFERENCES BattleParticipant (battleId, playerTag));
+"""
+
+JOIN_QUERY = """
+SELECT COUNT(*)
+FROM BattleInfo
+JOIN BattleParticipant USING (battleId, battleTime)
+JOIN BattleData USING (battleId, playerTag, battleTime)
+JOIN ParticipantDeck USING (battleId, playerTag, battleTime);
+"""
+
+LOOKUP_QUERY = 'SELECT COUNT(*) FROM ParticipantDeck WHERE battleId = ANY(%s);'
+
+
+def load(cur, schema: str, id_type: str, battles: list) -> None:
+    cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0};'.format(schema))
+    cur.execute(TABLES_SQL.format(id_type=id_type))
+    for table in BATTLE_TABLES:
+        insert_rows(cur, table, [row for rows in battles for row in rows[table]])
+    cur.execute('VACUUM ANALYZE;' if cur.connection.autocommit else 'ANALYZE;')
+
+
+def sizes(cur, schema: str) -> dict:
+    """
+    :return: {table: (table bytes, index bytes)}.
+    """
+    result = {}
+    for table in BATTLE_TABLES:
+        cur.execute('SELECT pg_table_size(%s), pg_indexes_size(%s);', ('{}.{}'.format(schema, table),) * 2)
+        result[table] = cur.fetchone()
+    return result
+
+
+def best_time(cur, query: str, params=None, repeat: int = 5) -> float:
+    # best of several runs (warm cache)
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        cur.execute(query, params)
+        cur.fetchall()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def mb(n: int) -> str:
+    return '{:8.1f} MB'.format(n / 2 ** 20)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare battleId as char(64) and as bytea.')
+    parser.add_argument('--battles', type=int, default=N_BATTLES, help='number of synthetic battles')
+    args = parser.parse_args()
+
+    random.seed(0)
+    ids = []
+    battles = {'char(64)': [], 'bytea': []}
+    for _ in range(args.battles):
+        battle = random_battle()
+        battle_id = make_battle_id(battle)
+        ids.append(battle_id)
+        rows = transform_battle(battle, battle_id)
+        battles['bytea'].append(rows)
+        # same rows with the hex id
+        battles['char(64)'].append({table: [(battle_id,) + row[1:] for row in table_rows]
+                                    for table, table_rows in rows.items() if table in BATTLE_TABLES})
+
+    lookup_ids = random.sample(ids, min(N_LOOKUPS, len(ids)))
+    lookup_params = {'char(64)': (lookup_ids,), 'bytea': ([bytes.fromhex(i) for i in lookup_ids],)}
+
+    con = DBConnection().get_con()
+    results = {}
+    with con.cursor() as cur:
+        for id_type, schema in (('char(64)', 'bench_battle_id_hex'), ('bytea', 'bench_battle_id_bytea')):
+            load(cur, schema, id_type, battles[id_type])
+            results[id_type] = {
+                'sizes': sizes(cur, schema),
+                'join': best_time(cur, JOIN_QUERY),
+                'lookup': best_time(cur, LOOKUP_QUERY, lookup_params[id_type]),
+            }
+            cur.execute('RESET search_path; DROP SCHEMA {} CASCADE;'.format(schema))
+
+    print('{} battles'.format(args.battles))
+    print('{:26} {:>22} {:>22}'.format('', 'char(64)', 'bytea'))
+    total = {id_type: [0, 0] for id_type in results}
+    for table in BATTLE_TABLES:
+        for kind, i in (('table', 0), ('indexes', 1)):
+            values = [results[id_type]['sizes'][table][i] for id_type in ('char(64)', 'bytea')]
+            print('{:26} {:>22} {:>22}'.format('{} {}'.format(table, kind), mb(values[0]), mb(values[1])))
+            for id_type, value in zip(('char(64)', 'bytea'), values):
+                total[id_type][i] += value
+    for kind, i in (('total tables', 0), ('total indexes', 1)):
+        print('{:26} {:>22} {:>22}'.format(kind, mb(total['char(64)'][i]), mb(total['bytea'][i])))
+    print('{:26} {:>19.1f} ms {:>19.1f} ms'.format('4-table join', 1e3 * results['char(64)']['join'],
+                                                   1e3 * results['bytea']['join']))
+    print('{:26} {:>19.1f} ms {:>19.1f} ms'.format('{} lookups'.format(len(lookup_ids)),
+                                                   1e3 * results['char(64)']['lookup'],
+                                                   1e3 * results['bytea']['lookup']))
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+import random
+from timeit import timeit
+
+import pandas as pd
+from numpy import nan
+
+from transform import make_battle_id, transform_battle
+
+
+# the purpose of this script is to benchmark transform_battle() against the pandas
+# transformation insert_battle() used to do, and to check that both produce the same rows
+
+N_BATTLES = 2000
+
+CARDS = ['Knight', 'Archers', 'Goblins', 'Giant', 'P.E.K.K.A', 'Minions', 'Balloon', 'Witch',
+         'Barbarians', 'Golem', 'Skeletons', 'Valkyrie', 'Skeleton Army', 'Bomber', 'Musketeer']
+TAG_CHARS = '0289PYLQGRJCUV'
+
+
+def pandas_transform(data: dict, battleId: bytes) -> dict:
+    """
+    The former pandas-based transformation of insert_battle(), kept as a reference.
+    """
+    team = data.get('team') or []
+    opponent = data.get('opponent') or []
+    participants = team + opponent
+
+    try:
+        arena = data.get('arena')
+        arena_id = arena.get('id')
+        arena_name = arena.get('name')
+    except AttributeError:
+        arena_id = None
+        arena_name = None
+    try:
+        gameMode = data.get('gameMode')
+        game_mode_id = gameMode.get('id')
+        game_mode_name = gameMode.get('name')
+    except AttributeError:
+        game_mode_id = None
+        game_mode_name = None
+
+    rows = {'BattleInfo': [(battleId, data.get('battleTime'), data.get('type'), data.get('isLadderTournament'),
+                            arena_id, arena_name, game_mode_id, game_mode_name, data.get('deckSelection'))]}
+
+    df = pd.DataFrame(participants)
+    df = df.drop('name', axis=1)
+
+    team_tags = [player.get('tag') for player in team]
+    df['team'] = df['tag'].apply(
+        lambda tag: True if tag in team_tags else False)
+    df['battleId'] = battleId
+    rows['BattleParticipant'] = df[['battleId', 'tag', 'team']].to_records(index=False).tolist()
+
+    curr_cols = df.columns
+    all_cols = pd.Series(['clan', 'startingTrophies', 'trophyChange', 'crowns',
+                          'princessTowersHitPoints', 'kingTowerHitPoints',
+                          'boatBattleSide', 'boatBattleWon',
+                          'newTowersDestroyed', 'prevTowersDestroyed', 'remainingTowers'])
+
+    def f(col):
+        if col not in curr_cols:
+            df[col] = None
+    all_cols.apply(f)
+
+    df = df.replace({nan: None})
+
+    df['clan'] = df['clan'].apply(lambda entry: entry.get(
+        'tag') if entry is not None else None)
+
+    df_princess = []
+
+    def f(col):
+        values = [None, None]
+        if col is not None:
+            if len(col) == 2:
+                values = col
+            elif len(col) == 1:
+                values = col + [None]
+        df_princess.append(values)
+
+    df['princessTowersHitPoints'].apply(f)
+
+    df_princess = pd.DataFrame(df_princess, columns=[
+                               'princessTower1HitPoints', 'princessTower2HitPoints'])
+    df_princess = df_princess.replace({nan: None})
+
+    df = pd.concat([df, df_princess], axis=1)
+
+    if data.get('type') == 'boatBattle':
+        df.loc[df['team'], 'boatBattleSide'] = data.get('boatBattleSide')
+        df.loc[~(df['team']), 'boatBattleSide'] = 'attacker' if data.get(
+            'boatBattleSide') != 'attacker' else 'defender'
+
+        df.loc[df['team'], 'boatBattleWon'] = data.get('boatBattleWon')
+        df.loc[~(df['team']), 'boatBattleWon'] = not data.get('boatBattleWon')
+
+        df['newTowersDestroyed'] = data.get('newTowersDestroyed')
+        df['prevTowersDestroyed'] = data.get('prevTowersDestroyed')
+        df['remainingTowers'] = data.get('remainingTowers')
+
+    rows['BattleData'] = df[['battleId', 'tag', 'clan',
+                             'startingTrophies', 'trophyChange', 'crowns',
+                             'princessTower1HitPoints', 'princessTower2HitPoints', 'kingTowerHitPoints',
+                             'boatBattleSide', 'boatBattleWon',
+                             'newTowersDestroyed', 'prevTowersDestroyed', 'remainingTowers']].to_records(index=False).tolist()
+
+    df = df.explode('cards')
+    df = pd.concat([df.drop(['cards'], axis=1),
+                   df['cards'].apply(pd.Series)], axis=1)
+    rows['BattleDeck'] = df[['battleId', 'tag', 'name', 'level']].to_records(index=False).tolist()
+
+    return rows
+
+
+def random_player(boat: bool) -> dict:
+    player = {
+        'tag': '#' + ''.join(random.choice(TAG_CHARS) for _ in range(9)),
+        'name': 'player',
+        'crowns': random.randint(0, 3),
+        'kingTowerHitPoints': random.randint(0, 6000),
+        'cards': [{'name': name, 'id': 26000000 + CARDS.index(name), 'level': random.randint(1, 14), 'maxLevel': 14,
+                   'iconUrls': {'medium': 'https://api-assets.clashroyale.com/cards/300/x.png'}}
+                  for name in random.sample(CARDS, 8)],
+    }
+    if not boat:
+        player['startingTrophies'] = random.randint(0, 7000)
+        player['trophyChange'] = random.randint(-30, 30)
+    if random.random() < 0.7:
+        player['clan'] = {'tag': '#' + ''.join(random.choice(TAG_CHARS) for _ in range(8)), 'name': 'clan', 'badgeId': 1}
+    princess = random.choice([None, [], [1000], [1000, 2000]])
+    if princess is not None:
+        player['princessTowersHitPoints'] = princess
+    return player
+
+
+def random_battle() -> dict:
+    battle_type = random.choice(['PvP', 'PvP', 'PvP', 'boatBattle', '2v2'])
+    battle = {
+        'type': battle_type,
+        'battleTime': '202111{:02d}T{:02d}{:02d}{:02d}.000Z'.format(
+            random.randint(1, 30), random.randint(0, 23), random.randint(0, 59), random.randint(0, 59)),
+        'isLadderTournament': False,
+        'arena': {'id': 54000012, 'name': 'Legendary Arena'},
+        'gameMode': {'id': 72000006, 'name': 'Ladder'},
+        'deckSelection': 'collection',
+    }
+    n = 2 if battle_type == '2v2' else 1
+    boat = battle_type == 'boatBattle'
+    battle['team'] = [random_player(boat) for _ in range(n)]
+    battle['opponent'] = [random_player(boat) for _ in range(n)]
+    if boat:
+        battle.update(boatBattleSide=random.choice(['attacker', 'defender']), boatBattleWon=random.random() < 0.5,
+                      newTowersDestroyed=1, prevTowersDestroyed=0, remainingTowers=2)
+    return battle
+
+
+def deck_rows(rows: list) -> list:
+    # BattleDeck rows (one per card) as ParticipantDeck rows (one per player, cards sorted by id)
+    decks = {}
+    for battleId, tag, name, level in rows:
+        decks.setdefault((battleId, tag), []).append((26000000 + CARDS.index(name), level))
+    return [(battleId, tag, [card for card, level in sorted(deck)], [level for card, level in sorted(deck)])
+            for (battleId, tag), deck in decks.items()]
+
+
+def normalize(value):
+    # pandas turns int columns with missing values into floats; the DB stores both the same way
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    # pandas sometimes leaves NaN for a missing value (e.g., no clan), which then got stored
+    # as the string 'NaN'; transform_battle() gives None (NULL) as intended
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    battles = [random_battle() for _ in range(N_BATTLES)]
+    ids = [make_battle_id(battle) for battle in battles]
+
+    # same rows for every battle and table
+    for battle, battle_id in zip(battles, ids):
+        expected = pandas_transform(battle, bytes.fromhex(battle_id))
+        expected['ParticipantDeck'] = deck_rows(expected.pop('BattleDeck'))
+        # battleTime (the partition key) was added to the tables after BattleInfo
+        for table in ('BattleParticipant', 'BattleData', 'ParticipantDeck'):
+            expected[table] = [row + (battle.get('battleTime'),) for row in expected[table]]
+        actual = transform_battle(battle, battle_id)
+        for table, rows in expected.items():
+            rows = [tuple(normalize(v) for v in row) for row in rows]
+            assert rows == actual[table], (table, battle, rows, actual[table])
+    print('Outputs match for {} battles'.format(N_BATTLES))
+
+    t_pandas = timeit(lambda: [pandas_transform(b, i) for b, i in zip(battles, ids)], number=1)
+    t_plain = timeit(lambda: [transform_battle(b, i) for b, i in zip(battles, ids)], number=5) / 5
+
+    print('pandas:           {:8.1f} us/battle'.format(1e6 * t_pandas / N_BATTLES))
+    print('transform_battle: {:8.1f} us/battle'.format(1e6 * t_plain / N_BATTLES))
+    print('speedup:          {:8.1f}x'.format(t_pandas / t_plain))
@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+import argparse
+from collections import defaultdict
+from datetime import date, datetime
+from itertools import combinations
+
+from psycopg2.extras import execute_values
+
+from extensions.connect_db import DBConnection
+from extensions.partitions import add_months, list_partitions
+from helpers import log
+
+
+# the purpose of this script is to query the card statistics (migrations/007_card_stats.sql):
+# usage and win rates of cards and pairs of cards over any range of months and trophy brackets,
+# from counters the crawler updates as it writes battles (update_card_stats(), called by
+# batch_writer.py), and to rebuild those counters from the battle tables
+# (e.g., after migrate_clash.py, which does not update them)
+
+# counters per month of battleTime and per trophy bracket (startingTrophies / 1000)
+UNKNOWN_BRACKET = -1
+
+# rows per multi-row INSERT statement
+PAGE_SIZE = 1000
+
+# number of rows printed
+TOP = 30
+
+
+def battle_month(battle_time) -> date:
+    """
+    :param battle_time: A battleTime, as in the API ('20211116T010203.000Z') or a datetime;
+    :return: The first day of its month.
+    """
+    if isinstance(battle_time, str):
+        return date(int(battle_time[:4]), int(battle_time[4:6]), 1)
+    return date(battle_time.year, battle_time.month, 1)
+
+
+def trophy_bracket(trophies) -> int:
+    return UNKNOWN_BRACKET if trophies is None else trophies // 1000
+
+
+def deck_outcomes(rows: dict) -> list:
+    """
+    A player wins when they took more crowns than every player of the other side. The side of
+    a player is their team; battles without teams (migrated from Clash: 1v1 only) are split
+    into the player whose tag comes first and the other one (the same rule as rebuild()).
+    :param rows: Rows of one battle, as returned by transform_battle();
+    :return: A list of (month, trophy bracket, card ids, win) of each deck of the battle.
+    """
+    sides = {row[1]: row[2] for row in rows['BattleParticipant']}
+    if len(sides) == 0:
+        return []
+    first = min(sides)
+    sides = {tag: team if team is not None else tag == first for tag, team in sides.items()}
+
+    # BattleData rows: (battleId, playerTag, clanTag, startingTrophies, trophyChange, crowns, ...)
+    players = {row[1]: (row[3], row[5]) for row in rows['BattleData']}
+    best = {}  # side -> most crowns taken by a player of that side
+    for tag, (trophies, crowns) in players.items():
+        if crowns is not None:
+            best[sides[tag]] = max(best.get(sides[tag], crowns), crowns)
+
+    outcomes = []
+    for battle_id, tag, cards, levels, battle_time in rows['ParticipantDeck']:
+        trophies, crowns = players.get(tag, (None, None))
+        opponent_crowns = best.get(not sides[tag])
+        win = crowns is not None and opponent_crowns is not None and crowns > opponent_crowns
+        outcomes.append((battle_month(battle_time), trophy_bracket(trophies), cards, win))
+    return outcomes
+
+
+def count_decks(battles: list) -> tuple:
+    """
+    :param battles: A list of {table: rows} from transform_battle();
+    :return: Counters ({key: [decks, wins]}) of DeckStats, CardStats and CardPairStats.
+    """
+    decks = defaultdict(lambda: [0, 0])
+    cards = defaultdict(lambda: [0, 0])
+    pairs = defaultdict(lambda: [0, 0])
+    for rows in battles:
+        for month, bracket, deck, win in deck_outcomes(rows):
+            deck = sorted(set(deck))
+            for counter, keys in ((decks, [(month, bracket)]),
+                                  (cards, [(month, bracket, card) for card in deck]),
+                                  (pairs, [(month, bracket, a, b) for a, b in combinations(deck, 2)])):
+                for key in keys:
+                    counter[key][0] += 1
+                    counter[key][1] += win
+    return decks, cards, pairs
+
+
+def _add_counts(cur, table: str, key_cols: str, counts: dict) -> None:
+    if len(counts) == 0:
+        return
+    # sorted by key: concurrent writers lock the counters in the same order (no deadlock)
+    rows = [key + tuple(counts[key]) for key in sorted(counts)]
+    execute_values(cur, """
+        INSERT INTO {0} ({1}, decks, wins) VALUES %s
+        ON CONFLICT ({1}) DO UPDATE SET decks = {0}.decks + EXCLUDED.decks, wins = {0}.wins + EXCLUDED.wins;
+    """.format(table, key_cols), rows, page_size=PAGE_SIZE)
+
+
+def update_card_stats(cur, battles: list) -> None:
+    """
+    Add the decks of battles to the card statistics, in the caller's transaction (so that the
+    counters match the battles stored). Count each battle once: only battles just inserted.
+    :param cur: A psycopg2 cursor;
+    :param battles: A list of {table: rows} from transform_battle().
+    """
+    decks, cards, pairs = count_decks(battles)
+    _add_counts(cur, 'DeckStats', 'month, trophyBracket', decks)
+    _add_counts(cur, 'CardStats', 'month, trophyBracket, cardId', cards)
+    _add_counts(cur, 'CardPairStats', 'month, trophyBracket, cardA, cardB', pairs)
+
+
+REBUILD_DECKS = """
+CREATE TEMP TABLE rebuild_deck ON COMMIT DROP AS
+WITH participant AS (
+  SELECT p.battleId, p.battleTime, p.playerTag, d.startingTrophies, d.crowns,
+         COALESCE(p.team, p.playerTag = MIN(p.playerTag) OVER w) AS side
+  FROM BattleParticipant p
+  LEFT JOIN BattleData d USING (battleId, playerTag, battleTime)
+  WHERE p.battleTime >= %(start)s AND p.battleTime < %(end)s
+  WINDOW w AS (PARTITION BY p.battleId, p.battleTime)
+),
+outcome AS (
+  SELECT battleId, battleTime, playerTag,
+         COALESCE(startingTrophies / 1000, %(unknown)s)::int2 AS trophyBracket,
+         COALESCE(crowns > CASE WHEN side THEN MAX(crowns) FILTER (WHERE NOT side) OVER w
+                                ELSE MAX(crowns) FILTER (WHERE side) OVER w END, FALSE) AS win
+  FROM participant
+  WINDOW w AS (PARTITION BY battleId, battleTime)
+)
+SELECT o.trophyBracket, o.win, d.cards
+FROM outcome o
+JOIN ParticipantDeck d USING (battleId, playerTag, battleTime)
+WHERE d.battleTime >= %(start)s AND d.battleTime < %(end)s;
+"""
+
+
+def rebuild(con, month: date) -> None:
+    """
+    Recompute the counters of a month from the battle tables, in one transaction. Battles
+    written meanwhile would be counted twice or not at all: stop the crawler first (or only
+    rebuild months it no longer writes to).
+    :param con: A psycopg2 connection object (autocommit);
+    :param month: First day of the month.
+    """
+    end = add_months(month, 1)
+    con.autocommit = False
+    try:
+        with con.cursor() as cur:
+            for table in ('DeckStats', 'CardStats', 'CardPairStats'):
+                cur.execute('DELETE FROM {} WHERE month = %s;'.format(table), (month,))
+            cur.execute(REBUILD_DECKS, {'start': month, 'end': end, 'unknown': UNKNOWN_BRACKET})
+            cur.execute("""
+                INSERT INTO DeckStats
+                SELECT %(month)s, trophyBracket, COUNT(*), COUNT(*) FILTER (WHERE win)
+                FROM rebuild_deck GROUP BY trophyBracket;
+            """, {'month': month})
+            cur.execute("""
+                INSERT INTO CardStats
+                SELECT %(month)s, trophyBracket, card, COUNT(*), COUNT(*) FILTER (WHERE win)
+                FROM rebuild_deck, unnest(cards) AS card GROUP BY trophyBracket, card;
+            """, {'month': month})
+            cur.execute("""
+                INSERT INTO CardPairStats
+                SELECT %(month)s, trophyBracket, a, b, COUNT(*), COUNT(*) FILTER (WHERE win)
+                FROM rebuild_deck, unnest(cards) AS a, unnest(cards) AS b
+                WHERE a < b GROUP BY trophyBracket, a, b;
+            """, {'month': month})
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    finally:
+        con.autocommit = True
+
+
+def _filters(since: date = None, until: date = None, min_bracket: int = None, max_bracket: int = None,
+             alias: str = '') -> tuple:
+    # WHERE clause (and parameters) on the month and trophy bracket of a statistics table
+    conditions = ['TRUE']
+    params = {}
+    for name, value, condition in (('since', since, 'month >='), ('until', until, 'month <='),
+                                   ('min_bracket', min_bracket, 'trophyBracket >='),
+                                   ('max_bracket', max_bracket, 'trophyBracket <=')):
+        if value is not None:
+            conditions.append('{}{} %({})s'.format(alias, condition, name))
+            params[name] = value
+    return ' AND '.join(conditions), params
+
+
+def total_decks(con, **filters) -> int:
+    where, params = _filters(**filters)
+    with con.cursor() as cur:
+        cur.execute('SELECT COALESCE(SUM(decks), 0)::int8 FROM DeckStats WHERE {};'.format(where), params)
+        return cur.fetchone()[0]
+
+
+def card_stats(con, **filters) -> list:
+    """
+    :param con: A psycopg2 connection object;
+    :param filters: since, until (first days of months, inclusive), min_bracket, max_bracket;
+    :return: A list of (cardId, name, decks, usage rate, win rate), most used first.
+    """
+    total = total_decks(con, **filters)
+    where, params = _filters(alias='s.', **filters)
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT s.cardId, COALESCE(c.name, s.cardId::text), SUM(s.decks)::int8, SUM(s.wins)::int8
+            FROM CardStats s LEFT JOIN Card c USING (cardId)
+            WHERE {}
+            GROUP BY s.cardId, c.name
+            ORDER BY 3 DESC;
+        """.format(where), params)
+        return [(card_id, name, decks, decks / total, wins / decks) for card_id, name, decks, wins in cur.fetchall()]
+
+
+def pair_stats(con, card: int = None, **filters) -> list:
+    """
+    :param con: A psycopg2 connection object;
+    :param card: Optional card id: only the pairs with this card;
+    :param filters: since, until (first days of months, inclusive), min_bracket, max_bracket;
+    :return: A list of (name A, name B, decks, usage rate, win rate), most used first.
+    """
+    total = total_decks(con, **filters)
+    where, params = _filters(alias='s.', **filters)
+    if card is not None:
+        where += ' AND %(card)s IN (s.cardA, s.cardB)'
+        params['card'] = card
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT COALESCE(a.name, s.cardA::text), COALESCE(b.name, s.cardB::text),
+                   SUM(s.decks)::int8, SUM(s.wins)::int8
+            FROM CardPairStats s
+            LEFT JOIN Card a ON a.cardId = s.cardA
+            LEFT JOIN Card b ON b.cardId = s.cardB
+            WHERE {}
+            GROUP BY s.cardA, s.cardB, a.name, b.name
+            ORDER BY 3 DESC;
+        """.format(where), params)
+        return [(name_a, name_b, decks, decks / total, wins / decks) for name_a, name_b, decks, wins in cur.fetchall()]
+
+
+def parse_month(s: str) -> date:
+    return datetime.strptime(s, '%Y-%m').date()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query (or rebuild) the card statistics.')
+    parser.add_argument('--pairs', action='store_true', help='pairs of cards instead of cards')
+    parser.add_argument('--card', help='with --pairs: only the pairs with this card (name)')
+    parser.add_argument('--since', type=parse_month, help='first month, YYYY-MM')
+    parser.add_argument('--until', type=parse_month, help='last month, YYYY-MM')
+    parser.add_argument('--min-bracket', type=int,
+                        help='lowest trophy bracket (thousands of starting trophies; {} = unknown)'.format(UNKNOWN_BRACKET))
+    parser.add_argument('--max-bracket', type=int, help='highest trophy bracket')
+    parser.add_argument('--top', type=int, default=TOP, help='rows printed (default: {})'.format(TOP))
+    parser.add_argument('--rebuild', action='store_true',
+                        help='recompute the counters from the battle tables (all months, or --since to --until); '
+                             'stop the crawler first')
+    args = parser.parse_args()
+
+    con = DBConnection().get_con()
+    filters = {'since': args.since, 'until': args.until, 'min_bracket': args.min_bracket, 'max_bracket': args.max_bracket}
+
+    if args.rebuild:
+        for month, name in list_partitions(con, 'BattleInfo'):
+            if (args.since is None or month >= args.since) and (args.until is None or month <= args.until):
+                rebuild(con, month)
+                log('Rebuilt the card statistics of {:%Y-%m}'.format(month))
+        exit(0)
+
+    if total_decks(con, **filters) == 0:
+        print('No decks counted')
+        exit(0)
+
+    if args.pairs:
+        card = None
+        if args.card is not None:
+            with con.cursor() as cur:
+                cur.execute('SELECT cardId FROM Card WHERE lower(name) = lower(%s);', (args.card,))
+                row = cur.fetchone()
+            if row is None:
+                print('Unknown card: {}'.format(args.card))
+                exit(1)
+            card = row[0]
+        print('{:25} {:25} {:>12} {:>8} {:>8}'.format('card A', 'card B', 'decks', 'usage', 'win'))
+        for name_a, name_b, decks, usage, win_rate in pair_stats(con, card, **filters)[:args.top]:
+            print('{:25} {:25} {:>12} {:>7.2%} {:>7.2%}'.format(name_a, name_b, decks, usage, win_rate))
+    else:
+        print('{:25} {:>12} {:>8} {:>8}'.format('card', 'decks', 'usage', 'win'))
+        for card_id, name, decks, usage, win_rate in card_stats(con, **filters)[:args.top]:
+            print('{:25} {:>12} {:>7.2%} {:>7.2%}'.format(name, decks, usage, win_rate))
@@ -1,7 +1,11 @@
+-- the four battle tables are partitioned by month of battleTime (partitions <table>_<YYYY>_<MM>,
+-- created ahead of time by the crawler and manage_partitions.py, which also archives old ones);
+-- battleTime is part of every key so that foreign keys and lookups stay within one partition
+
 DROP TABLE IF EXISTS BattleInfo CASCADE;
 CREATE TABLE BattleInfo (
-  battleId           char(64) NOT NULL,  -- made via sha256()
-  battleTime         timestamp, 
+  battleId           bytea NOT NULL,  -- sha256() digest, 32 bytes (hex in Python: see make_battle_id())
+  battleTime         timestamp NOT NULL, 
   type               varchar(30), 
   isLadderTournament boolean, 
   arenaId            int4, 
@@ -9,31 +13,57 @@ CREATE TABLE BattleInfo (
   gameModeId         int4, 
   gameMode           varchar(50), 
   deckSelection      varchar(30), 
-  PRIMARY KEY (battleId));
+  PRIMARY KEY (battleId, battleTime))
+PARTITION BY RANGE (battleTime);
+CREATE INDEX BattleInfo_battleTime ON BattleInfo (battleTime);
 
 
 DROP TABLE IF EXISTS BattleParticipant CASCADE;
 CREATE TABLE BattleParticipant (
-  battleId    char(64) NOT NULL, 
+  battleId    bytea NOT NULL, 
   playerTag   varchar(20) NOT NULL, 
   team        boolean, 
-  PRIMARY KEY (battleId, playerTag),
-  FOREIGN KEY (battleId) REFERENCES BattleInfo (battleId));
+  battleTime  timestamp NOT NULL,  -- of the battle (partition key)
+  PRIMARY KEY (battleId, playerTag, battleTime),
+  FOREIGN KEY (battleId, battleTime) REFERENCES BattleInfo (battleId, battleTime))
+PARTITION BY RANGE (battleTime);
+CREATE INDEX BattleParticipant_playerTag ON BattleParticipant (playerTag);
 
 
-DROP TABLE IF EXISTS BattleDeck;
-CREATE TABLE BattleDeck (
-  battleId    char(64) NOT NULL, 
+DROP TABLE IF EXISTS ParticipantDeck CASCADE;  -- and view BattleDeck
+DROP TABLE IF EXISTS BattleDeck;  -- a table before migration 005
+CREATE TABLE ParticipantDeck (
+  battleId    bytea NOT NULL, 
   playerTag   varchar(20) NOT NULL, 
-  card        varchar(30) NOT NULL, 
-  cardLevel   int4, 
-  PRIMARY KEY (battleId, playerTag, card),
-  FOREIGN KEY (battleId, playerTag) REFERENCES BattleParticipant (battleId, playerTag));
+  cards       int4[] NOT NULL,  -- card ids (see table Card), sorted
+  cardLevels  int2[],  -- level of each card, in the order of cards
+  battleTime  timestamp NOT NULL, 
+  PRIMARY KEY (battleId, playerTag, battleTime),
+  FOREIGN KEY (battleId, playerTag, battleTime) REFERENCES BattleParticipant (battleId, playerTag, battleTime))
+PARTITION BY RANGE (battleTime);
+-- decks containing given cards: WHERE cards @> ARRAY[id1, id2]
+CREATE INDEX ParticipantDeck_cards ON ParticipantDeck USING GIN (cards);
+
+
+DROP TABLE IF EXISTS Card CASCADE;
+CREATE TABLE Card (
+  cardId   int4 NOT NULL,  -- id of the API (see Stat/cards.json); added by batch_writer.py as cards are seen
+  name     varchar(30) NOT NULL,  -- one id per name: a placeholder (negative) id is replaced by the API one
+  PRIMARY KEY (cardId),
+  UNIQUE (name));
+
+
+-- former layout of the decks (one row per card), for existing queries
+CREATE VIEW BattleDeck AS
+SELECT d.battleId, d.playerTag, c.name AS card, u.cardLevel::int4 AS cardLevel, d.battleTime
+FROM ParticipantDeck d
+CROSS JOIN LATERAL unnest(d.cards, d.cardLevels) AS u (cardId, cardLevel)
+JOIN Card c ON c.cardId = u.cardId;
 
 
 DROP TABLE IF EXISTS BattleData;
 CREATE TABLE BattleData (
-  battleId                char(64) NOT NULL, 
+  battleId                bytea NOT NULL, 
   playerTag               varchar(20) NOT NULL, 
   clanTag                 varchar(20), 
   startingTrophies        int4, 
@@ -47,8 +77,10 @@ CREATE TABLE BattleData (
   newBoatTowersDestroyed  int4, 
   prevBoatTowersDestroyed int4, 
   remainingBoatTowers     int4, 
-  PRIMARY KEY (battleId, playerTag), 
-  FOREIGN KEY (battleId, playerTag) REFERENCES BattleParticipant (battleId, playerTag));
+  battleTime              timestamp NOT NULL, 
+  PRIMARY KEY (battleId, playerTag, battleTime), 
+  FOREIGN KEY (battleId, playerTag, battleTime) REFERENCES BattleParticipant (battleId, playerTag, battleTime))
+PARTITION BY RANGE (battleTime);
 
 
 DROP TABLE IF EXISTS PlayerInfo;
@@ -90,4 +122,68 @@ CREATE TABLE PlayerInfo (
   warDayWins                 int4,
   clanCardsCollected         int4,
   starPoints                 int4,
+  lastRefreshed              timestamp DEFAULT NOW(),  -- when this row last changed (unchanged refreshes are not written: see extensions/player_cache.py)
   PRIMARY KEY (playerTag));
+
+
+DROP TABLE IF EXISTS Player;
+CREATE TABLE Player (
+  playerId    serial NOT NULL,  -- dense key for constant-cost random sampling (see extensions/player_sampler.py)
+  playerTag   varchar(20) NOT NULL,
+  trophies    int4,  -- startingTrophies of a recent battle (updated when the trophy range changes)
+  PRIMARY KEY (playerId),
+  UNIQUE (playerTag));
+CREATE INDEX Player_trophyRange ON Player ((trophies / 1000), playerId);
+
+
+-- card statistics, updated by the crawler as battles are written (see card_stats.py): decks,
+-- wins, and decks containing each card and each pair of cards, per month of battleTime and
+-- trophy bracket (startingTrophies / 1000, -1 when unknown); fillfactor leaves room for HOT updates
+DROP TABLE IF EXISTS DeckStats;
+CREATE TABLE DeckStats (
+  month          date NOT NULL,
+  trophyBracket  int2 NOT NULL,
+  decks          int8 NOT NULL,
+  wins           int8 NOT NULL,
+  PRIMARY KEY (month, trophyBracket))
+WITH (fillfactor = 70);
+
+DROP TABLE IF EXISTS CardStats;
+CREATE TABLE CardStats (
+  month          date NOT NULL,
+  trophyBracket  int2 NOT NULL,
+  cardId         int4 NOT NULL,
+  decks          int8 NOT NULL,
+  wins           int8 NOT NULL,
+  PRIMARY KEY (month, trophyBracket, cardId))
+WITH (fillfactor = 70);
+
+DROP TABLE IF EXISTS CardPairStats;
+CREATE TABLE CardPairStats (
+  month          date NOT NULL,
+  trophyBracket  int2 NOT NULL,
+  cardA          int4 NOT NULL,
+  cardB          int4 NOT NULL,  -- cardA < cardB
+  decks          int8 NOT NULL,
+  wins           int8 NOT NULL,
+  PRIMARY KEY (month, trophyBracket, cardA, cardB))
+WITH (fillfactor = 70);
+
+
+-- schema version: a DB created by this file already has every change in migrations/
+-- (see migrate.py); add the version of each new migration here
+DROP TABLE IF EXISTS SchemaMigrations;
+CREATE TABLE SchemaMigrations (
+  version    int4 NOT NULL,
+  name       varchar(100),
+  appliedAt  timestamp DEFAULT NOW(),
+  PRIMARY KEY (version));
+INSERT INTO SchemaMigrations (version, name) VALUES
+  (1, '001_player_info_last_refreshed.sql'),
+  (2, '002_player_table.sql'),
+  (3, '003_hot_query_indexes.sql'),
+  (4, '004_battle_id_bytea.sql'),
+  (5, '005_participant_deck.sql'),
+  (6, '006_partition_battle_tables.sql'),
+  (7, '007_card_stats.sql'),
+  (8, '008_card_name_unique.sql');
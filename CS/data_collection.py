@@ -1,71 +1,25 @@
 import psycopg2
-import hashlib
-import pandas as pd
-from numpy import nan
 from time import sleep
 from random import randrange
 from random import choice
-from collections import deque
 
 import extensions.load_api_key
 from extensions.connect_db import DBConnection
+from extensions.http_session import stats as http_stats
+from extensions.player_cache import get_player_cache
+from extensions.battle_dedup import get_battle_dedup
+from extensions.frontier import get_frontier
+from extensions.yield_model import get_yield_model
+from extensions.player_sampler import sample_players
 from helpers import log, email_admin, cr_api_request
+from transform import make_battle_id, transform_battle, transform_player_info
+from batch_writer import get_batch_writer
 
 
 SLEEP_TIME = 0.05
 
-
-def psql_insert(con, table: str, insert_tuple: tuple, integrity_error_action: str = 'rollback',
-                primary_key: str = None, primary_key_value: str = None) -> None:
-    """
-    A helper function that does exactly what INSERT INTO does
-    (when inserting into all columns).
-    :param con: A psycopg2 connection object;
-    :param table: Name of the table;
-    :param insert_tuple: Values to insert - usually a single tuple,
-    but if bulk=True, a tuple of tuples;
-    :param integrity_error_action: 'rollback' (default) or 'update' (given a primary key);
-    this is useful for PlayerInfo insertions;
-    :param primary_key: Required only if integrity_error_action = 'update';
-    :param primary_key_value: The actual value of primary key (assumes it's a string)
-    """
-    log('Entered psql_insert()')
-
-    # detect if this is a bulk insertion
-    bulk = type(insert_tuple[0]) is tuple
-    num_attr = len(insert_tuple) if not bulk else len(insert_tuple[0])
-
-    # build up something like this: '(%s, %s, %s)'
-    insert_tuple_format = '(' + ('%s, ' * num_attr)[:-2] + ')'
-
-    with con.cursor() as cur:
-        insert_cmd = 'INSERT INTO {} VALUES {};'.format(
-            table, insert_tuple_format)
-
-        try:
-            # execute insertion
-            if not bulk:
-                cur.execute(insert_cmd, insert_tuple)
-            else:
-                cur.executemany(insert_cmd, insert_tuple)
-        except psycopg2.IntegrityError:
-            if integrity_error_action == 'rollback':
-                # by default, if primary/foreign key constraint violation, roll back, do not email
-                con.rollback()
-            elif integrity_error_action == 'update':
-                # perform an update instead - use primary key specified
-                # shortcut: delete row with primary key, then re-insert
-                delete_cmd = "DELETE FROM {} WHERE {} = '{}'".format(
-                    table, primary_key, primary_key_value)
-                cur.execute(delete_cmd)
-                psql_insert(con, table, insert_tuple,
-                            integrity_error_action, primary_key, primary_key_value)
-        except psycopg2.Error as e:
-            # email admin on all other errors
-            email_admin(400, 'ERROR: Insertion: {}.'.format(str(e) + '\n' + insert_cmd + '\n' + str(insert_tuple)).strip())
-        else:
-            # commit if successful
-            con.commit()
+# number of players crawled whose battles' participants are queued (the traversal), after a (re)start
+BFS_PLAYERS = 20
 
 
 def insert_player_info(con, player_tag: str) -> None:
@@ -79,133 +33,46 @@ def insert_player_info(con, player_tag: str) -> None:
     player_info_res = cr_api_request(player_tag, 'player_info')
     # sleep(SLEEP_TIME)
 
+    store_player_info(con, player_tag, player_info_res)
+
+
+def store_player_info(con, player_tag: str, player_info_res: dict) -> None:
+    """
+    Inserts into table PlayerInfo given an already fetched player_info response.
+    Split out of insert_player_info() so that the API call can be made elsewhere
+    (e.g., concurrently by the async crawler).
+    :param con: A psycopg2 connection object;
+    :param player_tag: A string;
+    :param player_info_res: The return value of cr_api_request(player_tag, 'player_info').
+    """
     if player_info_res.get('statusCode') == 200 and len(player_info_res.get('body')) > 0:
         player_info = player_info_res.get('body')  # a dictionary
 
         # build insertion tuple by extracting every attribute for table PlayerInfo
-        playerTag = player_info.get('tag')
-        name = player_info.get('name')
-
-        clan = player_info.get('clan')
-        try:
-            clanTag = clan.get('tag')
-        except AttributeError:
-            clanTag = None
+        insertion_tuple = transform_player_info(player_info)
 
-        role = player_info.get('role')
-
-        arena = player_info.get('arena')
-        try:
-            arenaId = arena.get('id')
-            arenaName = arena.get('name')
-        except AttributeError:
-            arenaId = None
-            arenaName = None
-
-        trophies = player_info.get('trophies')
-        bestTrophies = player_info.get('bestTrophies')
-        donations = player_info.get('donations')
-        donationsReceived = player_info.get('donationsReceived')
-        totalDonations = player_info.get('totalDonations')
-
-        leagueStatistics = player_info.get('leagueStatistics')
-        if leagueStatistics is not None:
-            previousSeason = leagueStatistics.get('previousSeason')
-            try:
-                previousSeasonTrophies = previousSeason.get('trophies')
-                previousSeasonRank = previousSeason.get('rank')
-                previousSeasonBestTrophies = previousSeason.get('bestTrophies')
-                previousSeasonId = previousSeason.get('id')
-            except AttributeError:
-                previousSeasonTrophies = None
-                previousSeasonRank = None
-                previousSeasonBestTrophies = None
-                previousSeasonId = None
-
-            currentSeason = leagueStatistics.get('currentSeason')
-            try:
-                currentSeasonTrophies = currentSeason.get('trophies')
-                currentSeasonRank = currentSeason.get('rank')
-                currentSeasonBestTrophies = currentSeason.get('bestTrophies')
-                currentSeasonId = currentSeason.get('id')
-            except AttributeError:
-                currentSeasonTrophies = None
-                currentSeasonRank = None
-                currentSeasonBestTrophies = None
-                currentSeasonId = None
-
-            bestSeason = leagueStatistics.get('bestSeason')
-            try:
-                bestSeasonTrophies = bestSeason.get('trophies')
-                bestSeasonRank = bestSeason.get('rank')
-                bestSeasonBestTrophies = bestSeason.get('bestTrophies')
-                bestSeasonId = bestSeason.get('id')
-            except AttributeError:
-                bestSeasonTrophies = None
-                bestSeasonRank = None
-                bestSeasonBestTrophies = None
-                bestSeasonId = None
-        else:
-            previousSeasonTrophies = None
-            previousSeasonRank = None
-            previousSeasonBestTrophies = None
-            previousSeasonId = None
-            currentSeasonTrophies = None
-            currentSeasonRank = None
-            currentSeasonBestTrophies = None
-            currentSeasonId = None
-            bestSeasonTrophies = None
-            bestSeasonRank = None
-            bestSeasonBestTrophies = None
-            bestSeasonId = None
-
-        currentFavouriteCard = player_info.get('currentFavouriteCard')
-        try:
-            currentFavouriteCardName = currentFavouriteCard.get('name')
-        except AttributeError:
-            currentFavouriteCardName = None
-
-        expLevel = player_info.get('expLevel')
-        expPoints = player_info.get('expPoints')
-        wins = player_info.get('wins')
-        losses = player_info.get('losses')
-        battleCount = player_info.get('battleCount')
-        threeCrownWins = player_info.get('threeCrownWins')
-        challengeCardsWon = player_info.get('challengeCardsWon')
-        challengeMaxWins = player_info.get('challengeMaxWins')
-        tournamentCardsWon = player_info.get('tournamentCardsWon')
-        tournamentBattleCount = player_info.get('tournamentBattleCount')
-        warDayWins = player_info.get('warDayWins')
-        clanCardsCollected = player_info.get('clanCardsCollected')
-        starPoints = player_info.get('starPoints')
-
-        # the insertion tuple
-        insertion_tuple = (playerTag, name, clanTag, role, arenaId, arenaName, trophies, bestTrophies,
-                           donations, donationsReceived, totalDonations,
-                           previousSeasonTrophies, previousSeasonRank, previousSeasonBestTrophies, previousSeasonId,
-                           currentSeasonTrophies, currentSeasonRank, currentSeasonBestTrophies, currentSeasonId,
-                           bestSeasonTrophies, bestSeasonRank, bestSeasonBestTrophies, bestSeasonId,
-                           currentFavouriteCardName, expLevel, expPoints, wins, losses, battleCount,
-                           threeCrownWins, challengeCardsWon, challengeMaxWins, tournamentCardsWon,
-                           tournamentBattleCount, warDayWins, clanCardsCollected, starPoints)
-
-        psql_insert(con, 'PlayerInfo', insertion_tuple, integrity_error_action='update',
-                    primary_key='playerTag', primary_key_value=playerTag)
+        # buffered; upserted when the batch is written
+        get_batch_writer(con).add_player_info(insertion_tuple)
+        get_player_cache().mark(player_tag)
 
         log('insert_player_info() success, player_tag = {}'.format(player_tag))
 
     else:
         # if fails, ignore - this is not a critical part of data collection
+        # (the player is stale again, if claimed by PlayerInfoCache.stale_tags())
+        get_player_cache().release(player_tag)
         log('Did not insert player info')
-        pass
 
 
-def insert_battle(con, data: dict) -> None:
+def insert_battle(con, data: dict, with_player_info: bool = True) -> bool:
     """
     Inserts a single battle into the DB.
     :param con: A psycopg2 connection object;
     :param data: A dictionary (subset) taken directly from a battle_log request.
-    The data contains information for exactly one battle.
+    The data contains information for exactly one battle;
+    :param with_player_info: If False, skip the PlayerInfo refresh of participants
+    (the caller is then responsible for it);
+    :return: False if the battle was already stored (and nothing was done), else True.
     """
     log('Entered insert_battle()')
 
@@ -213,157 +80,38 @@ def insert_battle(con, data: dict) -> None:
     # generate battleId
     # ------------------------------------------
 
-    # sha256 of battleTime and player tags of every participant in alphabetical order
     battleTime = data.get('battleTime')
+    battleId = make_battle_id(data)
 
-    team = data.get('team') or []
-    opponent = data.get('opponent') or []
-
-    participants = team + opponent
-    tags = [player.get('tag') for player in participants]
-    tags.sort()
-
-    s = ''.join([str(battleTime)] + tags)
-    m = hashlib.sha256()
-    m.update(s.encode('utf8'))
-    battleId = m.hexdigest()
+    # drop already-stored battles before doing any work
+    dedup = get_battle_dedup(con)
+    if dedup.is_duplicate(con, battleId, battleTime):
+        log('insert_battle() skipped known battle')
+        return False
 
     # ------------------------------------------
-    # insert into table BattleInfo
+    # insert into tables BattleInfo, BattleParticipant, BattleData, ParticipantDeck
     # ------------------------------------------
 
-    type = data.get('type')
-    isLadderTournament = data.get('isLadderTournament')
-    try:
-        arena = data.get('arena')
-        arena_id = arena.get('id')
-        arena_name = arena.get('name')
-    except AttributeError:
-        arena_id = None
-        arena_name = None
-    try:
-        gameMode = data.get('gameMode')
-        game_mode_id = gameMode.get('id')
-        game_mode_name = gameMode.get('name')
-    except AttributeError:
-        game_mode_id = None
-        game_mode_name = None
-    deckSelection = data.get('deckSelection')
-
-    psql_insert(con, 'BattleInfo', (battleId, battleTime, type, isLadderTournament,
-                                    arena_id, arena_name, game_mode_id, game_mode_name, deckSelection))
-
-    # ------------------------------------------
-    # insert into table BattleParticipant
-    # ------------------------------------------
-
-    # for each battle, insert a row for each player
-    df = pd.DataFrame(participants)
-    df = df.drop('name', axis=1)  # TODO further subsetting
-
-    # add extra columns for BattleParticipant insertion
-    team_tags = [player.get('tag') for player in team]
-    df['team'] = df['tag'].apply(
-        lambda tag: True if tag in team_tags else False)
-    df['battleId'] = battleId
-    df_sub = df[['battleId', 'tag', 'team']]
-
-    # bulk insertion
-    insertion_tuple = df_sub.to_records(index=False).tolist()
-    psql_insert(con, 'BattleParticipant', insertion_tuple)
-
-    # ------------------------------------------
-    # insert into table BattleData
-    # ------------------------------------------
-
-    # make sure all db columns exist in current data (if not set null)
-    curr_cols = df.columns
-    all_cols = pd.Series(['clan', 'startingTrophies', 'trophyChange', 'crowns',
-                          'princessTowersHitPoints', 'kingTowerHitPoints',
-                          'boatBattleSide', 'boatBattleWon',
-                          'newTowersDestroyed', 'prevTowersDestroyed', 'remainingTowers'])
-
-    def f(col):
-        if col not in curr_cols:
-            df[col] = None
-    all_cols.apply(f)
-
-    df = df.replace({nan: None})  # change NaN to None
-
-    # process clan column
-    df['clan'] = df['clan'].apply(lambda entry: entry.get(
-        'tag') if entry is not None else None)
-
-    # split princess tower hitpoints into separate columns
-    df_princess = []
-
-    def f(col):
-        values = [None, None]
-        if col is not None:
-            if len(col) == 2:
-                values = col
-            elif len(col) == 1:
-                values = col + [None]
-        df_princess.append(values)
-
-    df['princessTowersHitPoints'].apply(f)
-
-    df_princess = pd.DataFrame(df_princess, columns=[
-                               'princessTower1HitPoints', 'princessTower2HitPoints'])
-    df_princess = df_princess.replace({nan: None})
-
-    df = pd.concat([df, df_princess], axis=1)
-
-    # process boatBattle (1v1 always) columns
-    if data.get('type') == 'boatBattle':
-        # match attacker/defender status with team sides
-        df.loc[df['team'], 'boatBattleSide'] = data.get('boatBattleSide')
-        df.loc[~(df['team']), 'boatBattleSide'] = 'attacker' if data.get(
-            'boatBattleSide') != 'attacker' else 'defender'
-
-        # match win status with team sides
-        df.loc[df['team'], 'boatBattleWon'] = data.get('boatBattleWon')
-        df.loc[~(df['team']), 'boatBattleWon'] = not data.get('boatBattleWon')
-
-        # these are shared values
-        df['newTowersDestroyed'] = data.get('newTowersDestroyed')
-        df['prevTowersDestroyed'] = data.get('prevTowersDestroyed')
-        df['remainingTowers'] = data.get('remainingTowers')
-
-    # make subset for insertion
-    df_sub = df[['battleId', 'tag', 'clan',
-                 'startingTrophies', 'trophyChange', 'crowns',
-                 'princessTower1HitPoints', 'princessTower2HitPoints', 'kingTowerHitPoints',
-                 'boatBattleSide', 'boatBattleWon',
-                 'newTowersDestroyed', 'prevTowersDestroyed', 'remainingTowers']]
-
-    # bulk insertion
-    insertion_tuple = df_sub.to_records(index=False).tolist()
-    psql_insert(con, 'BattleData', insertion_tuple)
-
-    # ------------------------------------------
-    # insert into table BattleDeck
-    # ------------------------------------------
-
-    # for each battle, insert a row for each player
-    # also explode cards column
-    df = df.explode('cards')
-    df = pd.concat([df.drop(['cards'], axis=1),
-                   df['cards'].apply(pd.Series)], axis=1)
-    df_sub = df[['battleId', 'tag', 'name', 'level']]
-
-    # bulk insertion
-    insertion_tuple = df_sub.to_records(index=False).tolist()
-    psql_insert(con, 'BattleDeck', insertion_tuple)
+    # rows are buffered and written with those of many other battles in one transaction
+    # (the writer records the battle as stored in the dedup once it is written)
+    rows = transform_battle(data, battleId)
+    dedup.hold(battleId)
+    get_batch_writer(con).add_battle(rows)
 
     # ------------------------------------------
     # insert/update table PlayerInfo for all player tags involved
     # ------------------------------------------
-    for tag in tags:
-        insert_player_info(con, tag)
+    # skipping players refreshed within the TTL
+    if with_player_info:
+        tags = sorted(row[1] for row in rows['BattleParticipant'])
+        for tag in get_player_cache().stale_tags(con, tags):
+            insert_player_info(con, tag)
 
     log('insert_battle() success')
 
+    return True
+
 
 def get_last_playertag(con) -> str:
     """
@@ -377,12 +125,12 @@ def get_last_playertag(con) -> str:
             cur.execute("""
                 SELECT playerTag
                 FROM BattleParticipant
-                WHERE battleId = (
-                    SELECT battleId
+                JOIN (
+                    SELECT battleId, battleTime
                     FROM BattleInfo
                     ORDER BY battleTime DESC
                     LIMIT 1
-                )
+                ) last USING (battleId, battleTime)
                 LIMIT 1;
             """)
             res = cur.fetchone()  # a tuple
@@ -395,39 +143,34 @@ def get_last_playertag(con) -> str:
                 400, 'ERROR: Get last playerTag: {}.'.format(str(e).strip()))
 
 
-def get_random_playertags(con, n=1000) -> str:
+def get_random_playertags(con, n=1000, weights=None) -> list:
     """
-    A function that selects random player tags within table BattleParticipant.
-    :return: Either a string or None.
+    A function that selects random distinct player tags, from table Player
+    (by random keys: no scan of BattleParticipant).
+    :param con: A psycopg2 connection object;
+    :param n: Number of player tags;
+    :param weights: Optional {trophy range: weight} for a stratified sample (see sample_players());
+    :return: A list of length-1 tuples, or None.
     """
     log('Entered get_random_playertags()')
 
-    with con.cursor() as cur:
-        try:
-            cur.execute("""
-                SELECT playerTag FROM BattleParticipant WHERE RANDOM() < 0.01 LIMIT %s;
-            """, (n,))
-            res = cur.fetchall()  # a list of tuples
-            return res  # if no result, []
-        except psycopg2.Error as e:
-            email_admin(
-                400, 'ERROR: Get random playerTags: {}.'.format(str(e).strip()))
+    try:
+        return [(tag,) for tag in sample_players(con, n, weights)]  # if no result, []
+    except psycopg2.Error as e:
+        con.rollback()
+        email_admin(
+            400, 'ERROR: Get random playerTags: {}.'.format(str(e).strip()))
 
 
-def collect_data(init_player_tag_manual=None) -> None:
+def get_init_battle(con) -> dict:
     """
-    Collect data recursively using the technique called crawling.
-    Each node is a battle; and from this battle, a list of players can be produced:
-    All battle participants + their clanmates.
-    Then each player from this list yields a battle log (more battles).
-    Now recurse with a level-order traversal to enhance diversity.
+    Find an initial battle to start crawling from: the battle log of the last inserted
+    player (or a random player) is requested, and one of its battles is picked at random.
+    Terminates the program if no battle can be found.
     :param con: A psycopg2 connection object;
-    :param init_player_tag_manual: A player tag to initialize data collection manually.
+    :return: A dictionary containing exactly one battle.
     """
-    db = DBConnection()
-    con = db.get_con()
-
-    # need an initial battle
+    log('Entered get_init_battle()')
 
     # find a player with a list of battles
     retryThreshold = 10
@@ -472,128 +215,127 @@ def collect_data(init_player_tag_manual=None) -> None:
             400, 'Cannot get battle log from initial player; need to manually specify one; data collection terminated.')
         exit(1)
 
-    # data collection process starts
-
-    # initialize queue for level-order traversal
-    queue = deque()
-    queue.append(init_battle)
+    return init_battle
 
-    i = 0  # counts number of inserts
 
-    while len(queue) > 0:
-        # stop level order traversal after DB has been populated enough
-        if i >= 5:
-            break
+def crawl_player(con, tag: str, expand: bool = False) -> None:
+    """
+    Get the battle log of a player and insert all its battles that are newer than the ones
+    seen in the previous request (skipped if the player is not due for a revisit).
+    :param con: A psycopg2 connection object;
+    :param tag: A player tag;
+    :param expand: If True, push participants of every battle to the frontier (scored by YieldModel).
+    """
+    log('Curr player tag = {}'.format(tag))
 
-        # remove front of queue and insert into DB
-        curr_battle = queue.popleft()
-        insert_battle(con, curr_battle)
-        i += 1
+    model = get_yield_model()
+    if not model.is_due(tag):
+        log('Player {} not due for a revisit'.format(tag))
+        return
 
-        log('Inserted queue front to DB')
-
-        # produce a list of players
-
-        # player tags of battle participants
-        team = curr_battle.get('team') or []
-        opponent = curr_battle.get('opponent') or []
-        participants = team + opponent
-
-        # # clan tags of battle participants if any
-        # player_clan_map = {}
-        # for player in participants:
-        #     clan = player.get('clan')
-        #     try:
-        #         clan_tag = clan.get('tag')
-        #     except AttributeError:
-        #         clan_tag = None
-        #     player_clan_map[player.get('tag')] = clan_tag
-
-        # # get tags of all members of each clan
-        # all_player_tags = []
-        # for player_tag in player_clan_map:
-        #     clan_tag = player_clan_map.get(player_tag)
-        #     if clan_tag is None:
-        #         # not part of a clan, append itself
-        #         all_player_tags.append(player_tag)
-        #     else:
-        #         clan_members_res = cr_api_request(clan_tag, 'clan_members')
-        #         sleep(SLEEP_TIME)
-
-        #         if clan_members_res.get('statusCode') != 200:  # request failed
-        #             # failed to get clan members, append itself
-        #             all_player_tags.append(player_tag)
-        #         else:
-        #             clan = clan_members_res.get('body')
-        #             members = clan.get('items')
-        #             for member in members:
-        #                 all_player_tags.append(member.get('tag'))
-
-        # do not process clans for now to speed up
-        all_player_tags = [player.get('tag') for player in participants]
-
-        log('All player tags: {}'.format(len(all_player_tags)))
-
-        # get battle logs of all players, then enqueue
-        for player_tag in all_player_tags:
-            # get battle log of current player
-            battle_log_res = cr_api_request(player_tag, 'battle_log')
-            sleep(SLEEP_TIME)
-
-            if battle_log_res.get('statusCode') == 200 and len(battle_log_res.get('body')) > 0:
-                # a list of dict, where each dict is a battle
-                battle_log = battle_log_res.get('body')
-
-                # enqueue all battles for current player
-                for battle in battle_log:
-                    queue.append(battle)
-            else:
-                continue
+    battle_log_res = cr_api_request(tag, 'battle_log')
+    sleep(SLEEP_TIME)
 
-        log('while() curr iter done')
+    log('Got battle log response for tag: {}'.format(tag))
 
-    # after DB has been populated enough
-    # first finish inserting all battles currently in queue
-    log('Exited while() - BFS')
+    if battle_log_res.get('statusCode') == 200 and len(battle_log_res.get('body')) > 0:
+        # a list of dict, where each dict is a battle
+        battle_log = battle_log_res.get('body')
 
-    while len(queue) > 0:
-        insert_battle(con, queue.popleft())
-        sleep(SLEEP_TIME)
+        new_battles = 0
+        for battle in model.unseen(tag, battle_log):
+            new_battles += insert_battle(con, battle)
 
-    log('Queue emptied')
+            if expand:
+                # produce a list of players: battle participants
+                # (clanmates are not processed for now to speed up)
+                team = battle.get('team') or []
+                opponent = battle.get('opponent') or []
+                tags = [player.get('tag') for player in team + opponent]
+                trophies = {player.get('tag'): player.get('startingTrophies') for player in team + opponent}
+                get_frontier().push(tags, model.score(tags, trophies))
 
-    # repeat random sampling from existing player pool
-    while True:
-        log('Entered while-true')
+        model.observe(tag, battle_log, new_battles)
 
-        # a list of 1000 length-1 tuples
-        random_playertags = get_random_playertags(con)
 
-        log('Got random player tags')
+def collect_data(init_player_tag_manual=None) -> None:
+    """
+    Collect data recursively using the technique called crawling.
+    Each node is a battle; and from this battle, a list of players can be produced:
+    All battle participants + their clanmates.
+    Then each player from this list yields a battle log (more battles).
+    Now recurse with a level-order traversal to enhance diversity.
+    Players to crawl are queued in the frontier, which is kept on disk: after a restart,
+    crawling resumes from the players that were still queued. The frontier pops the player
+    with the most expected new battles first (see YieldModel), with some exploration.
+    :param con: A psycopg2 connection object;
+    :param init_player_tag_manual: A player tag to initialize data collection manually.
+    """
+    db = DBConnection()
+    con = db.get_con()
 
-        # for each player tag, insert all its battles
-        for tp in random_playertags:
-            log('Entered for-each-random-player-tag')
+    frontier = get_frontier()
+    # popped players are only checkpointed, and high-water marks committed, once their battles are written
+    frontier.before_checkpoint = get_batch_writer(con).flush
+    get_yield_model().before_commit = get_batch_writer(con).flush
 
-            tag = tp[0]
+    if len(frontier) == 0:
+        # need an initial battle
+        init_battle = get_init_battle(con)
+        insert_battle(con, init_battle)
 
-            log('Curr random player tag = {}'.format(tag))
+        team = init_battle.get('team') or []
+        opponent = init_battle.get('opponent') or []
+        frontier.push([player.get('tag') for player in team + opponent])
+    else:
+        log('Resuming from frontier: {} players queued'.format(len(frontier)))
 
-            battle_log_res = cr_api_request(tag, 'battle_log')
-            sleep(SLEEP_TIME)
+    # data collection process starts
 
-            log('Got battle log response for tag: {}'.format(tag))
+    # level-order traversal
+    i = 0  # counts number of players crawled
 
-            if battle_log_res.get('statusCode') == 200 and len(battle_log_res.get('body')) > 0:
-                log('Valid battle_log_res')
+    while i < BFS_PLAYERS:
+        # stop level order traversal after DB has been populated enough
+        tag = frontier.pop()
+        if tag is None:
+            break
 
-                # a list of dict, where each dict is a battle
-                battle_log = battle_log_res.get('body')
+        crawl_player(con, tag, expand=True)
+        frontier.done(tag)
+        i += 1
 
-                log('Battle log for player tag {}:\n{}'.format(tag, str(battle_log)))
+        log('while() curr iter done')
 
-                log('Start insertion for-loop')
+    log('Exited while() - BFS')
 
-                for battle in battle_log:
-                    insert_battle(con, battle)
-                    log('Inserted battle:\n{}'.format(str(battle)))
+    # repeat random sampling from existing player pool
+    while True:
+        log('Entered while-true')
+        log('HTTP timings: {}'.format(http_stats.summary()))
+        log('PlayerInfo cache: {}'.format(get_player_cache().summary()))
+        log('Battle dedup: {}'.format(get_battle_dedup(con).summary()))
+        log('Batch writer: {}'.format(get_batch_writer(con).summary()))
+        log('Frontier: {}'.format(frontier.summary()))
+        log('Yield: {}'.format(get_yield_model().summary()))
+        get_battle_dedup(con).prune()
+
+        # players still queued (from the BFS, or from before a restart) go first
+        if len(frontier) == 0:
+            # a list of 1000 length-1 tuples
+            random_playertags = get_random_playertags(con)
+            tags = [tp[0] for tp in random_playertags]
+            frontier.push(tags, get_yield_model().score(tags))
+
+            log('Got random player tags')
+
+        # for each player tag (highest expected yield first), insert all its battles
+        while True:
+            tag = frontier.pop()
+            if tag is None:
+                break
+            crawl_player(con, tag)
+            frontier.done(tag)
+
+        frontier.checkpoint()  # flushes the batch writer first
+        get_yield_model().commit()
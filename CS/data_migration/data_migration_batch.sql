@@ -1,3 +1,6 @@
+-- Superseded by ../migrate_clash.py (parallel, resumable, loads with COPY): see the README.
+-- Kept for reference; it targets the original schema (char(64) battleId, table BattleDeck).
+
 -- -- ==========================================
 -- -- Resets new db tables
 -- -- ==========================================
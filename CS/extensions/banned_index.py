@@ -0,0 +1,208 @@
+import threading
+from os import replace
+from os.path import isfile, getsize
+
+import numpy as np
+
+
+# player tags only use these characters; a tag is packed into a uint64 as a base-15 number
+# (digits 1..14, so that leading characters are never lost); 15^16 < 2^64
+TAG_ALPHABET = '0289PYLQGRJCUV'
+MAX_TAG_LEN = 16
+
+# file header: magic, byte offset of `banned` covered by the index, number of entries
+IDX_MAGIC = b'BANIDX01'
+IDX_HEADER = np.dtype([('magic', 'S8'), ('offset', '<u8'), ('count', '<u8')])
+
+# rebuild the sorted index once this many tags were appended since the last build
+COMPACT_THRESHOLD = 50000
+
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+_digits = {c: i + 1 for i, c in enumerate(TAG_ALPHABET)}
+
+
+def encode_tag(tag: str):
+    """
+    Pack a player tag (e.g., '#9YJUPU9LY') into an int.
+    :return: An int < 2^64, or None if the tag has unexpected characters or length.
+    """
+    body = tag.lstrip('#').upper()
+    if len(body) == 0 or len(body) > MAX_TAG_LEN:
+        return None
+    code = 0
+    for c in body:
+        d = _digits.get(c)
+        if d is None:
+            return None
+        code = code * 15 + d
+    return code
+
+
+class BannedIndex:
+    """
+    A set of banned (404) player tags that is loaded once and kept in memory.
+    The text file `banned` (one tag per line) stays the append-only log; `banned.idx` is a
+    compact sorted uint64 array of all tags in the log up to a recorded byte offset
+    (followed by the rare tags that cannot be packed, as text).
+    On load, only the log tail past that offset is parsed, so startup stays fast.
+    Lookups go through a 1-hash Bloom bitmap (O(1), rejects almost every non-banned tag),
+    then a binary search of the sorted array, or a set of recently added tags.
+    Thread-safe.
+    """
+
+    def __init__(self, path: str = 'banned', compact_threshold: int = COMPACT_THRESHOLD):
+        """
+        :param path: Path of the text log; the index lives at path + '.idx';
+        :param compact_threshold: Rebuild the index when the log tail has this many tags.
+        """
+        self.path = path
+        self.idx_path = path + '.idx'
+        self.compact_threshold = compact_threshold
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        """
+        Load banned.idx (if valid) and the tail of the log it does not cover.
+        """
+        if not isfile(self.path):
+            open(self.path, 'w').close()
+
+        self.sorted = np.empty(0, dtype=np.uint64)
+        other = []
+        offset = 0
+
+        if isfile(self.idx_path):
+            header = np.fromfile(self.idx_path, dtype=IDX_HEADER, count=1)
+            if len(header) == 1 and header['magic'][0] == IDX_MAGIC and header['offset'][0] <= getsize(self.path):
+                offset = int(header['offset'][0])
+                count = int(header['count'][0])
+                self.sorted = np.fromfile(self.idx_path, dtype='<u8', count=count, offset=IDX_HEADER.itemsize)
+
+                # tags that cannot be encoded follow the array as text
+                with open(self.idx_path, 'rb') as fh:
+                    fh.seek(IDX_HEADER.itemsize + 8 * count)
+                    other = fh.read().decode('utf8').split('\n')
+
+        self.recent = set()  # encoded tags appended after the index was built
+        self.other = set(tag for tag in other if len(tag) > 0)  # tags that cannot be encoded
+
+        codes = []
+        with open(self.path, 'rb') as fh:
+            fh.seek(offset)
+            for line in fh:
+                tag = line.decode('utf8').strip()
+                if len(tag) == 0:
+                    continue
+                code = encode_tag(tag)
+                if code is None:
+                    self.other.add(tag)
+                else:
+                    codes.append(code)
+
+        # drop tags the sorted index already holds (vectorized)
+        codes = np.array(codes, dtype=np.uint64)
+        codes = codes[~np.isin(codes, self.sorted)]
+        self.recent = set(codes.tolist())
+
+        if len(self.recent) + len(self.other) >= self.compact_threshold:
+            self.compact()  # also builds the Bloom bitmap
+        else:
+            self._build_bloom()
+
+    def _in_sorted(self, code: int) -> bool:
+        i = np.searchsorted(self.sorted, np.uint64(code))
+        return i < len(self.sorted) and int(self.sorted[i]) == code
+
+    def _build_bloom(self) -> None:
+        # one bit per hash slot, ~16 bits per entry, at least 2^20 bits
+        n = len(self.sorted) + len(self.recent)
+        bits = 1 << 20
+        while bits < 16 * n:
+            bits <<= 1
+        self.bloom_mask = bits - 1
+        self.bloom = np.zeros(bits // 8, dtype=np.uint8)
+
+        codes = np.concatenate([self.sorted, np.fromiter(self.recent, dtype=np.uint64, count=len(self.recent))])
+        if len(codes) > 0:
+            with np.errstate(over='ignore'):
+                h = (codes * np.uint64(HASH_MULTIPLIER)) >> np.uint64(32)
+            h &= np.uint64(self.bloom_mask)
+            np.bitwise_or.at(self.bloom, h >> np.uint64(3), np.left_shift(1, h & np.uint64(7)).astype(np.uint8))
+
+    def _bloom_slot(self, code: int) -> int:
+        # multiplicative (Fibonacci) hashing; must match the vectorized version in _build_bloom()
+        return (((code * HASH_MULTIPLIER) & 0xFFFFFFFFFFFFFFFF) >> 32) & self.bloom_mask
+
+    def __contains__(self, tag: str) -> bool:
+        code = encode_tag(tag)
+        if code is None:
+            return tag in self.other
+
+        h = self._bloom_slot(code)
+        if not (self.bloom[h >> 3] >> (h & 7)) & 1:
+            return False
+
+        return code in self.recent or self._in_sorted(code)
+
+    def __len__(self) -> int:
+        return len(self.sorted) + len(self.recent) + len(self.other)
+
+    def add(self, tag: str) -> None:
+        """
+        Record a banned tag in memory and append it to the log on disk.
+        """
+        tag = tag.strip()
+        if tag in self:
+            return
+        with self.lock:
+            with open(self.path, 'a') as fh:
+                fh.write(tag + '\n')
+            code = encode_tag(tag)
+            if code is None:
+                self.other.add(tag)
+            else:
+                self.recent.add(code)
+                h = self._bloom_slot(code)
+                self.bloom[h >> 3] |= 1 << (h & 7)
+
+            if len(self.recent) + len(self.other) >= self.compact_threshold:
+                self._compact()
+
+    def compact(self) -> None:
+        """
+        Merge recently added tags into the sorted index and rewrite banned.idx.
+        """
+        with self.lock:
+            self._compact()
+
+    def _compact(self) -> None:
+        recent = np.fromiter(self.recent, dtype=np.uint64, count=len(self.recent))
+        self.sorted = np.union1d(self.sorted, recent).astype(np.uint64)
+
+        header = np.array([(IDX_MAGIC, getsize(self.path), len(self.sorted))], dtype=IDX_HEADER)
+        tmp_path = self.idx_path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(header.tobytes())
+            fh.write(self.sorted.astype('<u8').tobytes())
+            fh.write('\n'.join(sorted(self.other)).encode('utf8'))
+        replace(tmp_path, self.idx_path)  # atomic
+
+        self.recent = set()
+        self._build_bloom()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_banned_index() -> BannedIndex:
+    """
+    :return: The process-wide BannedIndex (loaded on first use, from the working directory).
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = BannedIndex()
+        return _index
@@ -0,0 +1,171 @@
+import threading
+from datetime import datetime, timedelta
+
+import psycopg2
+
+
+# battle logs only hold a player's last 25 battles, so repeats are almost always recent;
+# every battle stored within this window is kept in memory
+DEDUP_WINDOW_DAYS = 7
+
+# battleTime format used by the API (sorts lexicographically), e.g. '20211110T123456.000Z'
+API_TIME_FORMAT = '%Y%m%dT%H%M%S.000Z'
+
+
+class BattleDedup:
+    """
+    Drops already-stored battles before insert_battle() does any work.
+    Keys are the first 64 bits of the sha256 battleId, held in a dictionary that is seeded
+    from BattleInfo (battles within the window) on first use and updated once a battle is
+    written (by the BatchWriter). Battles buffered for writing are held in flight meanwhile:
+    their copies are duplicates too, but a battle that is not written can be crawled again.
+    For battles newer than the window start, memory is complete and answers alone;
+    older battles fall back to a primary-key lookup in BattleInfo.
+    Thread-safe.
+    """
+
+    def __init__(self, window_days: int = DEDUP_WINDOW_DAYS):
+        """
+        :param window_days: How many days of stored battles to keep in memory.
+        """
+        self.window = timedelta(days=window_days)
+        self.seen = {}  # 64-bit battleId prefix -> battleTime (API format)
+        self.in_flight = set()  # 64-bit battleId prefixes of buffered battles
+        self.cutoff = None  # memory is complete for battles at or after this battleTime
+        self.lock = threading.Lock()
+
+        # counters for reporting
+        self.memory_duplicates = 0
+        self.db_duplicates = 0
+        self.new = 0
+
+    @staticmethod
+    def key(battle_id: str) -> int:
+        return int(battle_id[:16], 16)
+
+    def seed(self, con) -> None:
+        """
+        Load ids of battles within the window from BattleInfo.
+        :param con: A psycopg2 connection object.
+        """
+        cutoff = (datetime.utcnow() - self.window).strftime(API_TIME_FORMAT)
+        seen = {}
+
+        try:
+            # named (server-side) cursor: rows are streamed, not loaded at once;
+            # WITH HOLD so that it also works on autocommit connections
+            with con.cursor(name='battle_dedup_seed', withhold=True) as cur:
+                cur.itersize = 100000
+                cur.execute("""
+                    SELECT encode(battleId, 'hex'), TO_CHAR(battleTime, 'YYYYMMDD"T"HH24MISS".000Z"')
+                    FROM BattleInfo
+                    WHERE battleTime >= %s;
+                """, (cutoff,))
+                for battle_id, battle_time in cur:
+                    seen[self.key(battle_id)] = battle_time
+        except psycopg2.Error:
+            # memory stays empty; every lookup falls back to the DB
+            con.rollback()
+            cutoff = None
+
+        with self.lock:
+            seen.update(self.seen)
+            self.seen = seen
+            self.cutoff = cutoff
+
+    def prune(self) -> None:
+        """
+        Slide the window forward and forget battles that fell out of it.
+        """
+        cutoff = (datetime.utcnow() - self.window).strftime(API_TIME_FORMAT)
+        with self.lock:
+            if self.cutoff is None:
+                return
+            self.seen = {k: t for k, t in self.seen.items() if t is None or t >= cutoff}
+            self.cutoff = cutoff
+
+    def is_duplicate(self, con, battle_id: str, battle_time: str) -> bool:
+        """
+        :param con: A psycopg2 connection object;
+        :param battle_id: The sha256 hex battleId;
+        :param battle_time: The battleTime as given by the API;
+        :return: True if the battle is already stored.
+        """
+        key = self.key(battle_id)
+
+        with self.lock:
+            if key in self.seen or key in self.in_flight:
+                self.memory_duplicates += 1
+                return True
+            if self.cutoff is not None and battle_time is not None and battle_time >= self.cutoff:
+                self.new += 1
+                return False
+
+        # older than the window: ask the DB
+        try:
+            with con.cursor() as cur:
+                # battleTime (part of the hashed content) limits the lookup to one partition
+                cur.execute("""
+                    SELECT 1 FROM BattleInfo WHERE battleId = decode(%s, 'hex') AND battleTime = %s;
+                """, (battle_id, battle_time))
+                stored = cur.fetchone() is not None
+        except psycopg2.Error:
+            con.rollback()
+            stored = False
+
+        with self.lock:
+            if stored:
+                self.db_duplicates += 1
+            else:
+                self.new += 1
+        return stored
+
+    def hold(self, battle_id: str) -> None:
+        """
+        Record a battle that is about to be buffered for writing.
+        """
+        with self.lock:
+            self.in_flight.add(self.key(battle_id))
+
+    def add(self, battle_id: str, battle_time: str) -> None:
+        """
+        Record a battle that was just stored.
+        """
+        key = self.key(battle_id)
+        with self.lock:
+            self.seen[key] = battle_time
+            self.in_flight.discard(key)
+
+    def release(self, battle_id: str) -> None:
+        """
+        Forget a battle held in flight that could not be stored.
+        """
+        with self.lock:
+            self.in_flight.discard(self.key(battle_id))
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                'new': self.new,
+                'memory_duplicates': self.memory_duplicates,
+                'db_duplicates': self.db_duplicates,
+                'in_memory': len(self.seen),
+                'in_flight': len(self.in_flight),
+            }
+
+
+_dedup = None
+_dedup_lock = threading.Lock()
+
+
+def get_battle_dedup(con) -> BattleDedup:
+    """
+    :param con: A psycopg2 connection object, used to seed the filter on first use;
+    :return: The process-wide BattleDedup.
+    """
+    global _dedup
+    with _dedup_lock:
+        if _dedup is None:
+            _dedup = BattleDedup()
+            _dedup.seed(con)
+        return _dedup
@@ -0,0 +1,223 @@
+import atexit
+import sqlite3
+import threading
+from collections import deque
+from random import random
+from time import monotonic
+
+
+# max number of player tags held in memory, on each side (next to crawl / just discovered)
+HOT_SIZE = 10000
+
+# pops and pushes are made durable at least this often (seconds)
+CHECKPOINT_INTERVAL = 30
+
+# share of pops that take the oldest queued tag instead of the highest scored one
+# (so that every player is eventually crawled, and the yield estimates keep being checked)
+EXPLORATION_SHARE = 0.1
+
+
+class Frontier:
+    """
+    The crawl frontier: a priority queue of player tags whose battle log is still to be fetched,
+    kept in a local SQLite file so that a restarted crawler resumes where it stopped.
+    Each tag has a score (expected new battles, see YieldModel); pop() returns the highest
+    scored tag, except for a share of pops (exploration) that return the oldest one.
+    Tags pushed without a score are popped in FIFO order among themselves.
+    Memory is bounded: only hot windows of the next HOT_SIZE tags to pop and a buffer of
+    at most HOT_SIZE newly pushed tags are in memory; the rest is spilled to disk.
+    A tag is queued at most once (pushing a tag that is already queued keeps the higher score).
+    Pops and pushes are written to disk in one transaction per checkpoint, after which the
+    hot windows are reloaded; after a crash, tags popped since the last checkpoint are
+    crawled again. A popped tag is only done once the battles crawled from it are stored:
+    popped tags are in progress (they stay on disk) until done() is called for them, and
+    before_checkpoint (e.g., flushing the BatchWriter) is called before every checkpoint.
+    Thread-safe.
+    """
+
+    def __init__(self, path: str = 'frontier.db', hot_size: int = HOT_SIZE,
+                 checkpoint_interval: float = CHECKPOINT_INTERVAL, exploration_share: float = EXPLORATION_SHARE,
+                 before_checkpoint=None):
+        """
+        :param path: Path of the SQLite file (created if missing);
+        :param hot_size: Max number of tags in memory, on each side;
+        :param checkpoint_interval: Max seconds between two checkpoints;
+        :param exploration_share: Share of pops that return the oldest tag (0: always the best);
+        :param before_checkpoint: Function called (without arguments) before every checkpoint, to make
+        the work done on popped tags durable first; if it raises, nothing is checkpointed.
+        """
+        self.path = path
+        self.hot_size = hot_size
+        self.checkpoint_interval = checkpoint_interval
+        self.exploration_share = exploration_share
+        self.before_checkpoint = before_checkpoint
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL;')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS frontier (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                tag TEXT NOT NULL UNIQUE
+            );
+        """)
+        # frontier files written before tags had a score
+        if 'score' not in [col[1] for col in self.db.execute('PRAGMA table_info(frontier);')]:
+            self.db.execute('ALTER TABLE frontier ADD COLUMN score REAL NOT NULL DEFAULT 0;')
+        self.db.execute('CREATE INDEX IF NOT EXISTS frontier_score ON frontier (score DESC, seq);')
+        self.db.commit()
+
+        self.best = deque()  # (seq, tag) loaded from disk, highest score first
+        self.oldest = deque()  # (seq, tag) loaded from disk, oldest first
+        self.popped = set()  # seq of tags popped since the last checkpoint
+        self.in_progress = {}  # tag -> seq, popped tags not done yet (not checkpointed)
+        self.pushed = {}  # tag -> score, pushed since the last checkpoint (dict: keeps order)
+        self.last_checkpoint = monotonic()
+
+        self.size = self.db.execute('SELECT COUNT(*) FROM frontier;').fetchone()[0]
+
+        # counters for reporting
+        self.pops = 0
+        self.explorations = 0
+        self.pushes = 0
+        self.duplicates = 0
+        self.checkpoints = 0
+
+    def __len__(self) -> int:
+        """
+        :return: Number of queued tags (including buffered pushes that may turn out to be duplicates).
+        """
+        with self.lock:
+            return self.size - len(self.popped) + len(self.pushed)
+
+    def push(self, tags: list, scores: list = None) -> None:
+        """
+        Queue player tags.
+        :param tags: A list of player tags;
+        :param scores: Optional list of scores (higher is popped first), one per tag.
+        """
+        if scores is None:
+            scores = [0.0] * len(tags)
+
+        with self.lock:
+            for tag, score in zip(tags, scores):
+                if tag is None:
+                    continue
+                if tag in self.pushed:
+                    self.duplicates += 1
+                    self.pushed[tag] = max(self.pushed[tag], score)
+                    continue
+                self.pushed[tag] = score
+                self.pushes += 1
+            if len(self.pushed) >= self.hot_size:
+                self.checkpoint()
+            else:
+                self._maybe_checkpoint()
+
+    def pop(self):
+        """
+        :return: The player tag at the front of the frontier, or None if it is empty.
+        """
+        with self.lock:
+            explore = random() < self.exploration_share
+            entry = self._next(self.oldest if explore else self.best)
+            if entry is None:
+                # everything pushed so far must be on disk to be popped in order
+                self.checkpoint()
+                entry = self._next(self.oldest if explore else self.best)
+                if entry is None:
+                    return None
+
+            seq, tag = entry
+            self.popped.add(seq)
+            self.pops += 1
+            self.explorations += explore
+            self.in_progress[tag] = seq
+            self._maybe_checkpoint()
+            return tag
+
+    def done(self, tag: str) -> None:
+        """
+        Record that a popped tag has been crawled (and its battles handed to the writer): it is
+        removed from disk at the next checkpoint.
+        """
+        with self.lock:
+            self.in_progress.pop(tag, None)
+
+    def _next(self, window: deque):
+        # both windows may hold a tag already popped through the other one
+        while len(window) > 0:
+            entry = window.popleft()
+            if entry[0] not in self.popped:
+                return entry
+        return None
+
+    def _reload(self) -> None:
+        self.best = deque(self.db.execute("""
+            SELECT seq, tag FROM frontier ORDER BY score DESC, seq LIMIT ?;
+        """, (self.hot_size,)))
+        self.oldest = deque(self.db.execute("""
+            SELECT seq, tag FROM frontier ORDER BY seq LIMIT ?;
+        """, (max(self.hot_size // 10, 1),)))
+
+    def _maybe_checkpoint(self) -> None:
+        if monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """
+        Make all pops and pushes so far durable, in one transaction.
+        """
+        with self.lock:
+            if self.before_checkpoint is not None:
+                self.before_checkpoint()
+            with self.db:
+                in_progress = set(self.in_progress.values())
+                self.db.executemany('DELETE FROM frontier WHERE seq = ?;',
+                                    ((seq,) for seq in self.popped if seq not in in_progress))
+                size = self.db.execute('SELECT COUNT(*) FROM frontier;').fetchone()[0]
+                self.db.executemany("""
+                    INSERT INTO frontier (tag, score) VALUES (?, ?)
+                    ON CONFLICT (tag) DO UPDATE SET score = MAX(score, excluded.score);
+                """, self.pushed.items())
+                self.size = self.db.execute('SELECT COUNT(*) FROM frontier;').fetchone()[0]
+
+            self.duplicates += len(self.pushed) - (self.size - size)
+            self.popped = set(self.in_progress.values())
+            self.pushed = {}
+            self._reload()
+            self.last_checkpoint = monotonic()
+            self.checkpoints += 1
+
+    def close(self) -> None:
+        with self.lock:
+            self.checkpoint()
+            self.db.close()
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                'queued': len(self),
+                'in_memory': len(self.best) + len(self.oldest) + len(self.pushed),
+                'pops': self.pops,
+                'explorations': self.explorations,
+                'pushes': self.pushes,
+                'duplicates': self.duplicates,
+                'checkpoints': self.checkpoints,
+            }
+
+
+_frontier = None
+_frontier_lock = threading.Lock()
+
+
+def get_frontier() -> Frontier:
+    """
+    :return: The process-wide Frontier (checkpointed at exit).
+    """
+    global _frontier
+    with _frontier_lock:
+        if _frontier is None:
+            _frontier = Frontier()
+            atexit.register(_frontier.checkpoint)
+        return _frontier
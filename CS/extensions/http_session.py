@@ -0,0 +1,156 @@
+import threading
+from time import perf_counter
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
+
+
+# keep-alive connection pool shared by every crawler code path
+POOL_SIZE = 32  # max connections kept open per host; should be >= number of concurrent requests
+CONNECT_TIMEOUT = 5  # seconds
+READ_TIMEOUT = 30  # seconds
+
+# timings of the connection set up by the current thread (if any) during its current request
+_timing = threading.local()
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """
+    An HTTPSConnection that records how long the TCP connect and the TLS handshake took.
+    Only new connections go through connect(); reused keep-alive connections cost nothing.
+    """
+
+    def _new_conn(self):
+        start = perf_counter()
+        conn = super()._new_conn()
+        _timing.tcp = perf_counter() - start
+        return conn
+
+    def connect(self):
+        start = perf_counter()
+        super().connect()
+        _timing.connect = perf_counter() - start
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter whose HTTPS pools use TimedHTTPSConnection.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme)
+        self.poolmanager.pool_classes_by_scheme['https'] = TimedHTTPSConnectionPool
+
+
+class TimingStats:
+    """
+    Running totals of request timings, to see how much latency keep-alive saves. Thread-safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.totals = {'connect': 0.0, 'tls': 0.0, 'wait': 0.0, 'transfer': 0.0, 'total': 0.0}
+
+    def add(self, timings: dict) -> None:
+        with self.lock:
+            self.requests += 1
+            if timings.get('new_connection'):
+                self.new_connections += 1
+            for k in self.totals:
+                self.totals[k] += timings.get(k, 0.0)
+
+    def summary(self) -> dict:
+        """
+        :return: Number of requests, connection reuse ratio, and mean timings in ms.
+        """
+        with self.lock:
+            n = max(self.requests, 1)
+            res = {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reuse_ratio': 1 - self.new_connections / n,
+            }
+            for k, v in self.totals.items():
+                res['mean_{}_ms'.format(k)] = 1000 * v / n
+            return res
+
+
+stats = TimingStats()
+
+_session = None
+_session_lock = threading.Lock()
+_pool_size = POOL_SIZE
+_timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+
+def configure_session(pool_size: int = POOL_SIZE, connect_timeout: float = CONNECT_TIMEOUT,
+                      read_timeout: float = READ_TIMEOUT) -> None:
+    """
+    Set pool size and timeouts; must be called before the first request to take effect on the pool.
+    :param pool_size: Max keep-alive connections per host;
+    :param connect_timeout: Seconds to wait for a connection;
+    :param read_timeout: Seconds to wait between bytes of the response.
+    """
+    global _pool_size, _timeout
+    _pool_size = pool_size
+    _timeout = (connect_timeout, read_timeout)
+
+
+def get_session() -> requests.Session:
+    """
+    :return: The process-wide keep-alive session (created on first use).
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=_pool_size, pool_block=False)
+            _session.mount('https://', adapter)
+            _session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size))
+        return _session
+
+
+def timed_get(url: str, headers: dict = None) -> tuple:
+    """
+    A /GET through the shared session, with a per-request breakdown of where time went.
+    Raises the same exceptions as requests.get().
+    :param url: The URL;
+    :param headers: Request headers;
+    :return: A tuple (response, timings) where timings is a dictionary of seconds:
+    connect (TCP), tls (handshake), wait (until response headers), transfer (body), total;
+    connect and tls are 0 when a keep-alive connection was reused.
+    """
+    session = get_session()
+
+    _timing.tcp = 0.0
+    _timing.connect = 0.0
+
+    start = perf_counter()
+    response = session.get(url, headers=headers, timeout=_timeout)
+    _ = response.content  # read body so transfer time is included
+    total = perf_counter() - start
+
+    connect = _timing.tcp
+    tls = max(_timing.connect - _timing.tcp, 0.0)
+    headers_time = response.elapsed.total_seconds()
+
+    timings = {
+        'new_connection': _timing.connect > 0,
+        'connect': connect,
+        'tls': tls,
+        'wait': max(headers_time - connect - tls, 0.0),
+        'transfer': max(total - headers_time, 0.0),
+        'total': total,
+    }
+    stats.add(timings)
+
+    return response, timings
@@ -0,0 +1,134 @@
+import json
+import threading
+from os import environ
+from time import monotonic, sleep
+
+
+# per-key rate limit: sustained requests per second, and burst size (bucket capacity)
+RATE_PER_KEY = 10.0
+BURST_PER_KEY = 10
+
+# after a 429, a key sits out for this many seconds; doubles on consecutive 429s
+THROTTLE_COOLDOWN = 60
+MAX_THROTTLE_COOLDOWN = 3600
+
+
+class TokenBucket:
+    """
+    A token bucket for a single API key: refills at `rate` tokens per second up to `capacity`.
+    A throttled bucket hands out no tokens until `blocked_until`.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+        self.strikes = 0  # consecutive 429s
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        :return: Seconds until a token can be taken (0 if one is available now).
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class KeyScheduler:
+    """
+    Spreads API requests over every key in api_keys.json, one token bucket per key.
+    Keys are tried round-robin; a key that receives a 429 is taken out of rotation
+    for a while and comes back on its own. Thread-safe.
+    """
+
+    def __init__(self, api_keys: dict, rate: float = RATE_PER_KEY, capacity: int = BURST_PER_KEY):
+        """
+        :param api_keys: A dictionary {key name: bearer token};
+        :param rate: Requests per second allowed for each key;
+        :param capacity: Burst size for each key.
+        """
+        self.api_keys = api_keys
+        self.key_names = list(api_keys.keys())
+        self.buckets = {name: TokenBucket(rate, capacity) for name in self.key_names}
+        self.lock = threading.Lock()
+        self.next_idx = 0
+
+    def acquire(self) -> tuple:
+        """
+        Block until some key has a token available, then take it.
+        :return: A tuple (key name, bearer token).
+        """
+        while True:
+            with self.lock:
+                now = monotonic()
+                n = len(self.key_names)
+                min_wait = None
+
+                for offset in range(n):
+                    idx = (self.next_idx + offset) % n
+                    name = self.key_names[idx]
+                    bucket = self.buckets[name]
+
+                    wait = bucket.wait_time(now)
+                    if wait == 0:
+                        bucket.tokens -= 1
+                        self.next_idx = (idx + 1) % n
+                        return name, self.api_keys[name]
+
+                    if min_wait is None or wait < min_wait:
+                        min_wait = wait
+
+            sleep(min_wait)
+
+    def throttle(self, name: str) -> float:
+        """
+        Take a key out of rotation after a 429.
+        :param name: The key name;
+        :return: The cooldown in seconds.
+        """
+        with self.lock:
+            bucket = self.buckets[name]
+            bucket.strikes += 1
+            cooldown = min(THROTTLE_COOLDOWN * 2 ** (bucket.strikes - 1), MAX_THROTTLE_COOLDOWN)
+            bucket.blocked_until = monotonic() + cooldown
+            bucket.tokens = 0.0
+            return cooldown
+
+    def succeed(self, name: str) -> None:
+        """
+        Reset the consecutive-429 counter of a key after a successful request.
+        """
+        with self.lock:
+            self.buckets[name].strikes = 0
+
+    def available(self) -> int:
+        """
+        :return: Number of keys currently in rotation.
+        """
+        with self.lock:
+            now = monotonic()
+            return sum(1 for bucket in self.buckets.values() if now >= bucket.blocked_until)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_key_scheduler() -> KeyScheduler:
+    """
+    :return: The process-wide KeyScheduler, built from the keys loaded by load_api_key.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = KeyScheduler(json.loads(environ.get('API_KEYS')))
+        return _scheduler
@@ -21,8 +21,10 @@ except json.decoder.JSONDecodeError:
 key_names = list(api_keys.keys())
 if len(key_names) == 0:
     print('ERROR: No API key found in api_keys.json')
+    exit(1)
 
-# use first key available
+# every key is used by extensions/key_scheduler.py (one token bucket per key);
+# the first key is also exported as TOKEN for standalone scripts
 curr_key = key_names[0]
 
 # get bearer token
@@ -0,0 +1,99 @@
+import re
+from datetime import date, datetime
+
+
+# the battle tables are partitioned by month of battleTime, all four of them (the child
+# tables carry battleTime in their key); in foreign key order
+PARTITIONED_TABLES = ('BattleInfo', 'BattleParticipant', 'BattleData', 'ParticipantDeck')
+
+# partitions are created for the current month and this many months after it
+MONTHS_AHEAD = 3
+
+# name of the partition of a table for a month: <table>_<YYYY>_<MM> (lower case, as stored)
+PARTITION_SUFFIX = re.compile(r'_(\d{4})_(\d{2})$')
+
+# do not wait longer than this for the lock on a parent table (the crawler holds it while writing)
+LOCK_TIMEOUT = '10s'
+
+
+def month_start(d=None) -> date:
+    """
+    :param d: A date or datetime (default: now, in UTC like battleTime);
+    :return: The first day of its month.
+    """
+    d = d or datetime.utcnow()
+    return date(d.year, d.month, 1)
+
+
+def add_months(month: date, n: int) -> date:
+    i = month.year * 12 + month.month - 1 + n
+    return date(i // 12, i % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return '{}_{:%Y_%m}'.format(table.lower(), month)
+
+
+def is_partitioned(con) -> bool:
+    """
+    :return: True if the battle tables are partitioned (migration 006 applied).
+    """
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = 'battleinfo';
+        """)
+        return cur.fetchone() is not None
+
+
+def list_partitions(con, table: str) -> list:
+    """
+    :param con: A psycopg2 connection object;
+    :param table: One of PARTITIONED_TABLES;
+    :return: A list of (month, partition name) of the partitions of the table, sorted by month.
+    """
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass;
+        """, (table,))
+        partitions = []
+        for (name,) in cur.fetchall():
+            match = PARTITION_SUFFIX.search(name)
+            if match:
+                partitions.append((date(int(match.group(1)), int(match.group(2)), 1), name))
+        return sorted(partitions)
+
+
+def create_partitions(con, months_ahead: int = MONTHS_AHEAD, first_month: date = None) -> list:
+    """
+    Create the monthly partitions of every battle table that do not exist yet, from a month
+    to months_ahead months after the current one (a battle can only be stored once the
+    partition of its month exists). Does nothing if the tables are not partitioned.
+    :param con: A psycopg2 connection object (autocommit);
+    :param months_ahead: Number of months after the current one;
+    :param first_month: First month (default: the current one);
+    :return: Names of the partitions created.
+    """
+    if not is_partitioned(con):
+        return []
+
+    first_month = month_start(first_month)
+    last_month = add_months(month_start(), months_ahead)
+
+    created = []
+    with con.cursor() as cur:
+        cur.execute("SET lock_timeout = '{}';".format(LOCK_TIMEOUT))
+        month = first_month
+        while month <= last_month:
+            for table in PARTITIONED_TABLES:
+                name = partition_name(table, month)
+                cur.execute('SELECT to_regclass(%s);', (name,))
+                if cur.fetchone()[0] is None:
+                    cur.execute('CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s);'.format(name, table),
+                                (month, add_months(month, 1)))
+                    created.append(name)
+            month = add_months(month, 1)
+        cur.execute('RESET lock_timeout;')
+    return created
@@ -0,0 +1,154 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+import psycopg2
+
+
+# a player refreshed less than this many seconds ago is not re-fetched
+PLAYER_INFO_TTL = 6 * 3600
+
+# max number of players whose refresh time is kept in memory (least recently used are evicted)
+PLAYER_CACHE_SIZE = 500000
+
+
+class PlayerInfoCache:
+    """
+    Remembers when each player's PlayerInfo row was last refreshed, so that players seen
+    again within the TTL are not re-fetched from the API.
+    Two tiers: a bounded LRU dictionary in memory, backed by PlayerInfo.lastRefreshed in the DB.
+    A refresh that finds the player unchanged is only remembered in memory (the identical row is
+    not rewritten, see batch_writer.upsert_rows()): lastRefreshed is when the row last changed,
+    so such a player may be fetched again once after a restart or an eviction.
+    A player is only marked refreshed once their row is buffered for writing; stale_tags() can
+    claim the players it returns as pending meanwhile, so that concurrent callers do not fetch
+    them twice (release() them if the refresh fails).
+    Thread-safe.
+    """
+
+    def __init__(self, ttl: float = PLAYER_INFO_TTL, max_size: int = PLAYER_CACHE_SIZE):
+        """
+        :param ttl: Seconds a refresh stays valid;
+        :param max_size: Max number of players kept in memory.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.expiry = OrderedDict()  # player tag -> epoch time the refresh expires
+        self.pending = set()  # player tags claimed by stale_tags(), not refreshed yet
+        self.lock = threading.Lock()
+
+        # counters for reporting
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _remember(self, tag: str, expires: float) -> None:
+        self.expiry[tag] = expires
+        self.expiry.move_to_end(tag)
+        while len(self.expiry) > self.max_size:
+            self.expiry.popitem(last=False)
+
+    def mark(self, tag: str) -> None:
+        """
+        Record that a player was just refreshed.
+        """
+        with self.lock:
+            self._remember(tag, time() + self.ttl)
+            self.pending.discard(tag)
+
+    def release(self, tag: str) -> None:
+        """
+        Record that the refresh of a claimed player failed (they are stale again).
+        """
+        with self.lock:
+            self.pending.discard(tag)
+
+    def stale_tags(self, con, tags: list, claim: bool = False) -> list:
+        """
+        Filter a list of player tags down to those that need a refresh.
+        Tags not in memory are looked up in the DB with a single query.
+        :param con: A psycopg2 connection object;
+        :param tags: A list of player tags;
+        :param claim: If True, the returned players are pending until mark() or release();
+        :return: The sublist of tags whose PlayerInfo is missing or older than the TTL (and that
+        are not pending).
+        """
+        now = time()
+        unknown = []
+
+        with self.lock:
+            for tag in tags:
+                expires = self.expiry.get(tag)
+                if tag in self.pending:
+                    self.memory_hits += 1
+                elif expires is not None and expires > now:
+                    self.expiry.move_to_end(tag)
+                    self.memory_hits += 1
+                else:
+                    unknown.append(tag)
+
+        if len(unknown) == 0:
+            return []
+
+        fresh = {}
+        try:
+            with con.cursor() as cur:
+                cur.execute("""
+                    SELECT playerTag, EXTRACT(EPOCH FROM (NOW() - lastRefreshed))
+                    FROM PlayerInfo
+                    WHERE playerTag = ANY(%s) AND lastRefreshed > NOW() - %s * INTERVAL '1 second';
+                """, (unknown, self.ttl))
+                for tag, age in cur.fetchall():
+                    fresh[tag] = float(age)
+        except psycopg2.Error:
+            # fall back to refreshing everything not known in memory
+            con.rollback()
+
+        stale = []
+        with self.lock:
+            for tag in unknown:
+                age = fresh.get(tag)
+                if age is not None:
+                    self._remember(tag, now + self.ttl - age)
+                    self.db_hits += 1
+                elif tag in self.pending:
+                    self.memory_hits += 1  # claimed by another caller meanwhile
+                else:
+                    stale.append(tag)
+                    self.misses += 1
+                    if claim:
+                        self.pending.add(tag)
+
+        return stale
+
+    def summary(self) -> dict:
+        """
+        :return: Hit counts; every hit is one player_info API call saved.
+        """
+        with self.lock:
+            saved = self.memory_hits + self.db_hits
+            total = saved + self.misses
+            return {
+                'api_calls_saved': saved,
+                'memory_hits': self.memory_hits,
+                'db_hits': self.db_hits,
+                'refreshed': self.misses,
+                'hit_ratio': saved / total if total > 0 else 0.0,
+                'cached_players': len(self.expiry),
+                'pending': len(self.pending),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_player_cache() -> PlayerInfoCache:
+    """
+    :return: The process-wide PlayerInfoCache.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PlayerInfoCache()
+        return _cache
@@ -0,0 +1,84 @@
+import random
+
+
+# width of a trophy range; must match the index expression of Player_trophyRange (trophies / 1000)
+TROPHY_RANGE = 1000
+
+# give up after this many lookup rounds (only matters when few keys are left unused)
+MAX_ROUNDS = 8
+
+
+def _uniform(cur, n: int) -> list:
+    # random keys in [1, max playerId]; keys lost to gaps are made up for in the next round
+    cur.execute('SELECT MAX(playerId) FROM Player;')
+    max_id = cur.fetchone()[0]
+    if max_id is None:
+        return []
+
+    found = {}  # player tag -> None (keeps order)
+    hit_ratio = 1.0
+    for _ in range(MAX_ROUNDS):
+        need = n - len(found)
+        if need <= 0:
+            break
+        k = min(max_id, int(need / max(hit_ratio, 0.05)) + 1)
+        cur.execute('SELECT playerTag FROM Player WHERE playerId = ANY(%s);',
+                    (random.sample(range(1, max_id + 1), k),))
+        rows = cur.fetchall()
+        hit_ratio = len(rows) / k
+        found.update((tag, None) for (tag,) in rows)
+
+    return list(found)[:n]
+
+
+def _in_range(cur, n: int, trophy_range: int) -> list:
+    # random keys between the lowest and highest playerId of the range; each one is
+    # resolved to the next player of the range (an index seek on Player_trophyRange)
+    cur.execute('SELECT MIN(playerId), MAX(playerId) FROM Player WHERE trophies / 1000 = %s;', (trophy_range,))
+    min_id, max_id = cur.fetchone()
+    if min_id is None:
+        return []
+
+    found = {}
+    for _ in range(MAX_ROUNDS):
+        need = n - len(found)
+        if need <= 0:
+            break
+        k = min(max_id - min_id + 1, 2 * need)
+        cur.execute("""
+            SELECT s.playerTag
+            FROM unnest(%s::int4[]) AS r (id)
+            CROSS JOIN LATERAL (
+                SELECT playerTag FROM Player
+                WHERE trophies / 1000 = %s AND playerId >= r.id
+                ORDER BY trophies / 1000, playerId
+                LIMIT 1
+            ) s;
+        """, (random.sample(range(min_id, max_id + 1), k), trophy_range))
+        found.update((tag, None) for (tag,) in cur.fetchall())
+
+    return list(found)[:n]
+
+
+def sample_players(con, n: int, weights: dict = None) -> list:
+    """
+    Draw distinct random players from table Player by looking up random playerIds, so the
+    cost depends on n only, not on the size of the DB.
+    :param con: A psycopg2 connection object;
+    :param n: Number of players wanted;
+    :param weights: Optional {trophy range (trophies // TROPHY_RANGE): weight}; if given,
+    players are drawn from these ranges only, n being split between them in proportion to
+    the weights (stratified sample); within a range, players that follow a long run of
+    other-range keys are somewhat more likely;
+    :return: A list of at most n distinct player tags (fewer if the DB has fewer players).
+    """
+    with con.cursor() as cur:
+        if weights is None:
+            return _uniform(cur, n)
+
+        total = sum(weights.values())
+        tags = []
+        for trophy_range, weight in weights.items():
+            if weight > 0:
+                tags.extend(_in_range(cur, round(n * weight / total), trophy_range))
+        return tags
@@ -0,0 +1,311 @@
+import atexit
+import sqlite3
+import threading
+from datetime import datetime
+from time import time, monotonic
+
+from extensions.battle_dedup import API_TIME_FORMAT
+
+
+# a battle log holds at most this many battles: the most a request can yield
+LOG_SIZE = 25
+
+# players are grouped by trophy range to estimate players never crawled
+TROPHY_BRACKET = 1000
+
+# weight of the newest observation in the running (exponentially weighted) averages
+EWMA_WEIGHT = 0.3
+
+# starting estimates before anything is observed
+PRIOR_FIRST_YIELD = 20.0  # new battles in a player's first crawl
+PRIOR_BATTLES_PER_DAY = 5.0
+
+# revisit intervals adapt so that a visit finds about this many new battles
+# (well below LOG_SIZE, so that battles rarely fall off the log between two visits)
+TARGET_NEW_BATTLES = 10
+MIN_REVISIT_INTERVAL = 15 * 60  # seconds
+MAX_REVISIT_INTERVAL = 7 * 86400
+
+# observations are committed to disk at least this often (seconds), once before_commit succeeded
+COMMIT_INTERVAL = 30
+
+# sqlite limits the number of host parameters per statement
+MAX_PARAMS = 900
+
+
+def parse_battle_time(battle_time: str):
+    """
+    :param battle_time: A battleTime as given by the API;
+    :return: Seconds since the epoch, or None.
+    """
+    try:
+        return (datetime.strptime(battle_time, API_TIME_FORMAT) - datetime(1970, 1, 1)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+class YieldModel:
+    """
+    Estimates how many new battles a battle_log request for a player will return, so that
+    the crawler can fetch the most productive players first (see Frontier).
+    Per crawled player, it keeps the newest battleTime seen, an activity estimate (battles
+    per day, from the spacing of battles in their log) and their trophies, in a local SQLite
+    table. A crawled player is expected to have played activity * time since their newest
+    seen battle new battles (at most LOG_SIZE). A player never crawled is expected to yield
+    what first crawls of players in their trophy bracket yielded on average.
+    It is also the per-player battle log sync state: the newest battleTime seen is a
+    high-water mark (battles at or before it were already processed and are dropped by
+    unseen() before any work), and each player has a revisit interval that shrinks when a
+    visit finds more than TARGET_NEW_BATTLES new battles and grows when it finds fewer;
+    is_due() tells whether a player may be requested again.
+    A high-water mark must not get ahead of the battles it covers (they would never be
+    crawled again): observe() is called once the new battles are buffered for writing, and
+    before_commit (e.g., flushing the BatchWriter) is called before every commit.
+    Also counts new battles per request, the figure this is meant to raise.
+    Thread-safe.
+    """
+
+    def __init__(self, path: str = 'player_stats.db', before_commit=None):
+        """
+        :param path: Path of the SQLite file (created if missing);
+        :param before_commit: Function called (without arguments) before every commit, to store the
+        battles of the observed requests first; if it raises, nothing is committed.
+        """
+        self.before_commit = before_commit
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL;')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS player_stats (
+                tag TEXT PRIMARY KEY,
+                lastBattleTime REAL,  -- newest battleTime seen (epoch seconds)
+                lastCrawled REAL,
+                battlesPerDay REAL,
+                trophies INTEGER,
+                revisitInterval REAL,  -- seconds
+                nextVisit REAL
+            );
+        """)
+        # files written before revisit intervals were kept
+        cols = [col[1] for col in self.db.execute('PRAGMA table_info(player_stats);')]
+        for col in ('revisitInterval', 'nextVisit'):
+            if col not in cols:
+                self.db.execute('ALTER TABLE player_stats ADD COLUMN {} REAL;'.format(col))
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS bracket_stats (
+                bracket INTEGER PRIMARY KEY,  -- -1 for unknown trophies
+                firstYield REAL,
+                battlesPerDay REAL
+            );
+        """)
+        self.db.commit()
+        self.last_commit = monotonic()
+
+        self.brackets = {bracket: [first_yield, rate] for bracket, first_yield, rate
+                         in self.db.execute('SELECT bracket, firstYield, battlesPerDay FROM bracket_stats;')}
+
+        # counters for reporting
+        self.requests = 0
+        self.new_battles = 0
+        self.first_requests = 0
+        self.first_new_battles = 0
+        self.not_due = 0
+        self.dropped_battles = 0
+
+    @staticmethod
+    def bracket(trophies) -> int:
+        return trophies // TROPHY_BRACKET if trophies is not None else -1
+
+    def _bracket_stats(self, bracket: int) -> list:
+        stats = self.brackets.get(bracket)
+        if stats is None:
+            stats = self.brackets.get(-1) or [PRIOR_FIRST_YIELD, PRIOR_BATTLES_PER_DAY]
+            stats = self.brackets[bracket] = list(stats)
+        return stats
+
+    def _lookup(self, tags: list) -> dict:
+        rows = {}
+        for i in range(0, len(tags), MAX_PARAMS):
+            chunk = tags[i:i + MAX_PARAMS]
+            rows.update((row[0], row[1:]) for row in self.db.execute("""
+                SELECT tag, lastBattleTime, battlesPerDay, trophies, revisitInterval, nextVisit
+                FROM player_stats WHERE tag IN ({});
+            """.format(', '.join('?' * len(chunk))), chunk))
+        return rows
+
+    def score(self, tags: list, trophies: dict = None) -> list:
+        """
+        :param tags: A list of player tags;
+        :param trophies: Optional player tag -> trophies, for players never crawled;
+        :return: Expected number of new battles of a battle_log request, for every tag.
+        """
+        trophies = trophies or {}
+        now = time()
+
+        with self.lock:
+            known = self._lookup(list(set(tags)))
+            scores = []
+            for tag in tags:
+                row = known.get(tag)
+                if row is None:
+                    scores.append(self._bracket_stats(self.bracket(trophies.get(tag)))[0])
+                    continue
+
+                last_battle_time, rate, player_trophies = row[:3]
+                if rate is None:
+                    rate = self._bracket_stats(self.bracket(player_trophies))[1]
+                if last_battle_time is None:
+                    scores.append(0.0)  # empty battle log last time
+                else:
+                    days = max(now - last_battle_time, 0) / 86400
+                    scores.append(min(float(LOG_SIZE), rate * days))
+            return scores
+
+    def is_due(self, tag: str) -> bool:
+        """
+        :param tag: A player tag;
+        :return: False if the player was crawled less than their revisit interval ago.
+        """
+        with self.lock:
+            row = self._lookup([tag]).get(tag)
+            if row is not None and row[4] is not None and row[4] > time():
+                self.not_due += 1
+                return False
+            return True
+
+    def unseen(self, tag: str, battle_log: list) -> list:
+        """
+        Drop the battles of a battle log that are at or before the player's high-water mark.
+        :param tag: A player tag;
+        :param battle_log: A list of battles (dict) from a battle_log request;
+        :return: The battles newer than any seen in earlier requests for this player.
+        """
+        with self.lock:
+            row = self._lookup([tag]).get(tag)
+        if row is None or row[0] is None:
+            return battle_log
+
+        mark = row[0]
+        battles = []
+        for battle in battle_log:
+            battle_time = parse_battle_time(battle.get('battleTime'))
+            if battle_time is None or battle_time > mark:
+                battles.append(battle)
+
+        with self.lock:
+            self.dropped_battles += len(battle_log) - len(battles)
+        return battles
+
+    def observe(self, tag: str, battle_log: list, new_battles: int) -> None:
+        """
+        Record the outcome of a battle_log request: moves the player's high-water mark and
+        sets their next visit. Call it once the new battles are buffered for writing.
+        :param tag: The player tag;
+        :param battle_log: The battles returned (a list of dict), including those dropped by unseen();
+        :param new_battles: How many of them were not stored yet.
+        """
+        times = sorted(t for t in (parse_battle_time(battle.get('battleTime')) for battle in battle_log)
+                       if t is not None)
+
+        # the player's trophies before their newest battle
+        trophies = None
+        for battle in battle_log:
+            for player in battle.get('team') or []:
+                if player.get('tag') == tag and player.get('startingTrophies') is not None:
+                    trophies = player.get('startingTrophies')
+                    break
+            if trophies is not None:
+                break
+
+        # activity from the spacing of the battles in the log (at least an hour apart overall)
+        rate = None
+        if len(times) >= 2:
+            rate = (len(times) - 1) / max((times[-1] - times[0]) / 86400, 1 / 24)
+
+        with self.lock:
+            self.requests += 1
+            self.new_battles += new_battles
+
+            row = self._lookup([tag]).get(tag)
+            if row is None:
+                self.first_requests += 1
+                self.first_new_battles += new_battles
+                stats = self._bracket_stats(self.bracket(trophies))
+                stats[0] += EWMA_WEIGHT * (new_battles - stats[0])
+                if rate is not None:
+                    stats[1] += EWMA_WEIGHT * (rate - stats[1])
+                last_battle_time = times[-1] if len(times) > 0 else None
+
+                # first interval: the time this player takes to play TARGET_NEW_BATTLES battles
+                interval = TARGET_NEW_BATTLES / (rate or stats[1]) * 86400
+            else:
+                old_last, old_rate, old_trophies, interval = row[:4]
+                if old_rate is not None and rate is not None:
+                    rate = old_rate + EWMA_WEIGHT * (rate - old_rate)
+                elif rate is None:
+                    rate = old_rate
+                trophies = trophies if trophies is not None else old_trophies
+                last_battle_time = max([t for t in (old_last, times[-1] if len(times) > 0 else None)
+                                        if t is not None], default=None)
+
+                # more new battles than targeted: come back sooner (at most twice as soon), and vice versa
+                if interval is None:
+                    interval = TARGET_NEW_BATTLES / (rate or PRIOR_BATTLES_PER_DAY) * 86400
+                interval *= min(max(TARGET_NEW_BATTLES / max(new_battles, 1), 0.5), 2)
+
+            interval = min(max(interval, MIN_REVISIT_INTERVAL), MAX_REVISIT_INTERVAL)
+            now = time()
+
+            self.db.execute("""
+                INSERT OR REPLACE INTO player_stats
+                (tag, lastBattleTime, lastCrawled, battlesPerDay, trophies, revisitInterval, nextVisit)
+                VALUES (?, ?, ?, ?, ?, ?, ?);
+            """, (tag, last_battle_time, now, rate, trophies, interval, now + interval))
+
+            if monotonic() - self.last_commit >= COMMIT_INTERVAL:
+                self.commit()
+
+    def commit(self) -> None:
+        """
+        Write pending observations and the bracket averages to disk.
+        """
+        with self.lock:
+            if self.before_commit is not None:
+                self.before_commit()
+            self.db.executemany('INSERT OR REPLACE INTO bracket_stats VALUES (?, ?, ?);',
+                                ((bracket, first_yield, rate) for bracket, (first_yield, rate) in self.brackets.items()))
+            self.db.commit()
+            self.last_commit = monotonic()
+
+    def summary(self) -> dict:
+        """
+        :return: New battles per battle_log request, overall and for first crawls, and the
+        requests and battles saved by revisit intervals and high-water marks.
+        """
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'new_battles': self.new_battles,
+                'new_per_request': self.new_battles / self.requests if self.requests > 0 else 0.0,
+                'new_per_first_request': (self.first_new_battles / self.first_requests
+                                          if self.first_requests > 0 else 0.0),
+                'skipped_not_due': self.not_due,
+                'dropped_battles': self.dropped_battles,
+            }
+
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_yield_model() -> YieldModel:
+    """
+    :return: The process-wide YieldModel (committed at exit).
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = YieldModel()
+            atexit.register(_model.commit)
+        return _model
@@ -1,17 +1,27 @@
 import sys
-import requests
-import json
 import smtplib
 import ssl
+import threading
 from datetime import datetime
 from urllib.parse import quote_plus
-from time import sleep
-from os import environ
-from os.path import dirname, isfile
+from time import sleep, monotonic
+from os.path import dirname
+
+from extensions.key_scheduler import get_key_scheduler
+from extensions.http_session import timed_get
+from extensions.banned_index import get_banned_index
 
 
 # A collection of globally-shared helper functions
 
+# a throttled (429) request is retried with the keys still in rotation at most this many times
+MAX_THROTTLE_RETRIES = 5
+
+# the admin is emailed when every key is throttled, at most once per cooldown
+_throttle_alert_until = 0.0
+_throttle_alert_lock = threading.Lock()
+
+
 def init_log():
     """
     Open (create if does not exist) a log file named data_collection.log;
@@ -64,6 +74,20 @@ def email_admin(status_code, message):
             status_code, message))
 
 
+def alert_throttled(message, cooldown):
+    """
+    Email admin that every API key is throttled, unless already done within the last cooldown
+    (email_admin() logs in to the SMTP server: not on every 429).
+    """
+    global _throttle_alert_until
+    with _throttle_alert_lock:
+        now = monotonic()
+        if now < _throttle_alert_until:
+            return
+        _throttle_alert_until = now + cooldown
+    email_admin(429, message)
+
+
 def cr_api_request(tag: str, action: str, i: int = 0) -> dict:
     """
     A function to send a /GET request to Clash Royale API with comprehensive error handling.
@@ -77,24 +101,10 @@ def cr_api_request(tag: str, action: str, i: int = 0) -> dict:
     # prep
     url = 'https://api.clashroyale.com/v1/'
 
-    bannedTags = None
-
     if action == 'battle_log':
         url += 'players/' + quote_plus(tag) + '/battlelog'
     elif action == 'player_info':
         url += 'players/' + quote_plus(tag)
-        if isfile('banned'):
-            fh = open('banned')
-            bannedTags = set()
-            for bannedTag in fh:
-                bannedTags.add(bannedTag.strip())
-            fh.close()
-            # skip if it's a known banned tag
-            if tag in bannedTags:
-                return {'statusCode': 404, 'body': {"reason":"notFound"}}
-        else:
-            fh = open('banned', 'w')
-            fh.close()
     elif action == 'clan_members':
         url += 'clans/' + quote_plus(tag) + '/members'
     elif action == 'player_rankings':
@@ -103,70 +113,69 @@ def cr_api_request(tag: str, action: str, i: int = 0) -> dict:
         log('action = [battle_log | player_info | clan_members | player_rankings]')
         exit(1)
 
-    token = environ.get('TOKEN')
-    headers = {'Authorization': 'Bearer ' + token}
+    # skip known banned (not found) players without spending quota
+    if action in ('battle_log', 'player_info') and tag in get_banned_index():
+        return {'statusCode': 404, 'body': {'reason': 'notFound'}}
+
+    scheduler = get_key_scheduler()
+    for _ in range(1 + MAX_THROTTLE_RETRIES):
+        # take a token from whichever key has rate budget left
+        # (blocks until a key is back in rotation if all are throttled)
+        key_name, token = scheduler.acquire()
+        headers = {'Authorization': 'Bearer ' + token}
+
+        # request
+        try:
+            # pooled keep-alive session shared by all code paths
+            response, timings = timed_get(url, headers=headers)
+        except:
+            message = '/GET request failed; URL = {}; Bearer Token = {}.'.format(
+                url, token)
+            email_admin(500, message)
+            return {'statusCode': 500, 'body': {'message': message}}
+
+        status_code = response.status_code
+
+        log('Response {} in {:.1f} ms (connect {:.1f}, tls {:.1f}, wait {:.1f}, transfer {:.1f})'.format(
+            status_code, *(1000 * timings[k] for k in ('total', 'connect', 'tls', 'wait', 'transfer'))))
+
+        try:
+            res = response.json()
+        except:
+            email_admin(
+                400, "response.json() failed, tag = {}, action = {}".format(tag, action))
+            return {'statusCode': 400, 'body': {}}
 
-    # request
-    try:
-        response = requests.get(url, headers=headers)
-    except:
-        message = '/GET request failed; URL = {}; Bearer Token = {}.'.format(
-            url, token)
-        email_admin(500, message)
-        return {'statusCode': 500, 'body': {'message': message}}
+        if status_code != 429:
+            break
 
-    status_code = response.status_code
+        # request throttled: amount of requests exceeded threshold defined for API token
+        # take this key out of rotation for a while & retry with the other keys
+        cooldown = scheduler.throttle(key_name)
+        available = scheduler.available()
 
-    try:
-        res = response.json()
-    except:
-        email_admin(
-            400, "response.json() failed, tag = {}, action = {}".format(tag, action))
-        return {'statusCode': 400, 'body': {}}
+        message = 'Key "{}" throttled; out of rotation for {} seconds. Keys in rotation: {}/{}.'.format(
+            key_name, cooldown, available, len(scheduler.key_names))
+        log(message)
+        if available == 0:
+            alert_throttled(message, cooldown)
 
     # handle error responses
     if status_code == 200:
-        pass
+        scheduler.succeed(key_name)
 
     elif status_code == 403:
         # Fatal: IP address changed, need new key
         email_admin(403, str(res))
         exit(1)
 
-    elif status_code == 404 and action == 'player_info':
+    elif status_code == 404 and action in ('battle_log', 'player_info'):
         # player not found (likely banned)
-        fh = open('banned', 'a')
-        fh.write(tag + '\n')
-        fh.close()
+        get_banned_index().add(tag)
     elif status_code == 429:
-        # request throttled: amount of requests exceeded threshold defined for API token
-        # switch to another api key & notify admin
-        api_keys = json.loads(environ.get('API_KEYS'))
-        curr_key = environ.get('CURR_KEY')
-        key_names = list(api_keys.keys())
-        curr_key_idx = key_names.index(curr_key)
-
-        if curr_key_idx >= len(api_keys) - 1:
-            # email admin: used up all keys, require immediate action
-            message = 'Used up all API keys. Program terminated. Immediate action required: Create new tokens and update api_keys.json'
-            email_admin(429, message)
-            exit(1)  # terminate program because it is a critical failure
-        else:
-            # use next available key
-            next_key = key_names[curr_key_idx + 1]
-            token = str(api_keys.get(next_key))
-
-            # update environment variables
-            environ['CURR_KEY'] = next_key
-            environ['TOKEN'] = token
-
-            # email admin: using next available key
-            message = 'Current key "{}" obsolete. Retrying request with next available key in api_keys.json: "{}"'.format(
-                curr_key, next_key)
-            email_admin(429, message)
-
-            # retry request with new token
-            cr_api_request(tag, action)
+        # still throttled after every retry: the caller gets the 429
+        log('cr_api_request() gave up after {} throttled attempts, tag = {}, action = {}'.format(
+            1 + MAX_THROTTLE_RETRIES, tag, action))
 
     elif status_code == 503:
         # service temprorarily unavailable due to maintenance
@@ -1,14 +1,57 @@
 #!/usr/bin/python3
 
-from helpers import init_log
+from helpers import init_log, log, email_admin
 from data_collection import collect_data
+from extensions.connect_db import DBConnection
+from extensions.partitions import create_partitions
+from async_collection import collect_data_async, CONCURRENCY
+import pipeline
 
 import os
+import argparse
+
+import psycopg2
 
 pidFile = open("main.pid", "w")
 pidFile.write(str(os.getpid()))
 pidFile.close()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clash Royale data collection (crawler).')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='crawl with concurrent API requests')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help='number of API requests in flight in async mode (default: {})'.format(CONCURRENCY))
+    parser.add_argument('--pipeline', action='store_true',
+                        help='crawl with separate fetch, transform and write stages')
+    parser.add_argument('--fetchers', type=int, default=pipeline.FETCHERS,
+                        help='battle log fetcher threads in pipeline mode (default: {})'.format(pipeline.FETCHERS))
+    parser.add_argument('--player-fetchers', type=int, default=pipeline.PLAYER_FETCHERS,
+                        help='player info fetcher threads in pipeline mode (default: {})'.format(pipeline.PLAYER_FETCHERS))
+    parser.add_argument('--transformers', type=int, default=pipeline.TRANSFORMERS,
+                        help='transform threads in pipeline mode (default: {})'.format(pipeline.TRANSFORMERS))
+    parser.add_argument('--writers', type=int, default=pipeline.WRITERS,
+                        help='DB writer threads in pipeline mode (default: {})'.format(pipeline.WRITERS))
+    parser.add_argument('--queue-size', type=int, default=pipeline.QUEUE_SIZE,
+                        help='capacity of each queue in pipeline mode (default: {})'.format(pipeline.QUEUE_SIZE))
+    args = parser.parse_args()
+
     init_log()
-    collect_data()
+
+    # battles can only be stored once the partition of their month exists
+    con = DBConnection().get_con()
+    try:
+        created = create_partitions(con)
+        if len(created) > 0:
+            log('Created partitions: {}'.format(', '.join(created)))
+    except psycopg2.Error as e:
+        email_admin(400, 'ERROR: Create partitions: {}.'.format(str(e).strip()))
+    con.close()
+
+    if args.pipeline:
+        pipeline.collect_data_pipeline(args.fetchers, args.player_fetchers, args.transformers,
+                                       args.writers, args.queue_size)
+    elif args.use_async:
+        collect_data_async(args.concurrency)
+    else:
+        collect_data()
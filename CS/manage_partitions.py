@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+from os.path import join
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from extensions.connect_db import DBConnection
+from extensions.partitions import (PARTITIONED_TABLES, MONTHS_AHEAD, LOCK_TIMEOUT, month_start, add_months,
+                                   partition_name, is_partitioned, list_partitions, create_partitions)
+from helpers import log
+
+
+# the purpose of this script is to maintain the monthly partitions of the battle tables
+# (migrations/006_partition_battle_tables.sql): create those of the coming months, and move
+# the partitions of old months out of the DB into compressed columnar (Parquet) files
+
+ARCHIVE_DIR = 'archive'
+
+# archive the partitions of months older than this many months (the current one included)
+KEEP_MONTHS = 12
+
+# rows fetched and written per chunk while archiving a partition
+ARCHIVE_CHUNK = 100000
+
+# Parquet type of each column type of the battle tables
+ARROW_TYPES = {
+    'bytea': pa.binary(),
+    'timestamp without time zone': pa.timestamp('us'),
+    'boolean': pa.bool_(),
+    'smallint': pa.int16(),
+    'integer': pa.int32(),
+    'bigint': pa.int64(),
+    'smallint[]': pa.list_(pa.int16()),
+    'integer[]': pa.list_(pa.int32()),
+    'character': pa.string(),
+    'character varying': pa.string(),
+    'text': pa.string(),
+}
+
+
+def table_schema(cur, table: str) -> pa.Schema:
+    """
+    :return: The Parquet schema of a table (columns in table order).
+    """
+    cur.execute("""
+        SELECT attname, format_type(atttypid, NULL)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum;
+    """, (table,))
+    return pa.schema([(name, ARROW_TYPES[pg_type]) for name, pg_type in cur.fetchall()])
+
+
+def export_table(con, table: str, path: str) -> int:
+    """
+    Write every row of a table to a zstd-compressed Parquet file, chunk by chunk (the file
+    only takes its final name once complete).
+    :param con: A psycopg2 connection object;
+    :param table: Name of the table;
+    :param path: Path of the Parquet file;
+    :return: Number of rows written.
+    """
+    tmp_path = path + '.tmp'
+    rows_written = 0
+
+    con.autocommit = False
+    try:
+        with con.cursor() as cur:
+            schema = table_schema(cur, table)
+        binary = [i for i, field in enumerate(schema) if field.type == pa.binary()]
+
+        # server-side cursor: the partition is never held in memory as a whole
+        with con.cursor(name='archive_' + table) as cur, \
+                pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+            cur.itersize = ARCHIVE_CHUNK
+            cur.execute('SELECT * FROM {};'.format(table))
+            while True:
+                rows = cur.fetchmany(ARCHIVE_CHUNK)
+                if len(rows) == 0:
+                    break
+                columns = [list(col) for col in zip(*rows)]
+                for i in binary:
+                    columns[i] = [bytes(value) if value is not None else None for value in columns[i]]
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema))
+                rows_written += len(rows)
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    finally:
+        con.autocommit = True
+
+    os.replace(tmp_path, path)
+    return rows_written
+
+
+def detach_month(con, month) -> list:
+    """
+    Detach the partitions of a month from the battle tables, in one transaction (tables that
+    reference another first); the detached tables lose their foreign keys, so that each one
+    can then be archived and dropped on its own.
+    :return: Names of the partitions detached.
+    """
+    detached = []
+    con.autocommit = False
+    try:
+        with con.cursor() as cur:
+            cur.execute("SET LOCAL lock_timeout = '{}';".format(LOCK_TIMEOUT))
+            for table in reversed(PARTITIONED_TABLES):
+                name = partition_name(table, month)
+                if (month, name) not in list_partitions(con, table):
+                    continue
+                cur.execute('ALTER TABLE {} DETACH PARTITION {};'.format(table, name))
+                cur.execute("""
+                    SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f';
+                """, (name,))
+                for (constraint,) in cur.fetchall():
+                    cur.execute('ALTER TABLE {} DROP CONSTRAINT {};'.format(name, constraint))
+                detached.append(name)
+        con.commit()
+    except psycopg2.Error:
+        con.rollback()
+        raise
+    finally:
+        con.autocommit = True
+    return detached
+
+
+def detached_tables(con) -> list:
+    """
+    :return: Names of partitions that were detached but not archived yet (an interrupted run).
+    """
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT relname FROM pg_class
+            WHERE relkind = 'r' AND NOT relispartition AND relname ~ %s
+            ORDER BY relname;
+        """, ('^({})_[0-9]{{4}}_[0-9]{{2}}$'.format('|'.join(table.lower() for table in PARTITIONED_TABLES)),))
+        return [name for (name,) in cur.fetchall()]
+
+
+def archive_table(con, name: str, archive_dir: str) -> None:
+    """
+    Export a detached partition to <archive_dir>/<name>.parquet, check the row count, drop it.
+    """
+    path = join(archive_dir, name + '.parquet')
+    rows = export_table(con, name, path)
+    if pq.ParquetFile(path).metadata.num_rows != rows:
+        raise RuntimeError('{}: {} rows in the file, {} exported'.format(path, pq.ParquetFile(path).metadata.num_rows, rows))
+
+    with con.cursor() as cur:
+        cur.execute('DROP TABLE {};'.format(name))
+    log('Archived {} ({} rows) to {}'.format(name, rows, path))
+
+
+def archive(con, keep_months: int = KEEP_MONTHS, archive_dir: str = ARCHIVE_DIR) -> None:
+    """
+    Move the partitions of months older than keep_months out of the DB into Parquet files.
+    :param con: A psycopg2 connection object (autocommit);
+    :param keep_months: Number of months kept in the DB, the current one included;
+    :param archive_dir: Directory of the Parquet files.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff = add_months(month_start(), 1 - keep_months)
+
+    # left over by an interrupted run
+    for name in detached_tables(con):
+        archive_table(con, name, archive_dir)
+
+    months = sorted({month for month, name in list_partitions(con, PARTITIONED_TABLES[0]) if month < cutoff})
+    for month in months:
+        for name in detach_month(con, month):
+            archive_table(con, name, archive_dir)
+
+
+def show(con) -> None:
+    with con.cursor() as cur:
+        for table in PARTITIONED_TABLES:
+            for month, name in list_partitions(con, table):
+                cur.execute('SELECT pg_total_relation_size(%s), reltuples::int8 FROM pg_class WHERE oid = %s::regclass;',
+                            (name, name))
+                size, rows = cur.fetchone()
+                log('{:30} {:>12} rows (estimate) {:>10.1f} MB'.format(name, max(rows, 0), size / 2 ** 20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create and archive the monthly partitions of the battle tables.')
+    parser.add_argument('--ahead', type=int, default=MONTHS_AHEAD,
+                        help='create partitions up to this many months ahead (default: {})'.format(MONTHS_AHEAD))
+    parser.add_argument('--archive', action='store_true',
+                        help='archive the partitions of old months to Parquet files and drop them')
+    parser.add_argument('--keep-months', type=int, default=KEEP_MONTHS,
+                        help='with --archive: months kept in the DB, the current one included (default: {})'.format(KEEP_MONTHS))
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR,
+                        help='with --archive: directory of the Parquet files (default: {})'.format(ARCHIVE_DIR))
+    parser.add_argument('--list', action='store_true', help='list the partitions with their sizes')
+    args = parser.parse_args()
+
+    con = DBConnection().get_con()
+
+    if not is_partitioned(con):
+        log('ERROR: the battle tables are not partitioned (run python migrate.py first)')
+        exit(1)
+
+    if args.list:
+        show(con)
+        exit(0)
+
+    created = create_partitions(con, args.ahead)
+    log('Created {} partitions{}'.format(len(created), ': ' + ', '.join(created) if len(created) > 0 else ''))
+
+    if args.archive:
+        archive(con, args.keep_months, args.archive_dir)
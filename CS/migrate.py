@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+
+import argparse
+import re
+from datetime import datetime
+from os import listdir
+from os.path import dirname, join
+from time import time
+
+import psycopg2
+
+from extensions.connect_db import DBConnection
+from helpers import log
+
+
+# the purpose of this script is to bring an existing DB up to date with the schema changes
+# in migrations/ (NNN_description.sql, applied in order of NNN, each one once), and to check
+# that the crawler and analysis queries use the indexes those changes create
+
+MIGRATIONS_DIR = join(dirname(__file__), 'migrations')
+
+# first line of a migration that must run outside a transaction (e.g., CREATE INDEX CONCURRENTLY);
+# its statements are then run one by one, in autocommit mode
+NO_TRANSACTION = '-- migrate: no-transaction'
+
+# queries the crawler and the analyses run often, with the index each one must use (or
+# alternatives, separated by |; on a partitioned table, the partitions' copies count)
+CHECKED_QUERIES = [
+    ('get_last_playertag()', 'BattleInfo_battleTime', """
+        SELECT playerTag FROM BattleParticipant JOIN (
+            SELECT battleId, battleTime FROM BattleInfo ORDER BY battleTime DESC LIMIT 1
+        ) last USING (battleId, battleTime) LIMIT 1;
+    """, None),
+    ('battles in a time range', 'BattleInfo_battleTime', """
+        SELECT battleId FROM BattleInfo WHERE battleTime >= NOW() - INTERVAL '1 day';
+    """, None),
+    ('battles of a player', 'BattleParticipant_playerTag', """
+        SELECT battleId, team FROM BattleParticipant WHERE playerTag = %s;
+    """, ('#GYUQQCLV',)),
+    ('decks with given cards', 'ParticipantDeck_cards', """
+        SELECT battleId, playerTag FROM ParticipantDeck WHERE cards @> %s;
+    """, ([26000000, 28000011],)),
+    ('battle dedup', 'BattleInfo_pkey|BattleInfo_battleTime', """
+        SELECT 1 FROM BattleInfo WHERE battleId = decode(%s, 'hex') AND battleTime = %s;
+    """, ('0' * 64, datetime.utcnow().strftime('%Y%m%dT%H%M%S.000Z'))),  # a month with a partition
+    ('player sampling', 'Player_pkey', """
+        SELECT playerTag FROM Player WHERE playerId = ANY(%s);
+    """, ([1, 2, 3],)),
+    ('player sampling in a trophy range', 'Player_trophyRange', """
+        SELECT playerTag FROM Player WHERE trophies / 1000 = %s AND playerId >= %s
+        ORDER BY trophies / 1000, playerId LIMIT 1;
+    """, (5, 1)),
+]
+
+
+# a partition's index name: <table>_<YYYY>_<MM>_<index>[_idx]
+PARTITION_INDEX = re.compile(r'\b(\w+?)_\d{4}_\d{2}_(\w+?)(?:_idx)?\b')
+
+
+def list_migrations() -> list:
+    """
+    :return: A list of (version, name, path) of the files in migrations/, sorted by version.
+    """
+    migrations = []
+    for name in listdir(MIGRATIONS_DIR):
+        match = re.match(r'^(\d+)_.*\.sql$', name)
+        if match:
+            migrations.append((int(match.group(1)), name, join(MIGRATIONS_DIR, name)))
+    return sorted(migrations)
+
+
+def split_statements(sql: str) -> list:
+    """
+    Split a migration into statements at semicolons outside of quotes and comments
+    (migrations are plain DDL/DML: no function bodies).
+    """
+    statements = []
+    current = []
+    quote = None
+    i = 0
+    while i < len(sql):
+        c = sql[i]
+        if quote is None and sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = len(sql) if end == -1 else end
+            continue
+        if quote is None and c in ('\'', '"'):
+            quote = c
+        elif c == quote:
+            quote = None
+        if quote is None and c == ';':
+            statements.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(c)
+        i += 1
+    statements.append(''.join(current).strip())
+    return [statement for statement in statements if len(statement) > 0]
+
+
+def init_migrations_table(con) -> None:
+    with con.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS SchemaMigrations (
+              version    int4 NOT NULL,
+              name       varchar(100),
+              appliedAt  timestamp DEFAULT NOW(),
+              PRIMARY KEY (version));
+        """)
+
+
+def applied_versions(con) -> set:
+    with con.cursor() as cur:
+        cur.execute('SELECT version FROM SchemaMigrations;')
+        return {row[0] for row in cur.fetchall()}
+
+
+def drop_invalid_indexes(con, sql: str) -> None:
+    """
+    A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind, which IF NOT EXISTS
+    would then keep; drop the invalid indexes this migration creates before (re)running it.
+    """
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE NOT i.indisvalid;
+        """)
+        for (index,) in cur.fetchall():
+            if re.search(r'\b{}\b'.format(re.escape(index)), sql, re.IGNORECASE):
+                log('Dropping invalid index {} (left by an interrupted build)'.format(index))
+                cur.execute('DROP INDEX CONCURRENTLY IF EXISTS {};'.format(index))
+
+
+def apply_migration(con, version: int, name: str, path: str) -> None:
+    """
+    Apply one migration and record it in SchemaMigrations.
+    """
+    sql = open(path).read()
+    start = time()
+
+    if sql.startswith(NO_TRANSACTION):
+        drop_invalid_indexes(con, sql)
+        with con.cursor() as cur:
+            for statement in split_statements(sql):
+                log('{}: {}'.format(name, ' '.join(statement.split())))
+                cur.execute(statement)
+            cur.execute('INSERT INTO SchemaMigrations (version, name) VALUES (%s, %s);', (version, name))
+    else:
+        # all or nothing
+        con.autocommit = False
+        try:
+            with con.cursor() as cur:
+                cur.execute(sql)
+                cur.execute('INSERT INTO SchemaMigrations (version, name) VALUES (%s, %s);', (version, name))
+            con.commit()
+        except psycopg2.Error:
+            con.rollback()
+            raise
+        finally:
+            con.autocommit = True
+
+    log('Applied {} in {:.1f} s'.format(name, time() - start))
+
+
+def migrate(con, target: int = None) -> None:
+    """
+    Apply every migration not applied yet, in order.
+    :param con: A psycopg2 connection object (autocommit);
+    :param target: Optional last version to apply.
+    """
+    init_migrations_table(con)
+    applied = applied_versions(con)
+
+    for version, name, path in list_migrations():
+        if version in applied or (target is not None and version > target):
+            continue
+        try:
+            apply_migration(con, version, name, path)
+        except psycopg2.Error as e:
+            log('ERROR: {} failed: {}'.format(name, str(e).strip()))
+            exit(1)
+
+
+def baseline(con, version: int) -> None:
+    """
+    Record migrations up to a version as applied without running them
+    (for a DB where they were applied by hand).
+    """
+    init_migrations_table(con)
+    with con.cursor() as cur:
+        for v, name, path in list_migrations():
+            if v <= version:
+                cur.execute("""
+                    INSERT INTO SchemaMigrations (version, name) VALUES (%s, %s) ON CONFLICT DO NOTHING;
+                """, (v, name))
+    log('Recorded migrations up to {} as applied'.format(version))
+
+
+def status(con) -> None:
+    init_migrations_table(con)
+    applied = applied_versions(con)
+    for version, name, path in list_migrations():
+        log('{} {}'.format('applied' if version in applied else 'pending', name))
+
+
+def check(con, no_seqscan: bool = False) -> bool:
+    """
+    EXPLAIN every query in CHECKED_QUERIES and check that its plan uses the expected index.
+    :param con: A psycopg2 connection object;
+    :param no_seqscan: If True, disable sequential scans first (on a small dev DB the planner
+    rightly prefers them; this checks that the index can be used at all);
+    :return: True if every query uses its index.
+    """
+    ok = True
+    with con.cursor() as cur:
+        if no_seqscan:
+            cur.execute('SET enable_seqscan = off;')
+        for description, index, query, params in CHECKED_QUERIES:
+            try:
+                cur.execute('EXPLAIN ' + query, params)
+                plan = '\n'.join(row[0] for row in cur.fetchall())
+            except psycopg2.Error as e:
+                log('FAIL {}: {}'.format(description, str(e).strip()))
+                ok = False
+                continue
+
+            # the index of a partition is named after the partition (BattleInfo_2021_11_pkey for
+            # BattleInfo_pkey, battleinfo_2021_11_battletime_idx for BattleInfo_battleTime)
+            if re.search(index.lower(), PARTITION_INDEX.sub(r'\1_\2', plan.lower())):
+                log('OK   {}: uses {}'.format(description, index))
+            else:
+                log('FAIL {}: does not use {}; plan:\n{}'.format(description, index, plan))
+                ok = False
+        if no_seqscan:
+            cur.execute('RESET enable_seqscan;')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply schema migrations (migrations/) and check index usage.')
+    parser.add_argument('--status', action='store_true', help='list applied and pending migrations')
+    parser.add_argument('--target', type=int, help='apply migrations up to this version only')
+    parser.add_argument('--baseline', type=int, metavar='VERSION',
+                        help='record migrations up to VERSION as applied without running them')
+    parser.add_argument('--check', action='store_true',
+                        help='EXPLAIN the crawler and analysis queries and check that they use their indexes')
+    parser.add_argument('--no-seqscan', action='store_true',
+                        help='with --check: disable sequential scans (for a small dev DB)')
+    args = parser.parse_args()
+
+    con = DBConnection().get_con()
+
+    if args.status:
+        status(con)
+    elif args.baseline is not None:
+        baseline(con, args.baseline)
+    elif args.check:
+        exit(0 if check(con, args.no_seqscan) else 1)
+    else:
+        migrate(con, args.target)
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+
+import argparse
+import multiprocessing
+import zlib
+from datetime import datetime
+from time import monotonic
+
+import psycopg2
+
+from extensions.connect_db import DBConnection
+from extensions.partitions import is_partitioned, create_partitions, list_partitions
+from batch_writer import copy_rows, insert_cards
+from card_stats import rebuild
+from transform import BATTLE_TABLES
+from helpers import log
+
+
+# the purpose of this script is to migrate the legacy table Clash (one row per 1v1 battle, see
+# data_migration/) into the battle tables, replacing data_migration_batch.sql: the table is cut
+# into chunks of disk blocks (ctid ranges) that N worker processes load in parallel, each chunk
+# in one transaction that also marks it done in table DataMigrationChunks, so a killed run
+# resumes where it stopped (a chunk that was being loaded is rolled back and loaded again);
+# once every chunk is done, the players of the migrated battles are added to table Player
+
+SOURCE_TABLE = 'Clash'
+CONTROL_TABLE = 'DataMigrationChunks'
+
+N_WORKERS = 4
+
+# disk blocks (8 kB) per chunk: ~20 battles per block in Clash
+CHUNK_BLOCKS = 4096
+
+# a chunk that failed this many times is left for a later run
+MAX_ATTEMPTS = 3
+
+# seconds between progress reports
+REPORT_INTERVAL = 60
+
+SOURCE_QUERY = """
+    SELECT sha256(id::bytea), battleTime, arenaId, gameModeId,
+           leftTag, leftClanTag, leftStartingTrophies, leftTrophyChange, leftCrowns, leftDeck,
+           rightTag, rightClanTag, rightStartingTrophies, rightTrophyChange, rightCrowns, rightDeck
+    FROM {}
+    WHERE ctid >= %s::tid AND ctid < %s::tid AND battleTime IS NOT NULL;
+""".format(SOURCE_TABLE)
+
+# the backfill of migrations/002_player_table.sql, for players not in table Player yet (NOT EXISTS:
+# no playerId is drawn for the others, which keeps the keys dense)
+BACKFILL_PLAYERS = """
+    INSERT INTO Player (playerTag, trophies)
+    SELECT DISTINCT ON (bp.playerTag) bp.playerTag, bd.startingTrophies
+    FROM BattleParticipant bp
+    JOIN BattleInfo bi ON bi.battleId = bp.battleId
+    LEFT JOIN BattleData bd ON bd.battleId = bp.battleId AND bd.playerTag = bp.playerTag
+    WHERE NOT EXISTS (SELECT 1 FROM Player p WHERE p.playerTag = bp.playerTag)
+    ORDER BY bp.playerTag, bi.battleTime DESC
+    ON CONFLICT DO NOTHING;
+"""
+
+
+def init_control_table(con) -> None:
+    with con.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS {} (
+              chunk       int4 NOT NULL,
+              startBlock  int8 NOT NULL,
+              endBlock    int8 NOT NULL,
+              done        boolean NOT NULL DEFAULT FALSE,
+              attempts    int4 NOT NULL DEFAULT 0,
+              sourceRows  int8,
+              battles     int8,
+              seconds     float8,
+              finishedAt  timestamp,
+              error       text,
+              PRIMARY KEY (chunk));
+        """.format(CONTROL_TABLE))
+
+
+def plan_chunks(con, chunk_blocks: int = CHUNK_BLOCKS, first_month=None) -> int:
+    """
+    Split Clash into chunks of chunk_blocks disk blocks (once: the plan of an earlier run is
+    kept, which is what makes the migration resumable), and create the partitions the battles
+    of Clash go to.
+    :param con: A psycopg2 connection object (autocommit);
+    :param chunk_blocks: Number of blocks per chunk;
+    :param first_month: Month of the oldest battle, if known (saves a scan of Clash);
+    :return: Number of chunks.
+    """
+    with con.cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM {};'.format(CONTROL_TABLE))
+        n_chunks = cur.fetchone()[0]
+        if n_chunks > 0:
+            return n_chunks
+
+        # created here, not by the workers: concurrent DDL on the parent tables would deadlock
+        if first_month is None:
+            log('Looking for the oldest battle in {}'.format(SOURCE_TABLE))
+            cur.execute('SELECT MIN(battleTime) FROM {};'.format(SOURCE_TABLE))
+            first_month = cur.fetchone()[0]
+        created = create_partitions(con, first_month=first_month)
+        log('Created {} partitions'.format(len(created)))
+
+        cur.execute("SELECT pg_relation_size(%s) / current_setting('block_size')::int8;", (SOURCE_TABLE,))
+        blocks = cur.fetchone()[0]
+        chunks = [(i, start, min(start + chunk_blocks, blocks))
+                  for i, start in enumerate(range(0, blocks, chunk_blocks))]
+        cur.executemany('INSERT INTO {} (chunk, startBlock, endBlock) VALUES (%s, %s, %s);'.format(CONTROL_TABLE),
+                        chunks)
+        log('Planned {} chunks of {} blocks ({} blocks in {})'.format(len(chunks), chunk_blocks, blocks, SOURCE_TABLE))
+        return len(chunks)
+
+
+def parse_deck(deck: str) -> list:
+    """
+    :param deck: A deck of Clash, e.g. '[["Knight", 9], ["Archers", 11], ...]';
+    :return: A list of (card name, level or None).
+    """
+    if deck is None:
+        return []
+    for c in '["]':
+        deck = deck.replace(c, '')
+    parts = deck.split(', ')
+    cards = []
+    for i in range(0, len(parts) - 1, 2):
+        name, level = parts[i].strip(), parts[i + 1].strip()
+        if len(name) > 0:
+            cards.append((name, int(level) if level.isdigit() else None))
+    return cards
+
+
+def card_id(name: str, card_ids: dict) -> int:
+    """
+    :param name: A card name;
+    :param card_ids: Card name -> cardId of table Card (updated with new cards);
+    :return: The cardId of the card; a card that is not in table Card gets a negative id
+    derived from its name (the same one in every worker).
+    """
+    if name not in card_ids:
+        card_ids[name] = -(zlib.crc32(name.encode('utf8')) & 0x7fffffff)
+    return card_ids[name]
+
+
+def transform_clash(rows: list, card_ids: dict) -> dict:
+    """
+    Turn rows of Clash (SOURCE_QUERY) into rows of the battle tables.
+    :return: {table name: list of row tuples} like transform_battle(), plus 'Card'.
+    """
+    tables = {table: [] for table in BATTLE_TABLES + ('Card',)}
+    for row in rows:
+        battle_id, battle_time, arena_id, game_mode_id = row[:4]
+        battle_id = bytes(battle_id)
+        tables['BattleInfo'].append((battle_id, battle_time, None, None, arena_id, None, game_mode_id, None, None))
+
+        for tag, clan_tag, starting_trophies, trophy_change, crowns, deck in (row[4:10], row[10:16]):
+            if tag is None:
+                continue
+            tables['BattleParticipant'].append((battle_id, tag, None, battle_time))
+            tables['BattleData'].append((battle_id, tag, clan_tag, starting_trophies, trophy_change, crowns)
+                                        + (None,) * 8 + (battle_time,))
+
+            cards = sorted((card_id(name, card_ids), name, level) for name, level in parse_deck(deck))
+            if len(cards) > 0:
+                tables['ParticipantDeck'].append((battle_id, tag, [card[0] for card in cards],
+                                                  [card[2] for card in cards], battle_time))
+                tables['Card'].extend((card[0], card[1]) for card in cards)
+    return tables
+
+
+def migrate_chunk(cur, start_block: int, end_block: int, card_ids: dict, known_cards: set) -> tuple:
+    """
+    Load one chunk of Clash: COPY into the (temporary) staging tables, then insert into the
+    battle tables, skipping battles already there (duplicates in Clash, or an earlier migration).
+    :return: (rows read from Clash, battles inserted, card ids inserted into table Card).
+    """
+    cur.execute(SOURCE_QUERY, ('({},0)'.format(start_block), '({},0)'.format(end_block)))
+    rows = cur.fetchall()
+    tables = transform_clash(rows, card_ids)
+
+    new_cards = insert_cards(cur, tables['Card'], known_cards)
+    battles = 0
+    for table in BATTLE_TABLES:
+        copy_rows(cur, 'stage_' + table, tables[table])
+        cur.execute('INSERT INTO {0} SELECT * FROM stage_{0} ON CONFLICT DO NOTHING;'.format(table))
+        if table == 'BattleInfo':
+            battles = cur.rowcount
+    return len(rows), battles, new_cards
+
+
+def run_worker(worker: int) -> None:
+    """
+    Claim and load chunks not done yet until there are none left.
+    """
+    con = DBConnection().get_con()
+    with con.cursor() as cur:
+        for table in BATTLE_TABLES:
+            cur.execute('CREATE TEMP TABLE stage_{0} (LIKE {0}) ON COMMIT DELETE ROWS;'.format(table))
+        cur.execute('SELECT name, cardId FROM Card;')
+        card_ids = dict(cur.fetchall())
+    known_cards = set(card_ids.values())
+
+    while True:
+        chunk = None
+        con.autocommit = False
+        try:
+            with con.cursor() as cur:
+                # SKIP LOCKED: each worker takes the next chunk no other worker is loading
+                cur.execute("""
+                    SELECT chunk, startBlock, endBlock FROM {}
+                    WHERE NOT done AND attempts < %s
+                    ORDER BY chunk LIMIT 1 FOR UPDATE SKIP LOCKED;
+                """.format(CONTROL_TABLE), (MAX_ATTEMPTS,))
+                claimed = cur.fetchone()
+                if claimed is None:
+                    con.commit()
+                    break
+                chunk, start_block, end_block = claimed
+
+                start = monotonic()
+                source_rows, battles, new_cards = migrate_chunk(cur, start_block, end_block, card_ids, known_cards)
+                seconds = monotonic() - start
+                cur.execute("""
+                    UPDATE {} SET done = TRUE, sourceRows = %s, battles = %s, seconds = %s,
+                    finishedAt = NOW(), error = NULL
+                    WHERE chunk = %s;
+                """.format(CONTROL_TABLE), (source_rows, battles, seconds, chunk))
+            con.commit()
+            known_cards.update(new_cards)
+            log('Worker {}: chunk {} done, {} rows ({} new battles) in {:.1f} s, {:.0f} rows/s'.format(
+                worker, chunk, source_rows, battles, seconds, source_rows / max(seconds, 1e-3)))
+        except psycopg2.Error as e:
+            con.rollback()
+            if chunk is None:
+                raise
+            con.autocommit = True
+            log('ERROR: worker {}: chunk {} failed: {}'.format(worker, chunk, str(e).strip()))
+            with con.cursor() as cur:
+                cur.execute('UPDATE {} SET attempts = attempts + 1, error = %s WHERE chunk = %s;'.format(CONTROL_TABLE),
+                            (str(e).strip(), chunk))
+        finally:
+            con.autocommit = True
+    con.close()
+
+
+def backfill_players(con) -> int:
+    """
+    Add the players of the stored battles that are missing from table Player (the sampling
+    table, see extensions/player_sampler.py), with the startingTrophies of their latest battle.
+    :param con: A psycopg2 connection object (autocommit);
+    :return: Number of players added.
+    """
+    with con.cursor() as cur:
+        cur.execute(BACKFILL_PLAYERS)
+        return cur.rowcount
+
+
+def progress(con) -> tuple:
+    """
+    :return: (chunks done, chunks, rows read from Clash, battles inserted, chunks failed MAX_ATTEMPTS times).
+    """
+    with con.cursor() as cur:
+        cur.execute("""
+            SELECT COUNT(*) FILTER (WHERE done), COUNT(*),
+                   COALESCE(SUM(sourceRows), 0)::int8, COALESCE(SUM(battles), 0)::int8,
+                   COUNT(*) FILTER (WHERE NOT done AND attempts >= %s)
+            FROM {};
+        """.format(CONTROL_TABLE), (MAX_ATTEMPTS,))
+        return cur.fetchone()
+
+
+def report(con, start: float, start_rows: int, start_done: int) -> tuple:
+    """
+    Log the progress and speed of this run.
+    :param start: monotonic() at the start of the run;
+    :param start_rows: Rows read from Clash before this run;
+    :param start_done: Chunks done before this run;
+    :return: The result of progress().
+    """
+    state = progress(con)
+    done, total, rows, battles, failed = state
+    elapsed = monotonic() - start
+    rate = (rows - start_rows) / max(elapsed, 1e-3)
+    chunk_rate = (done - start_done) / max(elapsed, 1e-3)
+    eta = '{:.1f} h'.format((total - done - failed) / chunk_rate / 3600) if chunk_rate > 0 else 'unknown'
+    log('{}/{} chunks done ({} failed), {} rows read, {} battles inserted; {:.0f} rows/s; ETA {}'.format(
+        done, total, failed, rows, battles, rate, eta))
+    return state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate the legacy table Clash into the battle tables.')
+    parser.add_argument('--workers', type=int, default=N_WORKERS,
+                        help='number of worker processes (default: {})'.format(N_WORKERS))
+    parser.add_argument('--chunk-blocks', type=int, default=CHUNK_BLOCKS,
+                        help='disk blocks per chunk, on the first run only (default: {})'.format(CHUNK_BLOCKS))
+    parser.add_argument('--first-month', type=lambda s: datetime.strptime(s, '%Y-%m'),
+                        help='month of the oldest battle in Clash, YYYY-MM (default: looked up)')
+    parser.add_argument('--retry', action='store_true',
+                        help='retry the chunks that failed {} times'.format(MAX_ATTEMPTS))
+    parser.add_argument('--status', action='store_true', help='report the progress and exit')
+    parser.add_argument('--rebuild-stats', action='store_true',
+                        help='once complete, recompute the card statistics of every month (card_stats.py --rebuild); '
+                             'stop the crawler first')
+    args = parser.parse_args()
+
+    con = DBConnection().get_con()
+
+    if not is_partitioned(con):
+        log('ERROR: the battle tables are not up to date (run python migrate.py first)')
+        exit(1)
+
+    init_control_table(con)
+    if args.status:
+        report(con, monotonic(), 0, 0)
+        exit(0)
+
+    plan_chunks(con, args.chunk_blocks, args.first_month)
+    if args.retry:
+        with con.cursor() as cur:
+            cur.execute('UPDATE {} SET attempts = 0 WHERE NOT done;'.format(CONTROL_TABLE))
+
+    start = monotonic()
+    done, total, start_rows, battles, failed = progress(con)
+    log('Resuming: {}/{} chunks already done'.format(done, total) if done > 0 else 'Starting: {} chunks'.format(total))
+
+    workers = [multiprocessing.Process(target=run_worker, args=(i,)) for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    while any(worker.is_alive() for worker in workers):
+        for worker in workers:
+            worker.join(REPORT_INTERVAL / len(workers))
+        report(con, start, start_rows, done)
+
+    done, total, rows, battles, failed = report(con, start, start_rows, done)
+    if done < total:
+        log('ERROR: {} chunks not done ({} failed {} times, see {}.error); run again to resume'.format(
+            total - done, failed, MAX_ATTEMPTS, CONTROL_TABLE))
+        exit(1)
+    log('Migration of {} complete'.format(SOURCE_TABLE))
+
+    log('Adding the players of the migrated battles to table Player')
+    log('{} players added'.format(backfill_players(con)))
+
+    if args.rebuild_stats:
+        for month, name in list_partitions(con, 'BattleInfo'):
+            rebuild(con, month)
+            log('Rebuilt the card statistics of {:%Y-%m}'.format(month))
+    else:
+        log('The card statistics do not count the migrated battles: stop the crawler and run '
+            'python card_stats.py --rebuild (or this script with --rebuild-stats)')
@@ -0,0 +1,10 @@
+-- PlayerInfo freshness: lets the crawler skip players refreshed within the TTL
+-- (see extensions/player_cache.py)
+-- Added without a default first, so existing rows stay NULL (stale: refreshed on the next visit)
+-- instead of all looking fetched at migration time; rows inserted from now on get NOW().
+
+ALTER TABLE PlayerInfo
+ADD COLUMN IF NOT EXISTS lastRefreshed timestamp;
+
+ALTER TABLE PlayerInfo
+ALTER COLUMN lastRefreshed SET DEFAULT NOW();
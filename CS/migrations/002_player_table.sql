@@ -0,0 +1,21 @@
+-- Player: one row per distinct player with a dense integer key, so that random players
+-- can be sampled by key instead of scanning BattleParticipant
+-- (see extensions/player_sampler.py; kept up to date by batch_writer.py)
+
+CREATE TABLE IF NOT EXISTS Player (
+  playerId    serial NOT NULL,
+  playerTag   varchar(20) NOT NULL,
+  trophies    int4,
+  PRIMARY KEY (playerId),
+  UNIQUE (playerTag));
+
+CREATE INDEX IF NOT EXISTS Player_trophyRange ON Player ((trophies / 1000), playerId);
+
+-- backfill: every player stored so far, with the startingTrophies of their latest battle
+INSERT INTO Player (playerTag, trophies)
+SELECT DISTINCT ON (bp.playerTag) bp.playerTag, bd.startingTrophies
+FROM BattleParticipant bp
+JOIN BattleInfo bi ON bi.battleId = bp.battleId
+LEFT JOIN BattleData bd ON bd.battleId = bp.battleId AND bd.playerTag = bp.playerTag
+ORDER BY bp.playerTag, bi.battleTime DESC
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,13 @@
+-- migrate: no-transaction
+-- Indexes for the crawler's hot queries and per-player / per-card analysis queries;
+-- built CONCURRENTLY (one statement at a time, outside a transaction) so that the crawler
+-- keeps writing while they are built. Checked with `python migrate.py --check`.
+
+-- get_last_playertag(): ORDER BY battleTime DESC LIMIT 1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS BattleInfo_battleTime ON BattleInfo (battleTime);
+
+-- battles of a player (the primary key starts with battleId)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS BattleParticipant_playerTag ON BattleParticipant (playerTag);
+
+-- battles with a card
+CREATE INDEX CONCURRENTLY IF NOT EXISTS BattleDeck_card ON BattleDeck (card);
@@ -0,0 +1,21 @@
+-- battleId: store the sha256 digest as 32 raw bytes (bytea) instead of 64 hex characters
+-- (char(64) takes 65 bytes per value, in every row and every index of the four battle tables;
+-- see bench_battle_id.py for measured sizes). The hash itself is unchanged, so dedup and
+-- battleIds computed in Python (hex, see make_battle_id()) still match: decode(hex) = bytea.
+-- Rewrites the four tables and their indexes in one transaction: stop the crawler first.
+
+ALTER TABLE BattleDeck DROP CONSTRAINT IF EXISTS battledeck_battleid_playertag_fkey;
+ALTER TABLE BattleData DROP CONSTRAINT IF EXISTS battledata_battleid_playertag_fkey;
+ALTER TABLE BattleParticipant DROP CONSTRAINT IF EXISTS battleparticipant_battleid_fkey;
+
+ALTER TABLE BattleInfo ALTER COLUMN battleId TYPE bytea USING decode(battleId, 'hex');
+ALTER TABLE BattleParticipant ALTER COLUMN battleId TYPE bytea USING decode(battleId, 'hex');
+ALTER TABLE BattleDeck ALTER COLUMN battleId TYPE bytea USING decode(battleId, 'hex');
+ALTER TABLE BattleData ALTER COLUMN battleId TYPE bytea USING decode(battleId, 'hex');
+
+ALTER TABLE BattleParticipant ADD CONSTRAINT battleparticipant_battleid_fkey
+  FOREIGN KEY (battleId) REFERENCES BattleInfo (battleId);
+ALTER TABLE BattleDeck ADD CONSTRAINT battledeck_battleid_playertag_fkey
+  FOREIGN KEY (battleId, playerTag) REFERENCES BattleParticipant (battleId, playerTag);
+ALTER TABLE BattleData ADD CONSTRAINT battledata_battleid_playertag_fkey
+  FOREIGN KEY (battleId, playerTag) REFERENCES BattleParticipant (battleId, playerTag);
@@ -0,0 +1,152 @@
+-- BattleDeck (one row per card: 8 per player, each repeating battleId, playerTag and the card
+-- name) becomes ParticipantDeck: one row per player, with the deck as an array of card ids
+-- (sorted, the ids of the API and Stat/cards.json) and an array of card levels in the same
+-- order. Card maps ids to names. A view named BattleDeck gives the former rows, so SQL that
+-- reads BattleDeck keeps working; queries on cards should use the GIN index instead:
+--   SELECT battleId, playerTag FROM ParticipantDeck WHERE cards @> ARRAY[26000000, 28000011];
+-- Rewrites BattleDeck in one transaction: stop the crawler first.
+
+CREATE TABLE IF NOT EXISTS Card (
+  cardId   int4 NOT NULL,
+  name     varchar(30) NOT NULL,
+  PRIMARY KEY (cardId));
+
+-- cards of Stat/cards.json
+INSERT INTO Card (cardId, name) VALUES
+  (26000000, 'Knight'),
+  (26000001, 'Archers'),
+  (26000002, 'Goblins'),
+  (26000003, 'Giant'),
+  (26000004, 'P.E.K.K.A'),
+  (26000005, 'Minions'),
+  (26000006, 'Balloon'),
+  (26000007, 'Witch'),
+  (26000008, 'Barbarians'),
+  (26000009, 'Golem'),
+  (26000010, 'Skeletons'),
+  (26000011, 'Valkyrie'),
+  (26000012, 'Skeleton Army'),
+  (26000013, 'Bomber'),
+  (26000014, 'Musketeer'),
+  (26000015, 'Baby Dragon'),
+  (26000016, 'Prince'),
+  (26000017, 'Wizard'),
+  (26000018, 'Mini P.E.K.K.A'),
+  (26000019, 'Spear Goblins'),
+  (26000020, 'Giant Skeleton'),
+  (26000021, 'Hog Rider'),
+  (26000022, 'Minion Horde'),
+  (26000023, 'Ice Wizard'),
+  (26000024, 'Royal Giant'),
+  (26000025, 'Guards'),
+  (26000026, 'Princess'),
+  (26000027, 'Dark Prince'),
+  (26000028, 'Three Musketeers'),
+  (26000029, 'Lava Hound'),
+  (26000030, 'Ice Spirit'),
+  (26000031, 'Fire Spirit'),
+  (26000032, 'Miner'),
+  (26000033, 'Sparky'),
+  (26000034, 'Bowler'),
+  (26000035, 'Lumberjack'),
+  (26000036, 'Battle Ram'),
+  (26000037, 'Inferno Dragon'),
+  (26000038, 'Ice Golem'),
+  (26000039, 'Mega Minion'),
+  (26000040, 'Dart Goblin'),
+  (26000041, 'Goblin Gang'),
+  (26000042, 'Electro Wizard'),
+  (26000043, 'Elite Barbarians'),
+  (26000044, 'Hunter'),
+  (26000045, 'Executioner'),
+  (26000046, 'Bandit'),
+  (26000047, 'Royal Recruits'),
+  (26000048, 'Night Witch'),
+  (26000049, 'Bats'),
+  (26000050, 'Royal Ghost'),
+  (26000051, 'Ram Rider'),
+  (26000052, 'Zappies'),
+  (26000053, 'Rascals'),
+  (26000054, 'Cannon Cart'),
+  (26000055, 'Mega Knight'),
+  (26000056, 'Skeleton Barrel'),
+  (26000057, 'Flying Machine'),
+  (26000058, 'Wall Breakers'),
+  (26000059, 'Royal Hogs'),
+  (26000060, 'Goblin Giant'),
+  (26000061, 'Fisherman'),
+  (26000062, 'Magic Archer'),
+  (26000063, 'Electro Dragon'),
+  (26000064, 'Firecracker'),
+  (26000067, 'Elixir Golem'),
+  (26000068, 'Battle Healer'),
+  (26000069, 'Skeleton King'),
+  (26000072, 'Archer Queen'),
+  (26000074, 'Golden Knight'),
+  (26000080, 'Skeleton Dragons'),
+  (26000083, 'Mother Witch'),
+  (26000084, 'Electro Spirit'),
+  (26000085, 'Electro Giant'),
+  (27000000, 'Cannon'),
+  (27000001, 'Goblin Hut'),
+  (27000002, 'Mortar'),
+  (27000003, 'Inferno Tower'),
+  (27000004, 'Bomb Tower'),
+  (27000005, 'Barbarian Hut'),
+  (27000006, 'Tesla'),
+  (27000007, 'Elixir Collector'),
+  (27000008, 'X-Bow'),
+  (27000009, 'Tombstone'),
+  (27000010, 'Furnace'),
+  (27000012, 'Goblin Cage'),
+  (27000013, 'Goblin Drill'),
+  (28000000, 'Fireball'),
+  (28000001, 'Arrows'),
+  (28000002, 'Rage'),
+  (28000003, 'Rocket'),
+  (28000004, 'Goblin Barrel'),
+  (28000005, 'Freeze'),
+  (28000006, 'Mirror'),
+  (28000007, 'Lightning'),
+  (28000008, 'Zap'),
+  (28000009, 'Poison'),
+  (28000010, 'Graveyard'),
+  (28000011, 'The Log'),
+  (28000012, 'Tornado'),
+  (28000013, 'Clone'),
+  (28000014, 'Earthquake'),
+  (28000015, 'Barbarian Barrel'),
+  (28000016, 'Heal Spirit'),
+  (28000017, 'Giant Snowball'),
+  (28000018, 'Royal Delivery')
+ON CONFLICT DO NOTHING;
+
+-- names not listed above (cards released since) get negative ids, as their API id is not known here
+-- (placeholders: batch_writer.insert_cards() replaces them once the crawler sees the API id)
+INSERT INTO Card (cardId, name)
+SELECT -ROW_NUMBER() OVER (ORDER BY card), card
+FROM (SELECT DISTINCT card FROM BattleDeck WHERE card NOT IN (SELECT name FROM Card)) AS unknown;
+
+CREATE TABLE ParticipantDeck (
+  battleId    bytea NOT NULL,
+  playerTag   varchar(20) NOT NULL,
+  cards       int4[] NOT NULL,
+  cardLevels  int2[],
+  PRIMARY KEY (battleId, playerTag),
+  FOREIGN KEY (battleId, playerTag) REFERENCES BattleParticipant (battleId, playerTag));
+
+INSERT INTO ParticipantDeck (battleId, playerTag, cards, cardLevels)
+SELECT d.battleId, d.playerTag, array_agg(c.cardId ORDER BY c.cardId), array_agg(d.cardLevel ORDER BY c.cardId)
+FROM BattleDeck d
+JOIN Card c ON c.name = d.card
+GROUP BY d.battleId, d.playerTag;
+
+DROP TABLE BattleDeck;
+
+CREATE INDEX ParticipantDeck_cards ON ParticipantDeck USING GIN (cards);
+
+CREATE VIEW BattleDeck AS
+SELECT d.battleId, d.playerTag, c.name AS card, u.cardLevel::int4 AS cardLevel
+FROM ParticipantDeck d
+CROSS JOIN LATERAL unnest(d.cards, d.cardLevels) AS u (cardId, cardLevel)
+JOIN Card c ON c.cardId = u.cardId;
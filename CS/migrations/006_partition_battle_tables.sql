@@ -0,0 +1,137 @@
+-- Partition the four battle tables by month of battleTime, so that vacuum, index maintenance,
+-- recent-window queries and the crawler's inserts only touch small tables, and old months can
+-- be archived and dropped as a whole (see manage_partitions.py).
+-- A partitioned table's keys must include the partition key, so the tables after BattleInfo
+-- get a battleTime column (last) and battleTime joins every primary and foreign key. Since
+-- battleId hashes battleTime, (battleId, battleTime) is exactly as unique as battleId was.
+-- Copies every battle table in one transaction: stop the crawler first (and make room for a
+-- second copy of the battle tables until the old ones are dropped at the end).
+
+DROP VIEW IF EXISTS BattleDeck;
+
+ALTER TABLE BattleInfo RENAME TO BattleInfo_unpartitioned;
+ALTER TABLE BattleParticipant RENAME TO BattleParticipant_unpartitioned;
+ALTER TABLE BattleData RENAME TO BattleData_unpartitioned;
+ALTER TABLE ParticipantDeck RENAME TO ParticipantDeck_unpartitioned;
+
+-- index names are per schema: free them for the new tables
+ALTER INDEX IF EXISTS BattleInfo_pkey RENAME TO BattleInfo_unpartitioned_pkey;
+ALTER INDEX IF EXISTS BattleInfo_battleTime RENAME TO BattleInfo_unpartitioned_battleTime;
+ALTER INDEX IF EXISTS BattleParticipant_pkey RENAME TO BattleParticipant_unpartitioned_pkey;
+ALTER INDEX IF EXISTS BattleParticipant_playerTag RENAME TO BattleParticipant_unpartitioned_playerTag;
+ALTER INDEX IF EXISTS BattleData_pkey RENAME TO BattleData_unpartitioned_pkey;
+ALTER INDEX IF EXISTS ParticipantDeck_pkey RENAME TO ParticipantDeck_unpartitioned_pkey;
+ALTER INDEX IF EXISTS ParticipantDeck_cards RENAME TO ParticipantDeck_unpartitioned_cards;
+
+-- keys, indexes and foreign keys are added after the copy (faster than maintaining them row by row)
+CREATE TABLE BattleInfo (
+  battleId           bytea NOT NULL,
+  battleTime         timestamp NOT NULL,
+  type               varchar(30),
+  isLadderTournament boolean,
+  arenaId            int4,
+  arena              varchar(30),
+  gameModeId         int4,
+  gameMode           varchar(50),
+  deckSelection      varchar(30))
+PARTITION BY RANGE (battleTime);
+
+CREATE TABLE BattleParticipant (
+  battleId    bytea NOT NULL,
+  playerTag   varchar(20) NOT NULL,
+  team        boolean,
+  battleTime  timestamp NOT NULL)
+PARTITION BY RANGE (battleTime);
+
+CREATE TABLE BattleData (
+  battleId                bytea NOT NULL,
+  playerTag               varchar(20) NOT NULL,
+  clanTag                 varchar(20),
+  startingTrophies        int4,
+  trophyChange            int4,
+  crowns                  int4,
+  princessTower1HitPoints int4,
+  princessTower2HitPoints int4,
+  kingTowerHitPoints      int4,
+  boatBattleSide          char(8),
+  boatBattleWon           boolean,
+  newBoatTowersDestroyed  int4,
+  prevBoatTowersDestroyed int4,
+  remainingBoatTowers     int4,
+  battleTime              timestamp NOT NULL)
+PARTITION BY RANGE (battleTime);
+
+CREATE TABLE ParticipantDeck (
+  battleId    bytea NOT NULL,
+  playerTag   varchar(20) NOT NULL,
+  cards       int4[] NOT NULL,
+  cardLevels  int2[],
+  battleTime  timestamp NOT NULL)
+PARTITION BY RANGE (battleTime);
+
+-- a partition per table per month, from the oldest battle stored to 3 months from now
+-- (partition names: <table>_<YYYY>_<MM>, see extensions/partitions.py)
+DO $$
+DECLARE
+  month      timestamp;
+  last_month timestamp;
+  t          text;
+BEGIN
+  SELECT date_trunc('month', LEAST(MIN(battleTime), NOW()::timestamp)),
+         date_trunc('month', NOW()::timestamp) + INTERVAL '3 months'
+  INTO month, last_month
+  FROM BattleInfo_unpartitioned;
+
+  WHILE month <= last_month LOOP
+    FOREACH t IN ARRAY ARRAY['battleinfo', 'battleparticipant', 'battledata', 'participantdeck'] LOOP
+      EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L);',
+                     t || to_char(month, '_YYYY_MM'), t, month, month + INTERVAL '1 month');
+    END LOOP;
+    month := month + INTERVAL '1 month';
+  END LOOP;
+END $$;
+
+INSERT INTO BattleInfo
+SELECT * FROM BattleInfo_unpartitioned;
+
+INSERT INTO BattleParticipant
+SELECT p.*, i.battleTime
+FROM BattleParticipant_unpartitioned p
+JOIN BattleInfo_unpartitioned i USING (battleId);
+
+INSERT INTO BattleData
+SELECT d.*, i.battleTime
+FROM BattleData_unpartitioned d
+JOIN BattleInfo_unpartitioned i USING (battleId);
+
+INSERT INTO ParticipantDeck
+SELECT d.*, i.battleTime
+FROM ParticipantDeck_unpartitioned d
+JOIN BattleInfo_unpartitioned i USING (battleId);
+
+DROP TABLE ParticipantDeck_unpartitioned;
+DROP TABLE BattleData_unpartitioned;
+DROP TABLE BattleParticipant_unpartitioned;
+DROP TABLE BattleInfo_unpartitioned;
+
+ALTER TABLE BattleInfo ADD PRIMARY KEY (battleId, battleTime);
+ALTER TABLE BattleParticipant ADD PRIMARY KEY (battleId, playerTag, battleTime);
+ALTER TABLE BattleData ADD PRIMARY KEY (battleId, playerTag, battleTime);
+ALTER TABLE ParticipantDeck ADD PRIMARY KEY (battleId, playerTag, battleTime);
+
+CREATE INDEX BattleInfo_battleTime ON BattleInfo (battleTime);
+CREATE INDEX BattleParticipant_playerTag ON BattleParticipant (playerTag);
+CREATE INDEX ParticipantDeck_cards ON ParticipantDeck USING GIN (cards);
+
+ALTER TABLE BattleParticipant ADD FOREIGN KEY (battleId, battleTime)
+  REFERENCES BattleInfo (battleId, battleTime);
+ALTER TABLE BattleData ADD FOREIGN KEY (battleId, playerTag, battleTime)
+  REFERENCES BattleParticipant (battleId, playerTag, battleTime);
+ALTER TABLE ParticipantDeck ADD FOREIGN KEY (battleId, playerTag, battleTime)
+  REFERENCES BattleParticipant (battleId, playerTag, battleTime);
+
+CREATE VIEW BattleDeck AS
+SELECT d.battleId, d.playerTag, c.name AS card, u.cardLevel::int4 AS cardLevel, d.battleTime
+FROM ParticipantDeck d
+CROSS JOIN LATERAL unnest(d.cards, d.cardLevels) AS u (cardId, cardLevel)
+JOIN Card c ON c.cardId = u.cardId;
@@ -0,0 +1,34 @@
+-- Card statistics kept up to date by the crawler (batch_writer.py, see card_stats.py): counts
+-- of decks, wins and decks containing each card and each pair of cards, per month of battleTime
+-- and trophy bracket (startingTrophies / 1000, -1 when unknown). Usage and win rates over the
+-- whole warehouse are then sums over a few thousand rows instead of a scan of the battle tables.
+-- The tables start empty: fill them from the battles stored so far with
+-- python card_stats.py --rebuild (with the crawler stopped).
+-- Counters are updated in place: fillfactor leaves room on each page for HOT updates.
+
+CREATE TABLE IF NOT EXISTS DeckStats (
+  month          date NOT NULL,
+  trophyBracket  int2 NOT NULL,
+  decks          int8 NOT NULL,
+  wins           int8 NOT NULL,
+  PRIMARY KEY (month, trophyBracket))
+WITH (fillfactor = 70);
+
+CREATE TABLE IF NOT EXISTS CardStats (
+  month          date NOT NULL,
+  trophyBracket  int2 NOT NULL,
+  cardId         int4 NOT NULL,
+  decks          int8 NOT NULL,
+  wins           int8 NOT NULL,
+  PRIMARY KEY (month, trophyBracket, cardId))
+WITH (fillfactor = 70);
+
+CREATE TABLE IF NOT EXISTS CardPairStats (
+  month          date NOT NULL,
+  trophyBracket  int2 NOT NULL,
+  cardA          int4 NOT NULL,
+  cardB          int4 NOT NULL,  -- cardA < cardB
+  decks          int8 NOT NULL,
+  wins           int8 NOT NULL,
+  PRIMARY KEY (month, trophyBracket, cardA, cardB))
+WITH (fillfactor = 70);
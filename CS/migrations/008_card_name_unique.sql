@@ -0,0 +1,57 @@
+-- A card stored under a placeholder id (a negative one: cards missing from the list of
+-- 005_participant_deck.sql, or new in migrate_clash.py) got a second row in Card once the
+-- crawler saw its API id, and its decks were split between the two ids. This merges every
+-- placeholder into the id of its name (the API one when there is one: the largest id), in
+-- ParticipantDeck (cards stay sorted, levels in the same order) and in the card statistics,
+-- and makes names unique: batch_writer.insert_cards() now replaces a placeholder when it sees
+-- the API id of its card.
+-- Rewrites the decks of those cards in one transaction: stop the crawler first.
+
+CREATE TEMP TABLE card_replacement ON COMMIT DROP AS
+SELECT c.cardId AS oldId, k.cardId AS newId
+FROM Card c
+JOIN (SELECT name, MAX(cardId) AS cardId FROM Card GROUP BY name HAVING COUNT(*) > 1) k
+  ON k.name = c.name AND k.cardId <> c.cardId;
+
+UPDATE ParticipantDeck pd
+SET cards = s.cards, cardLevels = CASE WHEN pd.cardLevels IS NULL THEN NULL ELSE s.cardLevels END
+FROM (
+  SELECT d.battleId, d.playerTag, d.battleTime,
+         array_agg(COALESCE(r.newId, u.card) ORDER BY COALESCE(r.newId, u.card)) AS cards,
+         array_agg(u.level ORDER BY COALESCE(r.newId, u.card)) AS cardLevels
+  FROM ParticipantDeck d
+  CROSS JOIN unnest(d.cards, d.cardLevels) AS u (card, level)
+  LEFT JOIN card_replacement r ON r.oldId = u.card
+  WHERE d.cards && (SELECT array_agg(oldId) FROM card_replacement)
+  GROUP BY d.battleId, d.playerTag, d.battleTime
+) s
+WHERE pd.battleId = s.battleId AND pd.playerTag = s.playerTag AND pd.battleTime = s.battleTime;
+
+INSERT INTO CardStats (month, trophyBracket, cardId, decks, wins)
+SELECT s.month, s.trophyBracket, r.newId, SUM(s.decks), SUM(s.wins)
+FROM CardStats s
+JOIN card_replacement r ON r.oldId = s.cardId
+GROUP BY s.month, s.trophyBracket, r.newId
+ON CONFLICT (month, trophyBracket, cardId) DO UPDATE
+SET decks = CardStats.decks + EXCLUDED.decks, wins = CardStats.wins + EXCLUDED.wins;
+DELETE FROM CardStats WHERE cardId IN (SELECT oldId FROM card_replacement);
+
+INSERT INTO CardPairStats (month, trophyBracket, cardA, cardB, decks, wins)
+SELECT month, trophyBracket, LEAST(a, b), GREATEST(a, b), SUM(decks), SUM(wins)
+FROM (
+  SELECT s.month, s.trophyBracket, COALESCE(ra.newId, s.cardA) AS a, COALESCE(rb.newId, s.cardB) AS b, s.decks, s.wins
+  FROM CardPairStats s
+  LEFT JOIN card_replacement ra ON ra.oldId = s.cardA
+  LEFT JOIN card_replacement rb ON rb.oldId = s.cardB
+  WHERE ra.oldId IS NOT NULL OR rb.oldId IS NOT NULL
+) p
+WHERE a <> b
+GROUP BY month, trophyBracket, LEAST(a, b), GREATEST(a, b)
+ON CONFLICT (month, trophyBracket, cardA, cardB) DO UPDATE
+SET decks = CardPairStats.decks + EXCLUDED.decks, wins = CardPairStats.wins + EXCLUDED.wins;
+DELETE FROM CardPairStats
+WHERE cardA IN (SELECT oldId FROM card_replacement) OR cardB IN (SELECT oldId FROM card_replacement);
+
+DELETE FROM Card WHERE cardId IN (SELECT oldId FROM card_replacement);
+
+ALTER TABLE Card ADD CONSTRAINT Card_name_key UNIQUE (name);
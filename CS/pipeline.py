@@ -0,0 +1,378 @@
+import atexit
+import queue
+import threading
+from time import sleep, monotonic
+
+from extensions.connect_db import DBConnection
+from extensions.http_session import configure_session, stats as http_stats
+from extensions.player_cache import get_player_cache
+from extensions.battle_dedup import get_battle_dedup
+from extensions.frontier import get_frontier
+from extensions.yield_model import get_yield_model
+from helpers import log, email_admin, cr_api_request
+from transform import make_battle_id, transform_battle, transform_player_info
+from batch_writer import BatchWriter, TRANSIENT_ERRORS
+from data_collection import get_init_battle, get_random_playertags
+
+
+# default number of worker threads per stage
+FETCHERS = 8  # battle_log requests
+PLAYER_FETCHERS = 8  # player_info requests
+TRANSFORMERS = 2
+WRITERS = 1
+
+# capacity of each queue between stages; a full queue blocks the stage feeding it (backpressure)
+QUEUE_SIZE = 1000
+
+# number of battles whose participants are crawled before switching to random sampling
+# (same as collect_data())
+BFS_BATTLES = 5
+
+# seconds between two logs of queue depths and stage throughput
+STATS_INTERVAL = 60
+
+
+class CrawlPipeline:
+    """
+    A staged version of collect_data(), so that the API and the DB are never idle waiting
+    for each other. Each stage is a pool of threads; stages are connected by bounded queues:
+
+    driver (frontier) -> tag_queue -> fetchers (battle_log) -> battle_queue
+    -> transformers (dedup, transform_battle) -> write_queue -> writers (BatchWriter)
+                                              -> player_queue -> player fetchers (player_info) -> write_queue
+
+    A full queue blocks the stage feeding it. Transformers and writers hold their own DB
+    connection. A battle log is observed by the YieldModel, and its player done in the frontier,
+    once each of its battles is buffered by a writer or found already stored; the frontier and
+    the YieldModel flush the writers before they checkpoint or commit.
+    Queue depths and per-stage counts are logged every STATS_INTERVAL seconds;
+    the stage in front of the fullest queue is the bottleneck.
+    """
+
+    def __init__(self, fetchers: int = FETCHERS, player_fetchers: int = PLAYER_FETCHERS,
+                 transformers: int = TRANSFORMERS, writers: int = WRITERS, queue_size: int = QUEUE_SIZE):
+        """
+        :param fetchers: Number of battle_log fetcher threads;
+        :param player_fetchers: Number of player_info fetcher threads;
+        :param transformers: Number of transform threads;
+        :param writers: Number of DB writer threads;
+        :param queue_size: Capacity of each queue.
+        """
+        self.workers = {
+            'fetch': (fetchers, self.fetch_battle_logs),
+            'fetch_player': (player_fetchers, self.fetch_player_infos),
+            'transform': (transformers, self.transform),
+            'write': (writers, self.write),
+        }
+
+        self.queues = {
+            'tag_queue': queue.Queue(maxsize=queue_size),
+            'battle_queue': queue.Queue(maxsize=queue_size),
+            'player_queue': queue.Queue(maxsize=queue_size),
+            'write_queue': queue.Queue(maxsize=queue_size),
+        }
+
+        self.counts = {stage: 0 for stage in self.workers}
+        self.counts_lock = threading.Lock()
+
+        self.writers = []  # BatchWriter of every writer thread
+
+        self.bfs_remaining = BFS_BATTLES
+        self.bfs_done = threading.Event()
+        self.fatal = threading.Event()  # set when a worker hits a fatal error (e.g., 403)
+
+    # ------------------------------------------
+    # helpers
+    # ------------------------------------------
+
+    def put(self, name: str, item) -> None:
+        """
+        Blocking put into a queue that gives up if the pipeline is shutting down.
+        """
+        q = self.queues[name]
+        while not self.fatal.is_set():
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def done(self, stage: str) -> None:
+        with self.counts_lock:
+            self.counts[stage] += 1
+
+    def handled(self, crawl: dict, new: bool) -> None:
+        """
+        Count a battle of a battle log as buffered (new) or already stored; once every battle of
+        the log is counted, the YieldModel observes the request and the player is done.
+        :param crawl: {'tag', 'battle_log', 'remaining', 'new'} of the battle_log request (None
+        for the initial battle).
+        """
+        if crawl is None:
+            return
+        with self.counts_lock:
+            crawl['new'] += new
+            crawl['remaining'] -= 1
+            if crawl['remaining'] > 0:
+                return
+        get_yield_model().observe(crawl['tag'], crawl['battle_log'], crawl['new'])
+        get_frontier().done(crawl['tag'])
+
+    def flush_writers(self) -> None:
+        """
+        Write what every writer holds (a BatchWriter may be flushed from any thread).
+        """
+        with self.counts_lock:
+            writers = list(self.writers)
+        for writer in writers:
+            writer.flush()
+
+    def run_worker(self, stage: str, func) -> None:
+        """
+        Thread body: runs a stage function forever; a fatal error stops the whole pipeline,
+        any other error is reported and the worker carries on.
+        """
+        while not self.fatal.is_set():
+            try:
+                func()
+            except SystemExit:
+                # cr_api_request() exits on fatal errors; only the main thread can end the program
+                self.fatal.set()
+            except Exception as e:
+                email_admin(500, 'ERROR: pipeline stage {}: {}'.format(stage, repr(e)))
+                sleep(1)
+
+    # ------------------------------------------
+    # stages (each function processes items until an error)
+    # ------------------------------------------
+
+    def fetch_battle_logs(self) -> None:
+        model = get_yield_model()
+        frontier = get_frontier()
+
+        while True:
+            tag = self.queues['tag_queue'].get()
+
+            # players not due for a revisit are skipped; battles seen in the previous request dropped
+            if not model.is_due(tag):
+                frontier.done(tag)
+                self.done('fetch')
+                continue
+
+            battle_log_res = cr_api_request(tag, 'battle_log')
+            if battle_log_res.get('statusCode') == 200 and len(battle_log_res.get('body')) > 0:
+                battle_log = battle_log_res.get('body')
+                battles = model.unseen(tag, battle_log)
+                if len(battles) == 0:
+                    # nothing past the high-water mark: it stays where it is
+                    model.observe(tag, battle_log, 0)
+                    frontier.done(tag)
+
+                # observed once the transformers and writers have handled every battle (see handled())
+                crawl = {'tag': tag, 'battle_log': battle_log, 'remaining': len(battles), 'new': 0}
+                for battle in battles:
+                    self.put('battle_queue', (battle, crawl))
+            else:
+                frontier.done(tag)
+
+            self.done('fetch')
+
+    def fetch_player_infos(self) -> None:
+        cache = get_player_cache()
+
+        while True:
+            tag = self.queues['player_queue'].get()
+
+            # players were claimed by the transformers: marked refreshed by the writers, or released here
+            try:
+                player_info_res = cr_api_request(tag, 'player_info')
+                if player_info_res.get('statusCode') == 200 and len(player_info_res.get('body')) > 0:
+                    self.put('write_queue', ('player', transform_player_info(player_info_res.get('body')), None))
+                else:
+                    cache.release(tag)
+            except Exception:
+                cache.release(tag)
+                raise
+
+            self.done('fetch_player')
+
+    def transform(self) -> None:
+        con = DBConnection().get_con()
+        dedup = get_battle_dedup(con)
+        cache = get_player_cache()
+
+        while True:
+            battle, crawl = self.queues['battle_queue'].get()
+
+            team = battle.get('team') or []
+            opponent = battle.get('opponent') or []
+            tags = sorted(player.get('tag') for player in team + opponent)
+
+            # level-order traversal: crawl participants of the first battles (scored by YieldModel)
+            if self.bfs_step():
+                trophies = {player.get('tag'): player.get('startingTrophies') for player in team + opponent}
+                get_frontier().push(tags, get_yield_model().score(tags, trophies))
+
+            battle_id = make_battle_id(battle)
+            battle_time = battle.get('battleTime')
+            if dedup.is_duplicate(con, battle_id, battle_time):
+                self.handled(crawl, False)
+                self.done('transform')
+                continue
+
+            # recorded as stored by the writer once written
+            rows = transform_battle(battle, battle_id)
+            dedup.hold(battle_id)
+            self.put('write_queue', ('battle', rows, crawl))
+
+            # refresh PlayerInfo of participants not refreshed within the TTL; claimed right
+            # away so that players in several battles in flight are only fetched once
+            for tag in cache.stale_tags(con, tags, claim=True):
+                self.put('player_queue', tag)
+
+            self.done('transform')
+
+    def write(self) -> None:
+        con = DBConnection().get_con()
+        writer = BatchWriter(con)
+        atexit.register(writer.flush)  # writers are daemon threads: flush what they hold on exit
+        with self.counts_lock:
+            self.writers.append(writer)
+
+        try:
+            while True:
+                try:
+                    kind, row, crawl = self.queues['write_queue'].get(timeout=1)
+                except queue.Empty:
+                    if writer.is_due():
+                        writer.flush()
+                    continue
+
+                if kind == 'battle':
+                    writer.add_battle(row)
+                    self.handled(crawl, True)
+                else:
+                    writer.add_player_info(row)
+                    get_player_cache().mark(row[0])
+
+                self.done('write')
+        except TRANSIENT_ERRORS:
+            # the writer kept its rows; if the connection is lost they cannot be written: stop
+            # (nothing was recorded as stored, so they are crawled again after a restart)
+            if con.closed:
+                self.fatal.set()
+            raise
+
+    def bfs_step(self) -> bool:
+        """
+        :return: True while the first BFS_BATTLES battles are being processed.
+        """
+        with self.counts_lock:
+            if self.bfs_remaining <= 0:
+                return False
+            self.bfs_remaining -= 1
+            if self.bfs_remaining == 0:
+                self.bfs_done.set()
+            return True
+
+    # ------------------------------------------
+    # monitoring
+    # ------------------------------------------
+
+    def stats(self) -> dict:
+        """
+        :return: Current depth of every queue and number of items processed by every stage.
+        """
+        with self.counts_lock:
+            counts = dict(self.counts)
+        depths = {name: q.qsize() for name, q in self.queues.items()}
+        return {'queue_depth': depths, 'processed': counts}
+
+    def monitor(self) -> None:
+        last = self.stats()['processed']
+        last_time = monotonic()
+        while not self.fatal.is_set():
+            sleep(STATS_INTERVAL)
+            stats = self.stats()
+            now = monotonic()
+            rates = {stage: round((n - last[stage]) / (now - last_time), 2) for stage, n in stats['processed'].items()}
+            log('Pipeline: queue depth = {}; items/sec = {}'.format(stats['queue_depth'], rates))
+            log('HTTP timings: {}'.format(http_stats.summary()))
+            log('PlayerInfo cache: {}'.format(get_player_cache().summary()))
+            log('Yield: {}'.format(get_yield_model().summary()))
+            if self.bfs_done.is_set():
+                dedup = get_battle_dedup(None)  # already seeded by the transformers
+                log('Battle dedup: {}'.format(dedup.summary()))
+                dedup.prune()
+            last, last_time = stats['processed'], now
+
+    # ------------------------------------------
+    # driver
+    # ------------------------------------------
+
+    def start(self) -> None:
+        for stage, (n, func) in self.workers.items():
+            for i in range(n):
+                threading.Thread(target=self.run_worker, args=(stage, func),
+                                 name='{}-{}'.format(stage, i), daemon=True).start()
+        threading.Thread(target=self.monitor, name='monitor', daemon=True).start()
+
+    def collect(self) -> None:
+        """
+        Same traversal as collect_data(), through the frontier (resumed after a restart): the
+        participants of the first BFS_BATTLES battles (of an initial battle's players, or of the
+        players still queued) are queued, then random samples of the existing player pool
+        whenever the frontier runs dry, scored by YieldModel. The driver feeds tag_queue with the
+        players it pops (highest expected yield first, see Frontier).
+        """
+        con = DBConnection().get_con()
+
+        frontier = get_frontier()
+        # popped players are only checkpointed, and high-water marks committed, once their battles are written
+        frontier.before_checkpoint = self.flush_writers
+        get_yield_model().before_commit = self.flush_writers
+
+        self.start()
+
+        if len(frontier) == 0:
+            self.put('battle_queue', (get_init_battle(con), None))
+        else:
+            log('Resuming from frontier: {} players queued'.format(len(frontier)))
+
+        while not self.fatal.is_set():
+            tag = frontier.pop()
+            if tag is not None:
+                self.put('tag_queue', tag)
+                continue
+
+            # the BFS may still queue players (unless it ran dry)
+            if not self.bfs_done.is_set() and not all(q.qsize() == 0 for q in self.queues.values()):
+                sleep(1)
+                continue
+
+            log('Entered while-true')
+            log('Frontier: {}'.format(frontier.summary()))
+
+            random_playertags = get_random_playertags(con)
+            tags = [tp[0] for tp in random_playertags]
+            frontier.push(tags, get_yield_model().score(tags))
+            log('Got random player tags')
+
+        # a worker hit a fatal error (already reported)
+        exit(1)
+
+
+def collect_data_pipeline(fetchers: int = FETCHERS, player_fetchers: int = PLAYER_FETCHERS,
+                          transformers: int = TRANSFORMERS, writers: int = WRITERS,
+                          queue_size: int = QUEUE_SIZE) -> None:
+    """
+    Entry point of the pipeline crawl mode; see CrawlPipeline.
+    """
+    # one keep-alive connection per fetcher thread
+    configure_session(pool_size=fetchers + player_fetchers)
+
+    log('collect_data_pipeline() started: fetchers = {}, player fetchers = {}, transformers = {}, writers = {}'.format(
+        fetchers, player_fetchers, transformers, writers))
+
+    pipeline = CrawlPipeline(fetchers, player_fetchers, transformers, writers, queue_size)
+    pipeline.collect()
@@ -0,0 +1,236 @@
+import hashlib
+
+
+# insertion order of the battle tables (each one references the one before)
+BATTLE_TABLES = ('BattleInfo', 'BattleParticipant', 'BattleData', 'ParticipantDeck')
+
+# per-player columns of BattleData that are taken as is from the battle log
+BATTLE_DATA_COLS = ('startingTrophies', 'trophyChange', 'crowns')
+BOAT_BATTLE_COLS = ('newTowersDestroyed', 'prevTowersDestroyed', 'remainingTowers')
+
+
+def make_battle_id(data: dict) -> str:
+    """
+    Generates the battleId of a battle:
+    sha256 of battleTime and player tags of every participant in alphabetical order.
+    :param data: A dictionary containing exactly one battle;
+    :return: A hex string of length 64.
+    """
+    team = data.get('team') or []
+    opponent = data.get('opponent') or []
+    tags = sorted(player.get('tag') for player in team + opponent)
+
+    s = ''.join([str(data.get('battleTime'))] + tags)
+    m = hashlib.sha256()
+    m.update(s.encode('utf8'))
+    return m.hexdigest()
+
+
+def _get(d, key):
+    # d.get(key) for a dictionary that may be missing (None)
+    try:
+        return d.get(key)
+    except AttributeError:
+        return None
+
+
+def transform_battle(data: dict, battle_id: str = None) -> dict:
+    """
+    Turns one battle from a battle_log request into rows of the four battle tables,
+    with plain dictionaries and tuples (no pandas: a battle has only 2-8 rows).
+    :param data: A dictionary containing exactly one battle;
+    :param battle_id: The battleId if already computed (see make_battle_id());
+    :return: A dictionary {table name: list of row tuples}, with keys in BATTLE_TABLES order,
+    plus 'Card': (cardId, name) of every card played (for table Card);
+    columns are in the order of create_tables.sql (battleId as the 32-byte digest, for bytea;
+    battleTime, the partition key, last in the tables after BattleInfo).
+    """
+    battleId = bytes.fromhex(battle_id or make_battle_id(data))
+    battleTime = data.get('battleTime')
+
+    team = data.get('team') or []
+    opponent = data.get('opponent') or []
+
+    # ------------------------------------------
+    # BattleInfo
+    # ------------------------------------------
+    arena = data.get('arena')
+    gameMode = data.get('gameMode')
+
+    info_row = (battleId, battleTime, data.get('type'), data.get('isLadderTournament'),
+                _get(arena, 'id'), _get(arena, 'name'), _get(gameMode, 'id'), _get(gameMode, 'name'),
+                data.get('deckSelection'))
+
+    # ------------------------------------------
+    # BattleParticipant, BattleData, ParticipantDeck: a row per player
+    # ------------------------------------------
+    is_boat_battle = data.get('type') == 'boatBattle'
+    if is_boat_battle:
+        # boat battles are always 1v1: the opponent gets the other side and the opposite result
+        team_side = data.get('boatBattleSide')
+        opponent_side = 'attacker' if team_side != 'attacker' else 'defender'
+        team_won = data.get('boatBattleWon')
+        boat_values = tuple(data.get(col) for col in BOAT_BATTLE_COLS)
+
+    participant_rows = []
+    data_rows = []
+    deck_rows = []
+    card_rows = []
+
+    for is_team, players in ((True, team), (False, opponent)):
+        for player in players:
+            tag = player.get('tag')
+
+            participant_rows.append((battleId, tag, is_team, battleTime))
+
+            # split princess tower hitpoints into separate columns
+            princess = player.get('princessTowersHitPoints')
+            if princess is not None and len(princess) == 2:
+                princess1, princess2 = princess
+            elif princess is not None and len(princess) == 1:
+                princess1, princess2 = princess[0], None
+            else:
+                princess1, princess2 = None, None
+
+            if is_boat_battle:
+                side = team_side if is_team else opponent_side
+                won = team_won if is_team else not team_won
+                boat = boat_values
+            else:
+                side = player.get('boatBattleSide')
+                won = player.get('boatBattleWon')
+                boat = tuple(player.get(col) for col in BOAT_BATTLE_COLS)
+
+            data_rows.append((battleId, tag, _get(player.get('clan'), 'tag'))
+                             + tuple(player.get(col) for col in BATTLE_DATA_COLS)
+                             + (princess1, princess2, player.get('kingTowerHitPoints'), side, won)
+                             + boat + (battleTime,))
+
+            # the deck as arrays of card ids and levels, sorted by card id (the same deck is
+            # always the same array)
+            cards = sorted(player.get('cards') or [], key=lambda card: card.get('id') or 0)
+            if len(cards) > 0:
+                deck_rows.append((battleId, tag, [card.get('id') for card in cards],
+                                  [card.get('level') for card in cards], battleTime))
+                card_rows.extend((card.get('id'), card.get('name')) for card in cards)
+
+    return {
+        'BattleInfo': [info_row],
+        'BattleParticipant': participant_rows,
+        'BattleData': data_rows,
+        'ParticipantDeck': deck_rows,
+        'Card': card_rows,
+    }
+
+
+def transform_player_info(player_info: dict) -> tuple:
+    """
+    Turns the body of a player_info request into a PlayerInfo row.
+    :param player_info: A dictionary;
+    :return: A tuple holding the PlayerInfo columns in table order (without lastRefreshed).
+    """
+    playerTag = player_info.get('tag')
+    name = player_info.get('name')
+
+    clan = player_info.get('clan')
+    try:
+        clanTag = clan.get('tag')
+    except AttributeError:
+        clanTag = None
+
+    role = player_info.get('role')
+
+    arena = player_info.get('arena')
+    try:
+        arenaId = arena.get('id')
+        arenaName = arena.get('name')
+    except AttributeError:
+        arenaId = None
+        arenaName = None
+
+    trophies = player_info.get('trophies')
+    bestTrophies = player_info.get('bestTrophies')
+    donations = player_info.get('donations')
+    donationsReceived = player_info.get('donationsReceived')
+    totalDonations = player_info.get('totalDonations')
+
+    leagueStatistics = player_info.get('leagueStatistics')
+    if leagueStatistics is not None:
+        previousSeason = leagueStatistics.get('previousSeason')
+        try:
+            previousSeasonTrophies = previousSeason.get('trophies')
+            previousSeasonRank = previousSeason.get('rank')
+            previousSeasonBestTrophies = previousSeason.get('bestTrophies')
+            previousSeasonId = previousSeason.get('id')
+        except AttributeError:
+            previousSeasonTrophies = None
+            previousSeasonRank = None
+            previousSeasonBestTrophies = None
+            previousSeasonId = None
+
+        currentSeason = leagueStatistics.get('currentSeason')
+        try:
+            currentSeasonTrophies = currentSeason.get('trophies')
+            currentSeasonRank = currentSeason.get('rank')
+            currentSeasonBestTrophies = currentSeason.get('bestTrophies')
+            currentSeasonId = currentSeason.get('id')
+        except AttributeError:
+            currentSeasonTrophies = None
+            currentSeasonRank = None
+            currentSeasonBestTrophies = None
+            currentSeasonId = None
+
+        bestSeason = leagueStatistics.get('bestSeason')
+        try:
+            bestSeasonTrophies = bestSeason.get('trophies')
+            bestSeasonRank = bestSeason.get('rank')
+            bestSeasonBestTrophies = bestSeason.get('bestTrophies')
+            bestSeasonId = bestSeason.get('id')
+        except AttributeError:
+            bestSeasonTrophies = None
+            bestSeasonRank = None
+            bestSeasonBestTrophies = None
+            bestSeasonId = None
+    else:
+        previousSeasonTrophies = None
+        previousSeasonRank = None
+        previousSeasonBestTrophies = None
+        previousSeasonId = None
+        currentSeasonTrophies = None
+        currentSeasonRank = None
+        currentSeasonBestTrophies = None
+        currentSeasonId = None
+        bestSeasonTrophies = None
+        bestSeasonRank = None
+        bestSeasonBestTrophies = None
+        bestSeasonId = None
+
+    currentFavouriteCard = player_info.get('currentFavouriteCard')
+    try:
+        currentFavouriteCardName = currentFavouriteCard.get('name')
+    except AttributeError:
+        currentFavouriteCardName = None
+
+    expLevel = player_info.get('expLevel')
+    expPoints = player_info.get('expPoints')
+    wins = player_info.get('wins')
+    losses = player_info.get('losses')
+    battleCount = player_info.get('battleCount')
+    threeCrownWins = player_info.get('threeCrownWins')
+    challengeCardsWon = player_info.get('challengeCardsWon')
+    challengeMaxWins = player_info.get('challengeMaxWins')
+    tournamentCardsWon = player_info.get('tournamentCardsWon')
+    tournamentBattleCount = player_info.get('tournamentBattleCount')
+    warDayWins = player_info.get('warDayWins')
+    clanCardsCollected = player_info.get('clanCardsCollected')
+    starPoints = player_info.get('starPoints')
+
+    # the insertion tuple
+    return (playerTag, name, clanTag, role, arenaId, arenaName, trophies, bestTrophies,
+            donations, donationsReceived, totalDonations,
+            previousSeasonTrophies, previousSeasonRank, previousSeasonBestTrophies, previousSeasonId,
+            currentSeasonTrophies, currentSeasonRank, currentSeasonBestTrophies, currentSeasonId,
+            bestSeasonTrophies, bestSeasonRank, bestSeasonBestTrophies, bestSeasonId,
+            currentFavouriteCardName, expLevel, expPoints, wins, losses, battleCount,
+            threeCrownWins, challengeCardsWon, challengeMaxWins, tournamentCardsWon,
+            tournamentBattleCount, warDayWins, clanCardsCollected, starPoints)
@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+import argparse
+import hashlib
+import json
+import os
+from os.path import basename, dirname, join, splitext
+
+import numpy as np
+import scipy.cluster.hierarchy as sch
+import scipy.sparse as sp
+
+from deck_matrix import load_cards, card_label
+
+
+# the purpose of this module is to build the graphs (networks) of card interactions, replacing
+# graph_basic.py, graph_cond_joint.py and the loops of clustergram.py: interaction files (int_*.txt,
+# a "A:B" pair per line) and weight files (graph_lasso*.json, {"wgt": {"A:B": w}}) are read into a
+# symmetric CSR adjacency matrix with a row and a column per card of cards.json (in order of card
+# id, as deck_matrix.py), one edge per pair of cards. The JSON graphs, the dense weight matrix of
+# the clustergram and its linkage are computed from that matrix with array operations; linkages
+# are cached on disk under a hash of their input, so redrawing an unchanged clustergram (or the
+# rows and columns of a symmetric one) does not cluster again.
+
+# renamed cards, as they appear in older interaction files
+ALIASES = {'Fire_Spirits': 'Fire_Spirit'}
+
+WEIGHT_DIGITS = 4
+
+# files of the shiny app (see shiny/www/README.md)
+WWW = join(dirname(__file__), 'shiny', 'www')
+APP_GRAPH = 'graph_lasso_0.001.json'
+CLUSTERGRAM_DIV = 'clustergram_div.txt'
+
+LINKAGE_CACHE = join(dirname(__file__), '.cache', 'linkage')
+LINK_METHOD = 'complete'  # dash_bio's default
+
+# plotly.express.colors.sequential.Greys
+COLOR_MAP = [
+    [0.0, 'rgb(255,255,255)'],
+    [0.1, 'rgb(250,250,250)'],
+    [0.2, 'rgb(240,240,240)'],
+    [0.3, 'rgb(217,217,217)'],
+    [0.4, 'rgb(189,189,189)'],
+    [0.5, 'rgb(150,150,150)'],
+    [0.6, 'rgb(115,115,115)'],
+    [0.7, 'rgb(82,82,82)'],
+    [0.8, 'rgb(37,37,37)'],
+    [0.9, 'rgb(22,22,22)'],
+    [1.0, 'rgb(0,0,0)']
+]
+
+
+class CardGraph:
+    """
+    An undirected card graph: adjacency[i, j] = adjacency[j, i] = weight of the edge between
+    cards i and j (1 for unweighted graphs), in a (cards x cards) CSR matrix.
+    """
+
+    def __init__(self, adjacency: sp.csr_matrix, labels: list, weighted: bool):
+        """
+        :param adjacency: Symmetric adjacency matrix, no explicit zeros;
+        :param labels: Label of each card (row), as card_label();
+        :param weighted: Whether the weights are written out (else the graph is an adjacency list).
+        """
+        self.adjacency = adjacency
+        self.labels = np.array(labels, dtype=object)
+        self.weighted = weighted
+
+    @staticmethod
+    def from_pairs(pairs: list, weights: list = None, cards: tuple = None) -> 'CardGraph':
+        """
+        :param pairs: (label A, label B) of each edge (card names or labels), duplicates allowed (a pair
+        listed twice, or as A:B and B:A, is one edge, with the largest of its weights);
+        :param weights: Weight of each edge (default: unweighted);
+        :param cards: (card ids, names) as load_cards() (default: cards.json);
+        :return: The graph; ValueError for labels that are not cards.
+        """
+        card_ids, names = cards or load_cards()
+        labels = [card_label(name) for name in names]
+        index = {label: i for i, label in enumerate(labels)}
+        # labels of any file as card_label() (some files have P.E.K.K.A), renamed cards as now
+        pairs = [tuple(ALIASES.get(card_label(label), card_label(label)) for label in pair) for pair in pairs]
+        unknown = sorted({label for pair in pairs for label in pair if label not in index})
+        if unknown:
+            raise ValueError('Unknown cards: {}'.format(', '.join(unknown)))
+
+        n = len(labels)
+        rows = np.array([index[a] for a, b in pairs], dtype=np.int64)
+        cols = np.array([index[b] for a, b in pairs], dtype=np.int64)
+        values = np.ones(len(pairs)) if weights is None else np.asarray(weights, dtype=float)
+        keep = rows != cols
+        # both directions of every edge, then one value per (row, col): the largest
+        rows, cols = np.concatenate([rows[keep], cols[keep]]), np.concatenate([cols[keep], rows[keep]])
+        values = np.tile(values[keep], 2)
+        keys = rows * n + cols
+        order = np.lexsort((values, keys))
+        keys, values = keys[order], values[order]
+        last = np.flatnonzero(np.append(keys[1:] != keys[:-1], True))
+        adjacency = sp.csr_matrix((values[last], (keys[last] // n, keys[last] % n)), shape=(n, n))
+        adjacency.eliminate_zeros()
+        return CardGraph(adjacency, labels, weights is not None)
+
+    @staticmethod
+    def read_interactions(path: str, cards: tuple = None) -> 'CardGraph':
+        """
+        :param path: An interaction file (e.g., int_basic.txt): a "A:B" pair per line.
+        """
+        with open(path) as f:
+            pairs = [tuple(line.split(':')) for line in f.read().splitlines() if line]
+        return CardGraph.from_pairs(pairs, cards=cards)
+
+    @staticmethod
+    def read_weights(path: str, cards: tuple = None) -> 'CardGraph':
+        """
+        :param path: A weight file (e.g., graph_lasso_0.001.json): {"wgt": {"A:B": w, ...}}.
+        """
+        with open(path) as f:
+            weights = json.load(f)['wgt']
+        return CardGraph.from_pairs([tuple(pair.split(':')) for pair in weights], list(weights.values()), cards)
+
+    @staticmethod
+    def read(path: str, cards: tuple = None) -> 'CardGraph':
+        # interaction file or weight file, by extension
+        if path.endswith('.json'):
+            return CardGraph.read_weights(path, cards)
+        return CardGraph.read_interactions(path, cards)
+
+    def threshold(self, min_weight: float) -> 'CardGraph':
+        """
+        :return: The graph of the edges weighing at least min_weight.
+        """
+        adjacency = self.adjacency.copy()
+        adjacency.data[adjacency.data < min_weight] = 0
+        adjacency.eliminate_zeros()
+        return CardGraph(adjacency, list(self.labels), self.weighted)
+
+    def vertices(self) -> np.ndarray:
+        """
+        :return: Indices of the cards with at least one edge, in order of label.
+        """
+        vertices = np.flatnonzero(np.diff(self.adjacency.indptr) > 0)
+        return vertices[np.argsort(self.labels[vertices].astype(str), kind='stable')]
+
+    def edges(self) -> tuple:
+        """
+        :return: (rows, cols, weights) of every edge in both directions, each row's edges by
+        decreasing weight.
+        """
+        coo = self.adjacency.tocoo()
+        order = np.lexsort((coo.col, -coo.data, coo.row))
+        return coo.row[order], coo.col[order], coo.data[order]
+
+    def to_json(self) -> dict:
+        """
+        :return: The adjacency list ({A: [B, ...]}, as graph_basic.py), or for a weighted graph the
+        adjacency list and the weights ({"adj": ..., "wgt": {"A:B": w}}, as mod_lasso.Rmd).
+        """
+        rows, cols, weights = self.edges()
+        if len(rows) == 0:
+            return {'adj': {}, 'wgt': {}} if self.weighted else {}
+        starts = np.flatnonzero(np.append(True, rows[1:] != rows[:-1]))
+        neighbours = np.split(self.labels[cols], starts[1:])
+        adj = {self.labels[rows[start]]: list(labels) for start, labels in zip(starts, neighbours)}
+        if not self.weighted:
+            return adj
+        keys = np.char.add(np.char.add(self.labels[rows].astype(str), ':'), self.labels[cols].astype(str))
+        return {'adj': adj, 'wgt': dict(zip(keys.tolist(), np.round(weights, WEIGHT_DIGITS).tolist()))}
+
+    def save_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f)
+
+    def dense(self) -> tuple:
+        """
+        :return: (weight matrix of the cards with an edge, 0 for no edge; their labels), in order
+        of label (the clustergram of clustergram.py).
+        """
+        vertices = self.vertices()
+        return self.adjacency[vertices][:, vertices].toarray(), list(self.labels[vertices])
+
+
+def cached_linkage(distances: np.ndarray, optimal_ordering: bool = False, method: str = LINK_METHOD,
+                   cache_dir: str = LINKAGE_CACHE) -> np.ndarray:
+    """
+    scipy.cluster.hierarchy.linkage(), cached in cache_dir under a hash of its input (link_fun of
+    dash_bio.Clustergram).
+    :param distances: Condensed distance matrix (scipy.spatial.distance.pdist());
+    :return: The linkage matrix.
+    """
+    distances = np.ascontiguousarray(distances, dtype=float)
+    key = hashlib.sha256(distances.tobytes())
+    key.update('{}:{}'.format(method, optimal_ordering).encode())
+    path = join(cache_dir, key.hexdigest() + '.npy')
+    if os.path.exists(path):
+        return np.load(path)
+    linkage = sch.linkage(distances, method, optimal_ordering=optimal_ordering)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(path + '.tmp.npy', linkage)
+    os.replace(path + '.tmp.npy', path)
+    return linkage
+
+
+def clustergram_div(graph: CardGraph) -> str:
+    """
+    :return: The clustergram of the weight matrix as a plotly div (without plotly.js), as the
+    shiny app inserts it.
+    """
+    # dash_bio and plotly are only needed for the clustergram (not for the JSON graphs)
+    import dash_bio as dashbio
+    import plotly
+
+    matrix, labels = graph.dense()
+    clustergram = dashbio.Clustergram(
+        data=matrix,
+        row_labels=labels,
+        column_labels=labels,
+        link_fun=cached_linkage,
+        height=1300,
+        width=1300,
+        tick_font={
+            "size": 8
+        },
+        line_width=2,
+        display_ratio=[0.2, 0.4],
+        color_map=COLOR_MAP
+    )
+    clustergram.update_layout(legend=dict(
+        yanchor="top",
+        y=0.99,
+        xanchor="left",
+        x=0.01
+    ))
+    return plotly.offline.plot(clustergram, include_plotlyjs=False, output_type="div")
+
+
+def default_output(path: str, threshold: float = None) -> str:
+    """
+    :return: The JSON graph of an input file: graph_basic.json for int_basic.txt, with _t<threshold>
+    appended if given (graph_lasso_0.001_t0.05.json for graph_lasso_0.001.json); None for a weight
+    file without threshold (it would be the input file).
+    """
+    name = splitext(basename(path))[0]
+    if name.startswith('int_'):
+        name = 'graph_' + name[len('int_'):]
+    elif threshold is None:
+        return None
+    if threshold is not None:
+        name += '_t{:g}'.format(threshold)
+    return join(dirname(path), name + '.json')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build card interaction graphs from interaction files (int_*.txt) '
+                                                 'or weight files (graph_lasso*.json).')
+    parser.add_argument('input', help='interaction file ("A:B" per line) or weight file ({"wgt": {"A:B": w}})')
+    parser.add_argument('--output', help='JSON graph (default: int_x.txt -> graph_x.json, x.json -> x_t<threshold>.json; '
+                                         'required for a weight file without --threshold)')
+    parser.add_argument('--threshold', type=float, help='keep the edges weighing at least this much')
+    parser.add_argument('--www', nargs='?', const=WWW,
+                        help='write the graph and the clustergram of the shiny app ({} and {}) to this directory '
+                             '(default: {}) instead of --output'.format(APP_GRAPH, CLUSTERGRAM_DIV, WWW))
+    parser.add_argument('--clustergram', help='also write the clustergram div to this file')
+    args = parser.parse_args()
+
+    paths = [join(args.www, APP_GRAPH)] if args.www else [args.output or default_output(args.input, args.threshold)]
+    if paths[0] is None:
+        parser.error('give --output (or --threshold) for a weight file: it is not rewritten in place')
+    if os.path.abspath(paths[0]) == os.path.abspath(args.input):
+        parser.error('{} is the input file: give another --output'.format(paths[0]))
+
+    graph = CardGraph.read(args.input)
+    if args.threshold is not None:
+        graph = graph.threshold(args.threshold)
+
+    graph.save_json(paths[0])
+    if args.www or args.clustergram:
+        paths.append(join(args.www, CLUSTERGRAM_DIV) if args.www else args.clustergram)
+        with open(paths[-1], 'w') as f:
+            f.write(clustergram_div(graph))
+    print('{} cards, {} edges: {}'.format(len(graph.vertices()), graph.adjacency.nnz // 2, ', '.join(paths)))
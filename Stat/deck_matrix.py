@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import re
+from os.path import dirname, join
+
+import numpy as np
+import psycopg2
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import scipy.sparse as sp
+
+
+# the purpose of this module is to turn decks into a sparse one-hot participant-by-card matrix X
+# (CSR, a column per card of cards.json, in order of card id) and to compute card statistics from
+# it with sparse algebra: card co-occurrence (X'X), win rates and win-lift of card pairs, and
+# interaction features (products of card columns). Decks are read chunk by chunk, from a sample
+# exported by sample/export_sample.py or from the DB, and the statistics are accumulated chunk by
+# chunk, so memory use depends on the chunk size, not on the number of participants.
+
+CARDS_JSON = join(dirname(__file__), 'cards.json')
+
+DECK_SIZE = 8
+CARD_COLUMNS = ['card{}'.format(i) for i in range(1, DECK_SIZE + 1)]
+
+# participants per chunk: ~200 bytes each while a chunk is read and turned into X
+CHUNK_ROWS = 1000000
+
+# pairs played in fewer decks get no win rate (NaN)
+MIN_DECKS = 100
+
+# decks of the DB with their outcome (same rule as sample/export_sample.py)
+DB_QUERY = """
+    SELECT pd.cards, COALESCE(d.crowns > o.crowns, FALSE)
+    FROM ParticipantDeck pd
+    JOIN BattleParticipant p
+      ON p.battleId = pd.battleId AND p.playerTag = pd.playerTag AND p.battleTime = pd.battleTime
+    LEFT JOIN BattleData d
+      ON d.battleId = p.battleId AND d.playerTag = p.playerTag AND d.battleTime = p.battleTime
+    LEFT JOIN LATERAL (
+      SELECT MAX(d2.crowns) AS crowns
+      FROM BattleParticipant p2
+      JOIN BattleData d2 ON d2.battleId = p2.battleId AND d2.playerTag = p2.playerTag AND d2.battleTime = p2.battleTime
+      WHERE p2.battleId = p.battleId AND p2.battleTime = p.battleTime
+      AND CASE WHEN p.team IS NULL THEN p2.playerTag <> p.playerTag ELSE p2.team IS DISTINCT FROM p.team END
+    ) o ON TRUE
+    WHERE pd.battleTime >= %(since)s AND pd.battleTime < %(until)s;
+"""
+
+
+def load_cards(path: str = CARDS_JSON) -> tuple:
+    """
+    :param path: Path of cards.json (the cards endpoint of the API);
+    :return: (card ids as a sorted array, card names in the same order).
+    """
+    with open(path) as f:
+        items = sorted(json.load(f)['items'], key=lambda item: item['id'])
+    return np.array([item['id'] for item in items], dtype=np.int64), [item['name'] for item in items]
+
+
+def card_label(name: str) -> str:
+    """
+    :return: The card name as in the R models and the interaction files (e.g., P_E_K_K_A).
+    """
+    return re.sub(r'[ .\-]', '_', name)
+
+
+def deck_matrix(decks: np.ndarray, card_ids: np.ndarray) -> sp.csr_matrix:
+    """
+    :param decks: A (participants x DECK_SIZE) array of card ids; -1 (or any id that is not in
+    card_ids) for no card;
+    :param card_ids: Sorted card ids, one per column;
+    :return: The one-hot matrix (participants x cards), CSR with int32 ones.
+    """
+    cols = np.minimum(np.searchsorted(card_ids, decks), len(card_ids) - 1)
+    known = card_ids[cols] == decks
+    indptr = np.zeros(len(decks) + 1, dtype=np.int64)
+    np.cumsum(known.sum(axis=1), out=indptr[1:])
+    indices = cols[known]  # row by row: the CSR order
+    X = sp.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+                      shape=(len(decks), len(card_ids)))
+    X.sum_duplicates()
+    X.data[:] = 1  # a card listed twice is still one card
+    return X
+
+
+def iter_sample(path: str, chunk_rows: int = CHUNK_ROWS, columns: tuple = ()):
+    """
+    Read the decks of a sample exported by sample/export_sample.py, chunk by chunk.
+    :param path: Path of the Parquet file;
+    :param chunk_rows: Participants per chunk;
+    :param columns: Other columns to read (e.g., 'startingTrophies', 'gameModeId');
+    :return: A generator of (decks array, win array, {column: array}).
+    """
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=CARD_COLUMNS + ['win'] + list(columns)):
+        decks = np.column_stack([pc.fill_null(batch.column(name), -1).to_numpy().astype(np.int64)
+                                 for name in CARD_COLUMNS])
+        win = pc.fill_null(batch.column('win'), False).to_numpy(zero_copy_only=False)
+        yield decks, win, {name: batch.column(name).to_numpy(zero_copy_only=False) for name in columns}
+
+
+def iter_db(con, since, until, chunk_rows: int = CHUNK_ROWS):
+    """
+    Read the decks of the battles of a time range from the DB (table ParticipantDeck), chunk by
+    chunk, through a server-side cursor.
+    :param con: A psycopg2 connection object;
+    :param since: First battleTime (included);
+    :param until: Last battleTime (excluded);
+    :param chunk_rows: Participants per chunk;
+    :return: A generator of (decks array, win array, {}).
+    """
+    with con.cursor(name='decks') as cur:
+        cur.itersize = chunk_rows
+        cur.execute(DB_QUERY, {'since': since, 'until': until})
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if len(rows) == 0:
+                break
+            decks = np.full((len(rows), DECK_SIZE), -1, dtype=np.int64)
+            for i, (cards, win) in enumerate(rows):
+                decks[i, :min(len(cards), DECK_SIZE)] = cards[:DECK_SIZE]
+            yield decks, np.array([row[1] for row in rows], dtype=bool), {}
+
+
+def build_matrix(chunks, card_ids: np.ndarray) -> tuple:
+    """
+    Stack the chunks into one matrix (for model fitting: memory grows with the participants,
+    ~12 bytes per card of a deck).
+    :param chunks: A generator from iter_sample() or iter_db();
+    :param card_ids: Sorted card ids, one per column;
+    :return: (X, win array, {column: array}).
+    """
+    matrices, wins, extras = [], [], {}
+    for decks, win, extra in chunks:
+        matrices.append(deck_matrix(decks, card_ids))
+        wins.append(win)
+        for name, values in extra.items():
+            extras.setdefault(name, []).append(values)
+    if len(matrices) == 0:
+        return sp.csr_matrix((0, len(card_ids)), dtype=np.int32), np.zeros(0, dtype=bool), {}
+    return (sp.vstack(matrices, format='csr'), np.concatenate(wins),
+            {name: np.concatenate(values) for name, values in extras.items()})
+
+
+def interaction_matrix(X: sp.csr_matrix, pairs: np.ndarray) -> sp.csr_matrix:
+    """
+    :param X: A one-hot deck matrix;
+    :param pairs: A (pairs x 2) array of column indices;
+    :return: The (participants x pairs) matrix of the products of the two columns of each pair
+    (1 when the deck has both cards).
+    """
+    return X[:, pairs[:, 0]].multiply(X[:, pairs[:, 1]]).tocsr()
+
+
+class CardCounts:
+    """
+    Counts of decks and wins, per card and per pair of cards, accumulated chunk by chunk:
+    co-occurrence C = X'X (C[i, j]: decks with cards i and j; C[i, i]: decks with card i) and
+    the same over the decks that won. Counts of separate chunks (e.g., from several processes)
+    add up with merge().
+    """
+
+    def __init__(self, card_ids: np.ndarray):
+        self.card_ids = card_ids
+        self.decks = 0
+        self.wins = 0
+        self.cooccurrence = np.zeros((len(card_ids), len(card_ids)), dtype=np.int64)
+        self.cowins = np.zeros((len(card_ids), len(card_ids)), dtype=np.int64)
+
+    def add(self, X: sp.csr_matrix, win: np.ndarray) -> None:
+        """
+        :param X: A one-hot deck matrix (a chunk);
+        :param win: Outcome of each deck.
+        """
+        self.decks += X.shape[0]
+        self.wins += int(win.sum())
+        self.cooccurrence += (X.T @ X).toarray()
+        X_win = X[win]
+        self.cowins += (X_win.T @ X_win).toarray()
+
+    def merge(self, other: 'CardCounts') -> None:
+        self.decks += other.decks
+        self.wins += other.wins
+        self.cooccurrence += other.cooccurrence
+        self.cowins += other.cowins
+
+    def win_rates(self, min_decks: int = MIN_DECKS) -> np.ndarray:
+        """
+        :return: Win rate of the decks with cards i and j (i = j: with card i), NaN for pairs
+        played in fewer than min_decks decks.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = self.cowins / self.cooccurrence
+        rates[self.cooccurrence < max(min_decks, 1)] = np.nan
+        return rates
+
+    def win_lift(self, min_decks: int = MIN_DECKS) -> np.ndarray:
+        """
+        Win-lift of each pair of cards: the win rate of the decks with both cards minus the one
+        expected if the cards did not interact (win rate of i + win rate of j - overall win rate).
+        :return: A symmetric (cards x cards) array; NaN on the diagonal and for rare pairs.
+        """
+        rates = self.win_rates(min_decks)
+        single = np.diag(rates)
+        lift = rates - (single[:, None] + single[None, :] - self.wins / max(self.decks, 1))
+        np.fill_diagonal(lift, np.nan)
+        return lift
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(path, card_ids=self.card_ids, totals=np.array([self.decks, self.wins]),
+                            cooccurrence=self.cooccurrence, cowins=self.cowins)
+
+    @staticmethod
+    def load(path: str) -> 'CardCounts':
+        with np.load(path) as f:
+            counts = CardCounts(f['card_ids'])
+            counts.decks, counts.wins = (int(n) for n in f['totals'])
+            counts.cooccurrence[:] = f['cooccurrence']
+            counts.cowins[:] = f['cowins']
+        return counts
+
+
+def count_cards(chunks, card_ids: np.ndarray) -> CardCounts:
+    """
+    :param chunks: A generator from iter_sample() or iter_db();
+    :param card_ids: Sorted card ids, one per column;
+    :return: The counts of every chunk (only one chunk is in memory at a time).
+    """
+    counts = CardCounts(card_ids)
+    for decks, win, extra in chunks:
+        counts.add(deck_matrix(decks, card_ids), win)
+    return counts
+
+
+def top_pairs(matrix: np.ndarray, labels: list, n: int) -> list:
+    """
+    :return: The n pairs (i < j) with the highest values of a symmetric matrix, as
+    (label i, label j, value), NaNs left out.
+    """
+    i, j = np.triu_indices(len(matrix), k=1)
+    values = matrix[i, j]
+    keep = ~np.isnan(values)
+    i, j, values = i[keep], j[keep], values[keep]
+    order = np.argsort(-values)[:n]
+    return [(labels[i[k]], labels[j[k]], values[k]) for k in order]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Card co-occurrence and win-lift of card pairs from a sample '
+                                                 '(or the DB).')
+    parser.add_argument('sample', nargs='?', default='sample/clash_sample.parquet',
+                        help='Parquet file written by sample/export_sample.py')
+    parser.add_argument('--db', nargs=2, metavar=('SINCE', 'UNTIL'),
+                        help='read the decks of the battles from SINCE to UNTIL (YYYY-MM-DD) from the DB instead')
+    parser.add_argument('--host', default='10.32.95.90')
+    parser.add_argument('--dbname', default='clash')
+    parser.add_argument('--user', default='clashuser')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS,
+                        help='participants per chunk (default: {})'.format(CHUNK_ROWS))
+    parser.add_argument('--min-decks', type=int, default=MIN_DECKS,
+                        help='fewest decks for a pair to get a win rate (default: {})'.format(MIN_DECKS))
+    parser.add_argument('--top', type=int, default=20, help='pairs printed')
+    parser.add_argument('--save', help='save the counts to this .npz file (see CardCounts.load())')
+    args = parser.parse_args()
+
+    card_ids, names = load_cards()
+    labels = [card_label(name) for name in names]
+
+    if args.db:
+        con = psycopg2.connect(host=args.host, dbname=args.dbname, user=args.user)
+        counts = count_cards(iter_db(con, args.db[0], args.db[1], args.chunk_rows), card_ids)
+    else:
+        counts = count_cards(iter_sample(args.sample, args.chunk_rows), card_ids)
+    if args.save:
+        counts.save(args.save)
+
+    print('{} decks, win rate {:.2%}'.format(counts.decks, counts.wins / max(counts.decks, 1)))
+    print('\nMost frequent pairs:')
+    for a, b, value in top_pairs(counts.cooccurrence.astype(float), labels, args.top):
+        print('{:25} {:25} {:>10.0f}'.format(a, b, value))
+    print('\nHighest win-lift (pairs in at least {} decks):'.format(args.min_decks))
+    for a, b, value in top_pairs(counts.win_lift(args.min_decks), labels, args.top):
+        print('{:25} {:25} {:>+10.2%}'.format(a, b, value))
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import Lasso
+
+from deck_matrix import (CHUNK_ROWS, MIN_DECKS, load_cards, card_label, iter_sample, build_matrix,
+                         interaction_matrix, CardCounts)
+
+
+# the purpose of this script is to fit the lasso models of mod_lasso.Rmd and lambda.Rmd
+# (win ~ cards + card pairs, alpha = 1 in glmnet) on a sparse design matrix (deck_matrix.py),
+# for every stratum of the sample (e.g., trophy bracket, game mode) at once: each fit follows a
+# regularization path from the largest lambda down, every fit starting from the previous one's
+# coefficients (warm start), and the cross-validation folds and strata run in a process pool.
+# The positive card pair weights of the chosen lambda are written to graph_lasso*.json, in the
+# format of mod_lasso.Rmd ({"adj": {A: [B, ...]}, "wgt": {"A:B": w}}) that clustergram.py and
+# the shiny app read.
+
+OUTPUT = 'graph_lasso'
+
+# lambdas per path, from lambda max (no coefficient) down to lambda max * LAMBDA_RATIO (as glmnet)
+N_LAMBDAS = 100
+LAMBDA_RATIO = 1e-4
+N_FOLDS = 10
+SEED = 0
+
+# strata with fewer participants are not fitted
+MIN_STRATUM = 1000
+
+# a cross-validation path stops once its test error has not improved for this many lambdas
+# (smaller lambdas only add noise terms, and take the longest to fit)
+PATIENCE = 5
+
+MAX_ITER = 1000
+WEIGHT_DIGITS = 4
+
+# stratum columns of the sample, with the key of each participant in a stratum
+STRATA = {
+    'bracket': ('startingTrophies', lambda values: np.where(np.isnan(values), -1, values // 1000).astype(int)),
+    'mode': ('gameModeId', lambda values: np.where(np.isnan(values), -1, values).astype(int)),
+}
+
+
+def standardize(Z: sp.csc_matrix) -> tuple:
+    """
+    Scale every column to unit variance (glmnet's standardize = TRUE), keeping Z sparse; the
+    intercept takes care of the means.
+    :return: (scaled Z, scale of each column: multiply the coefficients by it).
+    """
+    mean = np.asarray(Z.mean(axis=0)).ravel()
+    variance = np.asarray(Z.multiply(Z).mean(axis=0)).ravel() - mean ** 2
+    scale = np.ones(Z.shape[1])
+    scale[variance > 0] = 1 / np.sqrt(variance[variance > 0])
+    return (Z @ sp.diags(scale)).tocsc(), scale
+
+
+def lambda_path(Z: sp.csc_matrix, y: np.ndarray, extra: list = ()) -> np.ndarray:
+    """
+    :param extra: Lambdas to add to the path;
+    :return: Decreasing lambdas, from the smallest one that zeroes every coefficient.
+    """
+    lambda_max = np.abs(Z.T @ (y - y.mean())).max() / len(y)
+    lambdas = np.geomspace(lambda_max, lambda_max * LAMBDA_RATIO, N_LAMBDAS)
+    return np.array(sorted(set(lambdas) | set(extra), reverse=True))
+
+
+def fit_path(Z: sp.csc_matrix, y: np.ndarray, lambdas: np.ndarray, train: np.ndarray = None,
+             test: np.ndarray = None) -> np.ndarray:
+    """
+    Fit the lasso at every lambda of a path, each fit warm-started from the previous one.
+    :param train: Rows to fit on (default: all);
+    :param test: Rows to test on;
+    :return: Mean squared error on the test rows per lambda if test is given (inf past the end of
+    the path, see PATIENCE), else the coefficients per lambda (lambdas x columns).
+    """
+    Z_train, y_train = (Z, y) if train is None else (Z[train], y[train])
+    model = Lasso(alpha=lambdas[0], warm_start=True, max_iter=MAX_ITER)
+    results = []
+    with warnings.catch_warnings():
+        # the smallest lambdas may not converge within MAX_ITER: they are rarely the ones chosen
+        warnings.simplefilter('ignore', ConvergenceWarning)
+        for value in lambdas:
+            model.set_params(alpha=value)
+            model.fit(Z_train, y_train)
+            if test is None:
+                results.append(model.coef_.copy())
+                continue
+            results.append(np.mean((y[test] - model.predict(Z[test])) ** 2))
+            if len(results) - 1 - int(np.argmin(results)) >= PATIENCE:
+                return np.concatenate([results, np.full(len(lambdas) - len(results), np.inf)])
+    return np.array(results)
+
+
+def _run_task(task: tuple) -> tuple:
+    # a fold (or the full fit) of a stratum, in a worker process
+    stratum, fold, Z, y, lambdas, train, test = task
+    return stratum, fold, fit_path(Z, y, lambdas, train, test)
+
+
+def stratify(n: int, extra: dict, by: list) -> dict:
+    """
+    :param n: Number of participants;
+    :param extra: {column: array} of the sample;
+    :param by: Keys of STRATA;
+    :return: {stratum name: row indices}; a single stratum 'all' without by.
+    """
+    if len(by) == 0:
+        return {'all': np.arange(n)}
+    keys = np.column_stack([STRATA[name][1](extra[STRATA[name][0]].astype(float)) for name in by])
+    strata = {}
+    for key in np.unique(keys, axis=0):
+        name = '_'.join('{}{}'.format(b, 'NA' if k == -1 else k) for b, k in zip(by, key))
+        strata[name] = np.flatnonzero((keys == key).all(axis=1))
+    return strata
+
+
+def select_pairs(X: sp.csr_matrix, min_decks: int) -> np.ndarray:
+    """
+    :return: The (pairs x 2) column indices of the card pairs in at least min_decks decks.
+    """
+    counts = CardCounts(np.arange(X.shape[1]))
+    counts.add(X, np.zeros(X.shape[0], dtype=bool))
+    i, j = np.triu_indices(X.shape[1], k=1)
+    keep = counts.cooccurrence[i, j] >= min_decks
+    return np.column_stack([i[keep], j[keep]])
+
+
+def choose_lambda(lambdas: np.ndarray, mse: np.ndarray, rule: str) -> int:
+    """
+    :param mse: Test error per fold and lambda (folds x lambdas, inf where a fold stopped);
+    :param rule: 'min' (lambda.min of cv.glmnet) or '1se' (lambda.1se);
+    :return: Index of the lambda chosen.
+    """
+    mean = mse.mean(axis=0)
+    best = int(np.argmin(mean))
+    if rule == 'min':
+        return best
+    se = mse[:, best].std(ddof=1) / np.sqrt(len(mse)) if len(mse) > 1 else 0
+    # lambdas decrease: the first one within 1 standard error is the largest
+    return int(np.flatnonzero(mean <= mean[best] + se)[0])
+
+
+def write_graph(path: str, pairs: list, weights: np.ndarray) -> int:
+    """
+    Write the positive pair weights as a weighted graph, as mod_lasso.Rmd did.
+    :param pairs: (label A, label B) of each weight;
+    :return: Number of edges written.
+    """
+    graph = {'adj': {}, 'wgt': {}}
+    for k in np.argsort(-weights):
+        if weights[k] <= 0:
+            break
+        a, b = pairs[k]
+        graph['adj'].setdefault(a, []).append(b)
+        graph['adj'].setdefault(b, []).append(a)
+        graph['wgt']['{}:{}'.format(a, b)] = round(float(weights[k]), WEIGHT_DIGITS)
+        graph['wgt']['{}:{}'.format(b, a)] = round(float(weights[k]), WEIGHT_DIGITS)
+    with open(path, 'w') as f:
+        json.dump(graph, f)
+    return len(graph['wgt']) // 2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit lasso models of card and card pair effects on winning, '
+                                                 'per stratum, and write the card pair graphs.')
+    parser.add_argument('sample', nargs='?', default='sample/clash_sample.parquet',
+                        help='Parquet file written by sample/export_sample.py')
+    parser.add_argument('--by', nargs='*', default=[], choices=sorted(STRATA),
+                        help='fit a model per trophy bracket and/or game mode')
+    parser.add_argument('--lambda', dest='lambdas', type=float, nargs='*', default=[],
+                        help='write the graphs of these lambdas instead of cross-validating')
+    parser.add_argument('--rule', choices=('min', '1se'), default='min',
+                        help='cross-validation: lambda.min or lambda.1se (default: min)')
+    parser.add_argument('--folds', type=int, default=N_FOLDS, help='cross-validation folds (default: {})'.format(N_FOLDS))
+    parser.add_argument('--min-decks', type=int, default=MIN_DECKS,
+                        help='card pairs in fewer decks of a stratum get no term (default: {})'.format(MIN_DECKS))
+    parser.add_argument('--workers', type=int, default=None, help='processes (default: one per core)')
+    parser.add_argument('--output', default=OUTPUT, help='prefix of the JSON files (default: {})'.format(OUTPUT))
+    parser.add_argument('--seed', type=int, default=SEED, help='seed of the folds')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+
+    card_ids, names = load_cards()
+    labels = [card_label(name) for name in names]
+    X, win, extra = build_matrix(iter_sample(args.sample, args.chunk_rows, [STRATA[b][0] for b in args.by]), card_ids)
+    y = win.astype(float)
+
+    rng = np.random.default_rng(args.seed)
+    fits = {}  # stratum -> (rows, pairs, Z, scale, lambdas)
+    tasks = []
+    for stratum, rows in stratify(X.shape[0], extra, args.by).items():
+        if len(rows) < MIN_STRATUM:
+            print('{}: {} participants, skipped'.format(stratum, len(rows)))
+            continue
+        X_stratum = X[rows]
+        pairs = select_pairs(X_stratum, args.min_decks)
+        Z, scale = standardize(sp.hstack([X_stratum, interaction_matrix(X_stratum, pairs)], format='csc', dtype=float))
+        lambdas = lambda_path(Z, y[rows], args.lambdas)
+        fits[stratum] = (rows, pairs, Z, scale, lambdas)
+        if len(args.lambdas) == 0:
+            folds = rng.permutation(len(rows)) % args.folds
+            for fold in range(args.folds):
+                tasks.append((stratum, fold, Z, y[rows], lambdas, np.flatnonzero(folds != fold),
+                              np.flatnonzero(folds == fold)))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        # cross-validation of every stratum, then the fits on all the rows of each stratum, down
+        # to the smallest lambda chosen
+        mse = {}
+        for stratum, fold, result in pool.map(_run_task, tasks):
+            mse.setdefault(stratum, []).append(result)
+        chosen = {}
+        for stratum, (rows, pairs, Z, scale, lambdas) in fits.items():
+            if len(args.lambdas) > 0:
+                chosen[stratum] = [int(np.flatnonzero(lambdas == value)[0]) for value in args.lambdas]
+            else:
+                chosen[stratum] = [choose_lambda(lambdas, np.array(mse[stratum]), args.rule)]
+        tasks = [(stratum, None, Z, y[rows], lambdas[:max(chosen[stratum]) + 1], None, None)
+                 for stratum, (rows, pairs, Z, scale, lambdas) in fits.items()]
+        coefs = {stratum: result for stratum, fold, result in pool.map(_run_task, tasks)}
+
+    for stratum, (rows, pairs, Z, scale, lambdas) in fits.items():
+        for n, k in enumerate(chosen[stratum]):
+            # coefficients on the scale of the 0/1 indicators; pair terms follow the card terms
+            weights = (coefs[stratum][k] * scale)[len(card_ids):]
+            suffix = ''.join('_' + part for part in ([str(args.lambdas[n])] if len(args.lambdas) > 0 else [])
+                             + ([stratum] if len(args.by) > 0 else []))
+            path = '{}{}.json'.format(args.output, suffix)
+            edges = write_graph(path, [(labels[a], labels[b]) for a, b in pairs], weights)
+            print('{}: {} participants, lambda {:.3g}, {} pair terms, {} positive: {}'.format(
+                stratum, len(rows), lambdas[k], len(pairs), edges, path))
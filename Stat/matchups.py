@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import numpy as np
+import psycopg2
+
+from deck_matrix import DECK_SIZE, load_cards, card_label, deck_matrix
+
+
+# the purpose of this script is to count how each card does against each other card over all the
+# battles of the DB: for every participant, the cards of their deck (i) against the cards of the
+# other side's decks (j), in games[i, j], and in wins[i, j] when the participant won (same rule as
+# sample/export_sample.py; wins[j, i] are then their losses). Battles are streamed chunk by chunk
+# by worker processes, each over a range of battleIds, and the partial counts are added up.
+# Counts are kept per day (of battleTime) in a .npz file with the number of battles of each day:
+# an update only recounts the days whose number of battles in the DB changed (battles crawled
+# since, or a new day), and keeps the days that are no longer in the DB (archived months).
+
+HOST = '10.32.95.90'
+DBNAME = 'clash'
+USER = 'clashuser'
+
+OUTPUT = 'matchups.npz'
+N_WORKERS = 4
+
+# battleId ranges (of the first byte of the sha256 digest) given out to the workers
+N_RANGES = 16
+
+# participants fetched per chunk
+CHUNK_ROWS = 100000
+
+# matchups played fewer times get no win rate (NaN)
+MIN_GAMES = 100
+
+# battles per day of the DB
+DAYS_QUERY = """
+    SELECT battleTime::date, COUNT(*)
+    FROM BattleInfo
+    WHERE battleTime >= %(since)s AND battleTime < %(until)s
+    GROUP BY 1;
+"""
+
+# deck of each participant, the decks of the other side and the outcome
+MATCHUP_QUERY = """
+    SELECT pd.battleTime::date, pd.cards, o.cards, COALESCE(d.crowns > o.crowns, FALSE)
+    FROM ParticipantDeck pd
+    JOIN BattleParticipant p
+      ON p.battleId = pd.battleId AND p.playerTag = pd.playerTag AND p.battleTime = pd.battleTime
+    LEFT JOIN BattleData d
+      ON d.battleId = p.battleId AND d.playerTag = p.playerTag AND d.battleTime = p.battleTime
+    JOIN LATERAL (
+      SELECT array_agg(c) AS cards, MAX(d2.crowns) AS crowns
+      FROM BattleParticipant p2
+      JOIN ParticipantDeck pd2
+        ON pd2.battleId = p2.battleId AND pd2.playerTag = p2.playerTag AND pd2.battleTime = p2.battleTime
+      CROSS JOIN unnest(pd2.cards) c
+      LEFT JOIN BattleData d2 ON d2.battleId = p2.battleId AND d2.playerTag = p2.playerTag AND d2.battleTime = p2.battleTime
+      WHERE p2.battleId = p.battleId AND p2.battleTime = p.battleTime
+      AND CASE WHEN p.team IS NULL THEN p2.playerTag <> p.playerTag ELSE p2.team IS DISTINCT FROM p.team END
+    ) o ON o.cards IS NOT NULL
+    WHERE pd.battleTime >= %(since)s AND pd.battleTime < %(until)s AND pd.battleTime::date = ANY(%(days)s)
+    AND pd.battleId >= %(low)s {}
+"""
+
+
+class Matchups:
+    """
+    Card against card counts per day: games[i, j] (a deck with card i against a side with card
+    j) and wins[i, j] (of those, the ones the deck won; draws are neither wins nor losses).
+    Counts of separate workers add up with merge().
+    """
+
+    def __init__(self, card_ids: np.ndarray):
+        self.card_ids = card_ids
+        self.battles = {}  # day -> battles of the day in the DB when it was counted
+        self.games = {}  # day -> (cards x cards) array
+        self.wins = {}
+
+    def add(self, day: date, X, O, win: np.ndarray) -> None:
+        """
+        :param X: One-hot matrix of the decks (a chunk of participants of the day);
+        :param O: One-hot matrix of the cards of the other side of each participant;
+        :param win: Outcome of each participant.
+        """
+        shape = (len(self.card_ids), len(self.card_ids))
+        games = self.games.setdefault(day, np.zeros(shape, dtype=np.int64))
+        wins = self.wins.setdefault(day, np.zeros(shape, dtype=np.int64))
+        games += (X.T @ O).toarray()
+        wins += (X[win].T @ O[win]).toarray()
+
+    def merge(self, other: 'Matchups') -> None:
+        for day in other.games:
+            if day in self.games:
+                self.games[day] += other.games[day]
+                self.wins[day] += other.wins[day]
+            else:
+                self.games[day] = other.games[day]
+                self.wins[day] = other.wins[day]
+        self.battles.update(other.battles)
+
+    def drop(self, days: list) -> None:
+        for day in days:
+            self.battles.pop(day, None)
+            self.games.pop(day, None)
+            self.wins.pop(day, None)
+
+    def total(self, since: date = None, until: date = None) -> tuple:
+        """
+        :return: (games, wins) of the days from since (included) to until (excluded).
+        """
+        games = np.zeros((len(self.card_ids), len(self.card_ids)), dtype=np.int64)
+        wins = np.zeros_like(games)
+        for day in self.games:
+            if (since is None or day >= since) and (until is None or day < until):
+                games += self.games[day]
+                wins += self.wins[day]
+        return games, wins
+
+    def win_rates(self, min_games: int = MIN_GAMES, since: date = None, until: date = None) -> np.ndarray:
+        """
+        :return: Win rate of card i against card j, draws left out (rates[j, i] = 1 - rates[i, j]),
+        NaN for matchups decided fewer than min_games times.
+        """
+        games, wins = self.total(since, until)
+        decided = wins + wins.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = wins / decided
+        rates[decided < max(min_games, 1)] = np.nan
+        return rates
+
+    def save(self, path: str) -> None:
+        # written to a temporary file first: an interrupted update keeps the previous counts
+        days = sorted(self.games)
+        shape = (len(days), len(self.card_ids), len(self.card_ids))
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, card_ids=self.card_ids, days=np.array(days, dtype='datetime64[D]'),
+                                battles=np.array([self.battles[day] for day in days], dtype=np.int64),
+                                games=np.array([self.games[day] for day in days]).reshape(shape),
+                                wins=np.array([self.wins[day] for day in days]).reshape(shape))
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def load(path: str) -> 'Matchups':
+        with np.load(path) as f:
+            matchups = Matchups(f['card_ids'])
+            battles, games, wins = f['battles'], f['games'], f['wins']
+            for k, day in enumerate(f['days'].tolist()):
+                matchups.battles[day] = int(battles[k])
+                matchups.games[day] = games[k]
+                matchups.wins[day] = wins[k]
+        return matchups
+
+
+def stale_days(con, matchups: Matchups, since: date, until: date) -> dict:
+    """
+    :return: {day: battles in the DB} of the days whose counts are missing or out of date.
+    """
+    with con.cursor() as cur:
+        cur.execute(DAYS_QUERY, {'since': since, 'until': until})
+        return {day: battles for day, battles in cur.fetchall() if matchups.battles.get(day) != battles}
+
+
+def battle_id_ranges(n: int) -> list:
+    """
+    :return: n (low, high) battleId ranges covering every sha256 digest (high is None for the last).
+    """
+    bounds = [bytes([i * 256 // n]) for i in range(n)]
+    return [(bounds[i], bounds[i + 1] if i + 1 < n else None) for i in range(n)]
+
+
+def pad(cards: list, width: int) -> np.ndarray:
+    """
+    :return: A (rows x width) array of card ids, -1 after the cards of each row.
+    """
+    array = np.full((len(cards), width), -1, dtype=np.int64)
+    for i, row in enumerate(cards):
+        array[i, :min(len(row), width)] = row[:width]
+    return array
+
+
+def count_range(task: tuple) -> Matchups:
+    """
+    Count the matchups of the battles of a battleId range, in a worker process.
+    :param task: (connection parameters, card ids, days, since, until, (low, high), chunk rows).
+    """
+    dsn, card_ids, days, since, until, (low, high), chunk_rows = task
+    matchups = Matchups(card_ids)
+    con = psycopg2.connect(**dsn)
+    query = MATCHUP_QUERY.format('' if high is None else 'AND pd.battleId < %(high)s')
+    with con.cursor(name='matchups') as cur:
+        cur.itersize = chunk_rows
+        cur.execute(query, {'since': since, 'until': until, 'days': days, 'low': low, 'high': high})
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if len(rows) == 0:
+                break
+            row_days = np.array([row[0] for row in rows])
+            X = deck_matrix(pad([row[1] for row in rows], DECK_SIZE), card_ids)
+            # 2v2: the other side has two decks
+            O = deck_matrix(pad([row[2] for row in rows], 2 * DECK_SIZE), card_ids)
+            win = np.array([row[3] for row in rows], dtype=bool)
+            for day in np.unique(row_days):
+                rows_day = row_days == day
+                matchups.add(day, X[rows_day], O[rows_day], win[rows_day])
+    con.close()
+    return matchups
+
+
+def update(dsn: dict, matchups: Matchups, since: date, until: date, rebuild: bool = False,
+           workers: int = N_WORKERS, ranges: int = N_RANGES, chunk_rows: int = CHUNK_ROWS) -> list:
+    """
+    Recount the days of the DB that are missing from the counts or out of date (every day from
+    since to until with rebuild).
+    :param dsn: psycopg2.connect() parameters;
+    :return: The days recounted.
+    """
+    con = psycopg2.connect(**dsn)
+    if rebuild:
+        matchups.drop([day for day in list(matchups.games) if since <= day < until])
+    # battles are counted before the matchups: a battle crawled in between makes its day stale
+    # for the next update, instead of going unnoticed
+    days = stale_days(con, matchups, since, until)
+    con.close()
+    if len(days) == 0:
+        return []
+
+    matchups.drop(list(days))
+    # the time range of the stale days (for partition pruning)
+    first, last = min(days), date.fromordinal(max(days).toordinal() + 1)
+    tasks = [(dsn, matchups.card_ids, sorted(days), first, last, battle_id_range, chunk_rows)
+             for battle_id_range in battle_id_ranges(ranges)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for partial in pool.map(count_range, tasks):
+            matchups.merge(partial)
+    matchups.battles.update(days)
+    return sorted(days)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count card against card wins and losses over the battles of the DB, '
+                                                 'and print the matchups of a card.')
+    parser.add_argument('--output', default=OUTPUT, help='counts file, updated in place (default: {})'.format(OUTPUT))
+    parser.add_argument('--since', type=date.fromisoformat, default=date.min,
+                        help='count the battles from this day on (YYYY-MM-DD)')
+    parser.add_argument('--until', type=date.fromisoformat, default=date.max,
+                        help='count the battles before this day (YYYY-MM-DD)')
+    parser.add_argument('--rebuild', action='store_true', help='recount every day, not only the stale ones')
+    parser.add_argument('--no-update', action='store_true', help='only print the counts of the file')
+    parser.add_argument('--workers', type=int, default=N_WORKERS, help='processes (default: {})'.format(N_WORKERS))
+    parser.add_argument('--ranges', type=int, default=N_RANGES,
+                        help='battleId ranges given out to the processes (default: {})'.format(N_RANGES))
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS,
+                        help='participants per chunk (default: {})'.format(CHUNK_ROWS))
+    parser.add_argument('--card', help='print the matchups of this card (e.g., Hog_Rider)')
+    parser.add_argument('--min-games', type=int, default=MIN_GAMES,
+                        help='fewest decided games for a matchup to get a win rate (default: {})'.format(MIN_GAMES))
+    parser.add_argument('--top', type=int, default=20, help='matchups printed')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--dbname', default=DBNAME)
+    parser.add_argument('--user', default=USER)
+    args = parser.parse_args()
+
+    card_ids, names = load_cards()
+    labels = [card_label(name) for name in names]
+    matchups = Matchups.load(args.output) if os.path.exists(args.output) else Matchups(card_ids)
+    if not np.array_equal(matchups.card_ids, card_ids):
+        parser.error('the cards of {} differ from cards.json: recount with a new --output'.format(args.output))
+
+    if not args.no_update:
+        dsn = {'host': args.host, 'dbname': args.dbname, 'user': args.user}
+        days = update(dsn, matchups, args.since, args.until, args.rebuild, args.workers, args.ranges, args.chunk_rows)
+        matchups.save(args.output)
+        print('{} days recounted{}'.format(len(days), ' ({} to {})'.format(days[0], days[-1]) if days else ''))
+
+    games, wins = matchups.total(args.since, args.until)
+    print('{} days, {} battles, {} card matchups'.format(
+        sum(1 for day in matchups.games if args.since <= day < args.until),
+        sum(n for day, n in matchups.battles.items() if args.since <= day < args.until), games.sum()))
+    rates = matchups.win_rates(args.min_games, args.since, args.until)
+    if args.card:
+        if args.card not in labels:
+            parser.error('unknown card: {}'.format(args.card))
+        i = labels.index(args.card)
+        order = [j for j in np.argsort(-rates[i]) if not np.isnan(rates[i, j])]
+        for title, selected in (('Best', order[:args.top]), ('Worst', order[::-1][:args.top])):
+            print('\n{} matchups of {} (at least {} decided games):'.format(title, args.card, args.min_games))
+            for j in selected:
+                print('{:25} {:>8.2%} {:>10}'.format(labels[j], rates[i, j], games[i, j]))
+    else:
+        print('\nMost one-sided matchups (at least {} decided games):'.format(args.min_games))
+        i, j = np.nonzero(rates > 0.5)
+        for k in np.argsort(-rates[i, j])[:args.top]:
+            print('{:25} beats {:25} {:>8.2%} {:>10}'.format(labels[i[k]], labels[j[k]], rates[i[k], j[k]],
+                                                             games[i[k], j[k]]))
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+from datetime import datetime
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# the purpose of this script is to export a random sample of battles to a Parquet file with one
+# row per participant (battle, player and deck columns; the deck as 8 card id and 8 card level
+# columns, sorted by card id; win: more crowns than the other side), replacing sample.sql (a CSV
+# with one row per card). Rows are streamed from a server-side cursor, so memory use does not
+# depend on the sample size.
+# A battle is sampled when a hash of its battleId and the seed falls below the fraction: the same
+# seed gives the same battles on every run (and those battles plus new ones as the DB grows).
+# Load it with pandas.read_parquet() or arrow::read_parquet() in R; card names are in the file
+# <output>_cards.parquet (table Card).
+
+HOST = '10.32.95.90'
+DBNAME = 'clash'
+USER = 'clashuser'  # password: PGPASSWORD or ~/.pgpass, like psql
+
+OUTPUT = 'clash_sample.parquet'
+FRACTION = 0.01
+SEED = 0
+DECK_SIZE = 8
+
+# rows fetched from the server and written per Parquet row group
+CHUNK_ROWS = 100000
+
+# (SQL expression, column name, Parquet type) of the columns written
+COLUMNS = [
+    ('i.battleId', 'battleId', pa.binary()),
+    ('i.battleTime', 'battleTime', pa.timestamp('us')),
+    ('i.type', 'type', pa.string()),
+    ('i.isLadderTournament', 'isLadderTournament', pa.bool_()),
+    ('i.arenaId', 'arenaId', pa.int32()),
+    ('i.arena', 'arena', pa.string()),
+    ('i.gameModeId', 'gameModeId', pa.int32()),
+    ('i.gameMode', 'gameMode', pa.string()),
+    ('i.deckSelection', 'deckSelection', pa.string()),
+    ('p.playerTag', 'playerTag', pa.string()),
+    ('p.team', 'team', pa.bool_()),
+    ('d.clanTag', 'clanTag', pa.string()),
+    ('d.startingTrophies', 'startingTrophies', pa.int32()),
+    ('d.trophyChange', 'trophyChange', pa.int32()),
+    ('d.crowns', 'crowns', pa.int32()),
+    ('d.princessTower1HitPoints', 'princessTower1HitPoints', pa.int32()),
+    ('d.princessTower2HitPoints', 'princessTower2HitPoints', pa.int32()),
+    ('d.kingTowerHitPoints', 'kingTowerHitPoints', pa.int32()),
+    ('trim(d.boatBattleSide)', 'boatBattleSide', pa.string()),
+    ('d.boatBattleWon', 'boatBattleWon', pa.bool_()),
+    ('d.newBoatTowersDestroyed', 'newBoatTowersDestroyed', pa.int32()),
+    ('d.prevBoatTowersDestroyed', 'prevBoatTowersDestroyed', pa.int32()),
+    ('d.remainingBoatTowers', 'remainingBoatTowers', pa.int32()),
+    ('COALESCE(d.crowns > o.crowns, FALSE)', 'win', pa.bool_()),
+] + [('pd.cards[{}]'.format(i), 'card{}'.format(i), pa.int32()) for i in range(1, DECK_SIZE + 1)] \
+  + [('pd.cardLevels[{}]'.format(i), 'cardLevel{}'.format(i), pa.int16()) for i in range(1, DECK_SIZE + 1)]
+
+SCHEMA = pa.schema([(name, pa_type) for expr, name, pa_type in COLUMNS])
+
+
+def build_query(args) -> tuple:
+    """
+    :param args: The parsed command line arguments;
+    :return: (query, parameters) of the sample.
+    """
+    # battleId is a sha256 digest: hashing it with the seed gives an evenly spread 63-bit number
+    conditions = ["(hashtextextended(encode(i.battleId, 'hex'), %(seed)s) & 9223372036854775807) < %(threshold)s"]
+    params = {'seed': args.seed, 'threshold': int(args.fraction * 2 ** 63)}
+
+    if args.game_mode:
+        conditions.append('i.gameModeId = ANY(%(game_modes)s)')
+        params['game_modes'] = args.game_mode
+    if args.since:
+        conditions.append('i.battleTime >= %(since)s')
+        params['since'] = args.since
+    if args.until:
+        conditions.append('i.battleTime < %(until)s')
+        params['until'] = args.until
+    if args.min_trophies is not None:
+        conditions.append('d.startingTrophies >= %(min_trophies)s')
+        params['min_trophies'] = args.min_trophies
+    if args.max_trophies is not None:
+        conditions.append('d.startingTrophies < %(max_trophies)s')
+        params['max_trophies'] = args.max_trophies
+
+    query = """
+        SELECT {}
+        FROM BattleInfo i
+        JOIN BattleParticipant p ON p.battleId = i.battleId AND p.battleTime = i.battleTime
+        LEFT JOIN BattleData d
+          ON d.battleId = p.battleId AND d.playerTag = p.playerTag AND d.battleTime = p.battleTime
+        LEFT JOIN ParticipantDeck pd
+          ON pd.battleId = p.battleId AND pd.playerTag = p.playerTag AND pd.battleTime = p.battleTime
+        LEFT JOIN LATERAL (
+          -- most crowns taken by the other side (the other player when there are no teams)
+          SELECT MAX(d2.crowns) AS crowns
+          FROM BattleParticipant p2
+          JOIN BattleData d2 ON d2.battleId = p2.battleId AND d2.playerTag = p2.playerTag AND d2.battleTime = p2.battleTime
+          WHERE p2.battleId = p.battleId AND p2.battleTime = p.battleTime
+          AND CASE WHEN p.team IS NULL THEN p2.playerTag <> p.playerTag ELSE p2.team IS DISTINCT FROM p.team END
+        ) o ON TRUE
+        WHERE {};
+    """.format(', '.join(expr for expr, name, pa_type in COLUMNS), ' AND '.join(conditions))
+    return query, params
+
+
+def to_table(rows: list) -> pa.Table:
+    columns = [list(col) for col in zip(*rows)]
+    columns[0] = [bytes(value) for value in columns[0]]  # battleId: memoryview
+    return pa.Table.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, SCHEMA)],
+                                schema=SCHEMA)
+
+
+def export_sample(con, query: str, params: dict, path: str) -> int:
+    """
+    Stream the rows of the query into a zstd-compressed Parquet file (which only takes its
+    final name once complete).
+    :return: Number of rows written.
+    """
+    tmp_path = path + '.tmp'
+    rows_written = 0
+    with con.cursor(name='sample') as cur, pq.ParquetWriter(tmp_path, SCHEMA, compression='zstd') as writer:
+        cur.itersize = CHUNK_ROWS
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(CHUNK_ROWS)
+            if len(rows) == 0:
+                break
+            writer.write_table(to_table(rows))
+            rows_written += len(rows)
+            print('{} rows written'.format(rows_written), flush=True)
+    con.commit()
+    os.replace(tmp_path, path)
+    return rows_written
+
+
+def export_cards(con, path: str) -> None:
+    with con.cursor() as cur:
+        cur.execute('SELECT cardId, name FROM Card ORDER BY cardId;')
+        rows = cur.fetchall()
+    pq.write_table(pa.table({'cardId': pa.array([row[0] for row in rows], pa.int32()),
+                             'name': pa.array([row[1] for row in rows], pa.string())}), path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a repeatable random sample of battles to Parquet '
+                                                 '(one row per participant).')
+    parser.add_argument('--output', default=OUTPUT, help='Parquet file (default: {})'.format(OUTPUT))
+    parser.add_argument('--fraction', type=float, default=FRACTION,
+                        help='fraction of the battles sampled (default: {})'.format(FRACTION))
+    parser.add_argument('--seed', type=int, default=SEED,
+                        help='seed of the sample: the same seed gives the same battles (default: {})'.format(SEED))
+    parser.add_argument('--game-mode', type=int, action='append',
+                        help='keep battles of this gameModeId only (repeat for several)')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='keep battles from this time on (YYYY-MM-DD)')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='keep battles before this time (YYYY-MM-DD)')
+    parser.add_argument('--min-trophies', type=int, help='keep participants with at least this many starting trophies')
+    parser.add_argument('--max-trophies', type=int, help='keep participants with fewer starting trophies than this')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--dbname', default=DBNAME)
+    parser.add_argument('--user', default=USER)
+    args = parser.parse_args()
+
+    con = psycopg2.connect(host=args.host, dbname=args.dbname, user=args.user)
+    query, params = build_query(args)
+    rows = export_sample(con, query, params, args.output)
+    export_cards(con, os.path.splitext(args.output)[0] + '_cards.parquet')
+    print('Exported {} participants to {}'.format(rows, args.output))
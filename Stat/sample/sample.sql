@@ -1,4 +1,5 @@
 -- Take a random sample from DB with all relavant tables joined
+-- (one row per card, as CSV; export_sample.py writes a repeatable sample as Parquet instead)
 
 CREATE TEMP VIEW Sample AS (
     WITH SampleInfo AS (
@@ -10,17 +11,17 @@ CREATE TEMP VIEW Sample AS (
     SampleParticipant AS (
         SELECT *
         FROM SampleInfo
-        LEFT JOIN BattleParticipant USING (battleId)
+        LEFT JOIN BattleParticipant USING (battleId, battleTime)
     ),
     SampleDeck AS (
         SELECT *
         FROM SampleParticipant
-        LEFT JOIN BattleDeck USING (battleId, playerTag)
+        LEFT JOIN BattleDeck USING (battleId, playerTag, battleTime)
     ),
     SampleData AS (
         SELECT *
         FROM SampleDeck
-        LEFT JOIN BattleData USING (battleId, playerTag)
+        LEFT JOIN BattleData USING (battleId, playerTag, battleTime)
     )
     SELECT * FROM SampleData
 );